@@ -0,0 +1,306 @@
+import asyncio
+import time
+from bisect import insort
+from pyutilb.asyncio_threadpool import EventLoopThread
+from pyutilb.log import log
+from pyutilb.util import parse_func
+
+# 默认走快速通道的动作: 通知类动作，不能被耗时的dump动作阻塞
+default_fast_actions = ['send_email', 'send_alert_email']
+
+# 默认的单动作并发上限: 动作名 -> 同动作(同参数，如同一进程分组)最多同时执行几个
+default_limits = {
+    'dump_jvm_heap': 1,
+    'dump_jvm_thread': 1,
+    'dump_jvm_hot_threads': 1,
+    'profile_threads': 1,
+    'dump_jvm_gcs_xlsx': 1,
+    'dump_all_proc_xlsx': 1,
+    'compare_gc_logs': 1,
+}
+
+# 队列满时的淘汰策略
+overflow_policies = ['drop_oldest', 'drop_new']
+
+'''
+排队中的动作任务
+'''
+class ActionJob(object):
+
+    def __init__(self, name, steps, vars, priority, limit_key, coalesce_key):
+        '''
+        :param name: 动作名，用于分流与限流
+        :param steps: 要执行的步骤
+        :param vars: 传递调用线程中的变量
+        :param priority: 优先级，越小越优先
+        :param limit_key: 并发上限的分组key，为空则不限
+        :param coalesce_key: 合并key，排队中有同key的任务则合并(丢掉新任务)，为空则不合并
+        '''
+        self.name = name
+        self.steps = steps
+        self.vars = vars
+        self.priority = priority
+        self.limit_key = limit_key
+        self.coalesce_key = coalesce_key
+        self.submit_time = time.time()
+
+'''
+执行通道: 一个事件循环线程 + 有界的优先级队列
+    队列的读写都在通道线程中执行，因此不用加锁
+'''
+class ActionLane(object):
+
+    def __init__(self, name, runner, workers, queue_size, overflow, limits):
+        '''
+        :param name: 通道名
+        :param runner: 执行步骤的协程函数，参数为 (steps, vars)
+        :param workers: 最多同时执行几个任务
+        :param queue_size: 最多排队几个任务
+        :param overflow: 队列满时的淘汰策略: drop_oldest 淘汰优先级最低的任务中最早的, drop_new 丢掉新任务
+        :param limits: 单动作的并发上限
+        '''
+        self.name = name
+        self.runner = runner
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.limits = limits
+        self.thread = EventLoopThread() # 递延启动
+        self.queue = [] # 排队中的任务: (优先级, 序号, 任务)，有序
+        self.seq = 0
+        self.running = 0
+        self.running_keys = {} # 执行中的任务数: limit_key -> 个数
+        # 统计
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.done = 0
+        self.failed = 0
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_queue_size = 0
+
+    # 提交任务: 线程安全，扔到通道线程中入队
+    def submit(self, job):
+        self.thread.exec(self.enqueue, job)
+
+    # 入队，在通道线程中执行
+    def enqueue(self, job):
+        self.submitted += 1
+        # 1 合并: 排队中已有同样的任务
+        if job.coalesce_key is not None:
+            for _, _, job2 in self.queue:
+                if job2.coalesce_key == job.coalesce_key:
+                    self.coalesced += 1
+                    log.info("执行通道[%s]合并排队中的重复动作: %s", self.name, job.name)
+                    return
+        # 2 队列满: 淘汰
+        if len(self.queue) >= self.queue_size:
+            if self.overflow == 'drop_new' or job.priority > self.queue[-1][0]:
+                self.drop(job)
+                return
+            self.drop(self.pop_oldest_lowest())
+        # 3 入队
+        self.seq += 1
+        insort(self.queue, (job.priority, self.seq, job)) # 序号唯一，不会比较到任务
+        self.max_queue_size = max(self.max_queue_size, len(self.queue))
+        self.dispatch()
+
+    # 弹出优先级最低的任务中最早的
+    def pop_oldest_lowest(self):
+        lowest = self.queue[-1][0]
+        for i, item in enumerate(self.queue):
+            if item[0] == lowest:
+                return self.queue.pop(i)[2]
+
+    # 丢弃任务
+    def drop(self, job):
+        self.dropped += 1
+        log.warning("执行通道[%s]队列已满(%s), 丢弃动作: %s", self.name, self.queue_size, job.name)
+
+    # 分发任务: 按优先级，跳过已达并发上限的任务
+    def dispatch(self):
+        i = 0
+        while self.running < self.workers and i < len(self.queue):
+            job = self.queue[i][2]
+            key = job.limit_key
+            if key is not None and self.running_keys.get(key, 0) >= self.limits[job.name]:
+                i += 1
+                continue
+            del self.queue[i]
+            self.running += 1
+            if key is not None:
+                self.running_keys[key] = self.running_keys.get(key, 0) + 1
+            asyncio.ensure_future(self.run_job(job))
+
+    # 执行任务
+    async def run_job(self, job):
+        wait = time.time() - job.submit_time
+        self.started += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        try:
+            await self.runner(job.steps, dict(job.vars))
+            self.done += 1
+        except Exception as ex:
+            self.failed += 1
+            log.error("ActionLane.run_job()异常: " + str(ex), exc_info=ex)
+        finally:
+            self.running -= 1
+            key = job.limit_key
+            if key is not None:
+                self.running_keys[key] -= 1
+                if self.running_keys[key] == 0:
+                    del self.running_keys[key]
+            self.dispatch()
+
+    # 排队最久的任务的等待秒数
+    @property
+    def wait_time(self):
+        queue = list(self.queue) # 复制，以免其他线程读时被修改
+        if len(queue) == 0:
+            return 0
+        return time.time() - min(item[2].submit_time for item in queue)
+
+    # 统计
+    def stats(self):
+        return {
+            'queue_size': len(self.queue),
+            'max_queue_size': self.max_queue_size,
+            'running': self.running,
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'done': self.done,
+            'failed': self.failed,
+            'wait_time': self.wait_time,
+            'avg_wait': self.total_wait / self.started if self.started else 0,
+            'max_wait': self.max_wait,
+        }
+
+'''
+告警动作的执行器，代替单线程的协程线程池，以免一个耗时的动作(如10分钟的jmap)阻塞后面的动作(如发告警邮件)
+   1 两个通道各有一个事件循环线程: 快速通道执行通知类动作，普通通道执行其他动作(如dump)
+   2 通道内按优先级执行，同时执行的任务数有上限
+   3 单动作的并发上限: 如同一进程最多同时执行一个jmap，达到上限的任务继续排队，不阻塞其他动作
+   4 队列有界: 排队中有重复的任务则合并，队列满则按策略丢弃
+   5 统计队列长度与等待时间，可用于告警条件，如 executor.wait_time > 60
+'''
+class ActionExecutor(object):
+
+    def __init__(self, runner):
+        '''
+        :param runner: 执行步骤的协程函数，参数为 (steps, vars)
+        '''
+        self.runner = runner
+        self.fast_actions = list(default_fast_actions)
+        self.priorities = {}
+        self.lanes = None
+        self.config({})
+
+    def config(self, options):
+        '''
+        配置执行器，必须在提交任务前调用
+        :param options: 选项，包含
+                    workers: 普通通道最多同时执行几个动作，默认4
+                    fast_workers: 快速通道最多同时执行几个动作，默认2
+                    queue_size: 每个通道最多排队几个动作，默认100
+                    overflow: 队列满时的淘汰策略: drop_oldest(默认) 淘汰优先级最低的动作中最早的, drop_new 丢掉新动作
+                    limits: 单动作的并发上限，如 {dump_jvm_heap: 1}，同动作同参数(如同一进程分组)的动作最多同时执行几个，会合并到默认上限中
+                    priorities: 动作的优先级，如 {dump_jvm_thread: 1}，越小越优先，默认10
+                    fast_actions: 走快速通道的动作，默认 send_email 与 send_alert_email
+        '''
+        if self.lanes is not None and any(lane.submitted > 0 for lane in self.lanes.values()):
+            raise Exception("动作执行器已在运行, 不能再配置")
+        overflow = options.get('overflow', 'drop_oldest')
+        if overflow not in overflow_policies:
+            raise Exception(f"无效的队列淘汰策略: {overflow}")
+        limits = {**default_limits, **{k: int(v) for k, v in (options.get('limits') or {}).items()}}
+        self.priorities = {k: int(v) for k, v in (options.get('priorities') or {}).items()}
+        if 'fast_actions' in options:
+            self.fast_actions = list(options['fast_actions'])
+        queue_size = int(options.get('queue_size', 100))
+        self.lanes = {
+            'fast': ActionLane('fast', self.runner, int(options.get('fast_workers', 2)), queue_size, overflow, limits),
+            'normal': ActionLane('normal', self.runner, int(options.get('workers', 4)), queue_size, overflow, limits),
+        }
+
+    def submit_steps(self, steps, vars = None, name = None):
+        '''
+        提交要执行的步骤
+        :param steps: 步骤
+        :param vars: 传递调用线程中的变量
+        :param name: 任务名，为空则拆分为单个动作的任务，各自排队与并发执行；否则作为一个任务串行执行(如 when_no_run)，排队中有同名任务则合并
+        '''
+        vars = vars or {}
+        if name is not None:
+            self.submit(name, steps, vars, name)
+            return
+        # 合并key要带上告警的进程与目录: 无参的dump动作默认导出告警的进程，放到告警目录下，不同告警的dump不能合并
+        alert_proc = vars.get('alert_proc')
+        alert_dir = vars.get('alert_dir')
+        for step in steps:
+            for action, param in step.items():
+                self.submit(self.parse_action_name(action), [{action: param}], vars, (action, repr(param), alert_proc, alert_dir))
+
+    # 解析动作名，如 dump_jvm_heap(app) 的动作名为 dump_jvm_heap
+    def parse_action_name(self, action):
+        if '(' in action:
+            return parse_func(action)[0]
+        return action
+
+    # 提交单个任务
+    def submit(self, name, steps, vars, coalesce_key):
+        lane = self.lanes['fast' if name in self.fast_actions else 'normal']
+        if lane.name == 'fast': # 通知不合并: 同一动作不同告警的通知都要发
+            coalesce_key = None
+        limit_key = None
+        if name in lane.limits: # 按动作名+参数+告警的进程限流，如同一进程分组的jmap
+            limit_key = (name, coalesce_key[0], coalesce_key[2]) if isinstance(coalesce_key, tuple) else name
+        priority = self.priorities.get(name, 0 if lane.name == 'fast' else 10)
+        lane.submit(ActionJob(name, steps, vars, priority, limit_key, coalesce_key))
+
+    # 排队中的动作数
+    @property
+    def queue_size(self):
+        return sum(len(lane.queue) for lane in self.lanes.values())
+
+    # 执行中的动作数
+    @property
+    def running(self):
+        return sum(lane.running for lane in self.lanes.values())
+
+    # 排队最久的动作的等待秒数
+    @property
+    def wait_time(self):
+        return max(lane.wait_time for lane in self.lanes.values())
+
+    # 丢弃的动作数
+    @property
+    def dropped(self):
+        return sum(lane.dropped for lane in self.lanes.values())
+
+    # 各通道的统计
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+if __name__ == '__main__':
+    # 测试: 耗时的dump不阻塞通知，同一进程的dump不并发
+    async def runner(steps, vars):
+        for step in steps:
+            for action, param in step.items():
+                print(f"{time.strftime('%X')} start {action}")
+                await asyncio.sleep(2 if action.startswith('dump') else 0.1)
+                print(f"{time.strftime('%X')} end {action}")
+
+    executor = ActionExecutor(runner)
+    steps = [
+        {'dump_jvm_heap(app)': None},
+        {'dump_jvm_heap(app)': 'other'},
+        {'dump_jvm_heap(db)': None},
+        {'send_alert_email': None},
+    ]
+    executor.submit_steps(steps, {'alert_msg': 'test'})
+    time.sleep(5)
+    print(executor.stats())
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import threading
+import time
+from pyutilb.log import log
+
+'''
+告警去重的存储: 记录告警条件的过期时间，没过期就不处理同条件告警
+   子类要实现:
+   1 check_and_set(): 原子的检查并设置过期时间
+   2 get_expire(): 读过期时间
+   3 compact(): 干掉已过期的记录
+'''
+class AlertDedupStore(object):
+
+    def __init__(self, compact_interval = 600):
+        '''
+        :param compact_interval: 定期清理已过期记录的间隔秒数
+        '''
+        self.compact_interval = compact_interval
+        self.next_compact_time = time.time() + compact_interval
+
+    def check_and_set(self, condition, expire_sec, now = None):
+        '''
+        检查该条件的告警是否过期，过期(或之前没发生过)则设置新的过期时间
+        :param condition: 告警条件
+        :param expire_sec: 同条件的告警的过期秒数
+        :param now: 当前时间
+        :return: 是否过期，即是否要处理该告警
+        '''
+        now = now or time.time()
+        ret = self.do_check_and_set(condition, now, now + expire_sec)
+        # 定期清理
+        if now >= self.next_compact_time:
+            self.next_compact_time = now + self.compact_interval
+            try:
+                self.compact(now)
+            except Exception as ex:
+                log.error("AlertDedupStore.compact()异常: " + str(ex), exc_info=ex)
+        return ret
+
+    # 检查过期时间 < now 则设为expire_time，返回是否设置了
+    def do_check_and_set(self, condition, now, expire_time):
+        raise NotImplementedError()
+
+    # 读过期时间，没有则返回None
+    def get_expire(self, condition):
+        raise NotImplementedError()
+
+    # 干掉已过期的记录
+    def compact(self, now = None):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+'''
+内存的告警去重存储，重启后丢失，不能跨进程共享
+'''
+class MemoryDedupStore(AlertDedupStore):
+
+    def __init__(self, compact_interval = 600):
+        super(MemoryDedupStore, self).__init__(compact_interval)
+        self.expires = {} # 告警条件 -> 过期时间
+        self.lock = threading.Lock()
+
+    def do_check_and_set(self, condition, now, expire_time):
+        with self.lock:
+            expire = self.expires.get(condition)
+            if expire is not None and expire >= now: # 没过期
+                return False
+            self.expires[condition] = expire_time
+            return True
+
+    def get_expire(self, condition):
+        return self.expires.get(condition)
+
+    def compact(self, now = None):
+        now = now or time.time()
+        with self.lock:
+            self.expires = {k: v for k, v in self.expires.items() if v >= now}
+
+'''
+sqlite的告警去重存储
+   1 重启后不丢失，以免监控进程反复崩溃重启时重复发告警
+   2 同一主机上多个MonitorBoot进程共用同一个db文件，则共享去重
+   3 检查并设置是一条upsert语句，由sqlite的写锁保证跨进程原子性
+   4 告警条件是主键，检查与设置都是O(1)(btree查找)，不受条件数影响
+   5 共用db文件的多个MonitorBoot进程如果监控的是不同的对象(如不同的进程)，同一条件的告警不是同一个告警，要用namespace区分
+'''
+class SqliteDedupStore(AlertDedupStore):
+
+    def __init__(self, file = 'alert_dedup.db', compact_interval = 600, timeout = 5, namespace = None):
+        '''
+        :param file: db文件
+        :param compact_interval: 定期清理已过期记录的间隔秒数
+        :param timeout: 等待其他进程释放写锁的秒数
+        :param namespace: 告警条件的key前缀，如监控名或主机名，相同namespace的进程才共享去重，为空则所有进程共享
+        '''
+        super(SqliteDedupStore, self).__init__(compact_interval)
+        self.file = file
+        self.key_pref = f'{namespace}:' if namespace else ''
+        dir = os.path.dirname(file)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir)
+        # 自动提交，每条语句一个事务
+        self.conn = sqlite3.connect(file, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL') # 读写不互斥
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS alert_expire (condition TEXT PRIMARY KEY, expire REAL NOT NULL) WITHOUT ROWID')
+
+    def do_check_and_set(self, condition, now, expire_time):
+        condition = self.key_pref + condition
+        with self.lock:
+            # 没有记录则插入，有记录且过期则更新，没过期则不变
+            cur = self.conn.execute('INSERT INTO alert_expire (condition, expire) VALUES (?, ?) '
+                                    'ON CONFLICT (condition) DO UPDATE SET expire = excluded.expire WHERE alert_expire.expire < ?',
+                                    (condition, expire_time, now))
+            return cur.rowcount > 0
+
+    def get_expire(self, condition):
+        condition = self.key_pref + condition
+        with self.lock:
+            row = self.conn.execute('SELECT expire FROM alert_expire WHERE condition = ?', (condition,)).fetchone()
+        return row[0] if row else None
+
+    def compact(self, now = None):
+        now = now or time.time()
+        with self.lock:
+            self.conn.execute('DELETE FROM alert_expire WHERE expire < ?', (now,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# 告警去重存储的类型: 类型名 -> 类
+dedup_stores = {
+    'memory': MemoryDedupStore,
+    'sqlite': SqliteDedupStore,
+}
+
+def create_dedup_store(options):
+    '''
+    创建告警去重存储
+    :param options: 选项，包含 type(存储类型: memory/sqlite，默认sqlite)，其他选项是存储类的构造参数，如 file/compact_interval
+    :return:
+    '''
+    options = dict(options or {})
+    type = options.pop('type', 'sqlite')
+    if type not in dedup_stores:
+        raise Exception(f"无效的告警去重存储类型: {type}")
+    return dedup_stores[type](**options)
+
+if __name__ == '__main__':
+    # 测试: 10k个不同条件的检查并设置
+    store = SqliteDedupStore('/tmp/alert_dedup_test.db')
+    n = 10000
+    start = time.time()
+    for i in range(n):
+        store.check_and_set(f'sys.cpu_percent > {i}', 600)
+    print(f"SqliteDedupStore: {n / (time.time() - start):.0f} check_and_set/sec")
+    print(store.check_and_set('sys.cpu_percent > 1', 600)) # 没过期: False
+    print(store.check_and_set('sys.cpu_percent > 1', 600, time.time() + 601)) # 过期: True
+    store.close()
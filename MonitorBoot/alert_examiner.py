@@ -1,4 +1,6 @@
 import asyncio
+from MonitorBoot.alert_rule import AlertRule, AlertContext
+from MonitorBoot.sampler import metric_sampler
 from MonitorBoot.sysinfo import SysInfo
 from pyutilb import ts
 from pyutilb.cmd import get_ip
@@ -8,9 +10,10 @@ from pyutilb.util import get_var, set_var
 
 # 告警异常
 class AlertException(Exception):
-    def __init__(self, condition, msg):
+    def __init__(self, condition, msg, procs = None):
         super(AlertException, self).__init__(msg)
         self.condition = condition # 告警条件
+        self.procs = procs or [] # 告警条件中引用的进程分组名，''为未命名的进程
 
 # 告警条件的检查者
 class AlertExaminer(object):
@@ -30,138 +33,150 @@ class AlertExaminer(object):
         # 2 监控的进程的性能指标相关的条件，仅在有监控进程的情况下使用
         'proc.cpu_percent',
         'proc.mem_used',
+        'proc.mem_rss',
+        'proc.mem_pss',
         'proc.mem_percent',
         'proc.disk_read',
         'proc.disk_write',
 
         # 3 gc指标相关的条件，仅在有监控gc log的情况下使用
         'ygc.costtime',
+        'ygc.interval',
+        'ygc.count',
         'fgc.costtime',
         'fgc.interval',
+        'fgc.count',
+
+        # 4 gc衍生指标相关的条件，仅在有监控gc log的情况下使用
+        'gc.alloc_rate',
+        'gc.promotion_rate',
+        'gc.old_after',
+        'gc.old_after_slope',
+        'gc.pause_p50',
+        'gc.pause_p99',
+        'gc.pause_max',
+        'gc.ygc_p99',
+        'gc.fgc_p99',
+
+        # 5 告警动作的执行器相关的条件
+        'executor.queue_size',
+        'executor.running',
+        'executor.wait_time',
+        'executor.dropped',
     ]
 
-    # 操作符函数映射
-    ops = {
-        '=': lambda val, param: float(val) == float(param),
-        '>': lambda val, param: float(val) > float(param),
-        '<': lambda val, param: float(val) < float(param),
-        '>=': lambda val, param: float(val) >= float(param),
-        '<=': lambda val, param: float(val) <= float(param),
-    }
-
     def __init__(self, boot):
         self.boot = boot
+        # 编译后的告警规则: 告警条件 -> AlertRule，每个条件只编译一次，编译失败则为None
+        self.rules = {}
+        # 窗口函数的滚动窗口: (表达式, 窗口秒数) -> RollingWindow，多个条件共用
+        self.windows = {}
+
+    # 编译告警条件，有缓存: 编译失败也缓存，只打印一次异常，以免每次检查都重新解析并刷屏，返回None
+    def compile(self, condition):
+        if condition in self.rules:
+            return self.rules[condition]
+        try:
+            rule = AlertRule(condition, self.alert_cols, self.windows)
+        except Exception as ex:
+            log.error("编译告警条件[" + condition + "]错误, 该条件将被忽略: " + str(ex), exc_info=ex)
+            rule = None
+        self.rules[condition] = rule
+        return rule
 
-    def run(self, condition):
+    # 新建检查上下文: 同一次告警动作的多个条件共用一个上下文，以便共享操作对象与字段值
+    def new_context(self):
+        return AlertContext(self.get_op_object)
+
+    def run(self, condition, ctx = None):
         '''
         检查单个告警条件，如果符合条件，则抛出报警异常
-        :param condition: 告警的条件表达式，只支持简单的三元表达式，操作符只支持 =, <, >, <=, >=
+        :param condition: 告警的条件表达式，支持 and/or/not、括号、字段间的四则运算、带单位的常量、窗口函数、持续子句，比较操作符有 =, ==, !=, <, >, <=, >=
                如 mem_free <= 1024M
+               如 proc.mem_used / sys.mem_used > 0.5 and ygc.costtime > 500ms
+               如 avg(sys.cpu_percent, 60s) > 90 for 2m
+        :param ctx: 检查上下文，为空则新建
         '''
+        rule = self.compile(condition)
+        if rule is None: # 编译失败，已打印过异常
+            return
         try:
-            # 分割字段+操作符+值
-            col, op, param = self.parse_condition(condition)
-            # 获得col所在的对象
-            if '.' not in col:
-                col = 'sys.' + col
-            if col not in self.alert_cols:
-                raise Exception('无效告警字段: ' + col)
-            obj_name, col2 = col.split('.', 1)
-            obj = self.get_op_object(obj_name)
-            if obj is None:
-                return
-
-            # 读col值
-            val = self.get_col_val(obj, col2)
-            if obj_name.endswith('gc') and col2 == 'interval' and val == 0: # 第一次gc是interval=0, 是没有意义的, 直接跳过
-                return
-
-            # 执行操作符函数
-            ret = bool(self.run_op(op, val, param))
+            if ctx is None:
+                ctx = self.new_context()
+            msg = rule.eval(ctx)
         except Exception as ex:
             log.error("执行告警条件[" + condition + "]错误: " + str(ex), exc_info=ex)
             return
 
-        if ret:
-            msg = f"主机[{get_ip()}]在{ts.now2str()}时发生告警: {col}({val}) {op} {param}"
-            raise AlertException(condition, msg)
-
-    # 解析条件：分割字段+操作符+值
-    def parse_condition(self, condition):
-        # 1. 空格分割: wrong 有可能无空格
-        # return re.split(r'\s+', condition.strip(), 3)
+        if msg is not None:
+            msg = f"主机[{get_ip()}]在{ts.now2str()}时发生告警: {msg}"
+            procs = sorted(key or '' for name, key in rule.objs if name == 'proc')
+            raise AlertException(condition, msg, procs)
 
-        # 2. 三元素正则匹配
-        mat = re.match('([\w\.]+)\s*([><=]+)\s*(\d+\w?)', condition.strip())
-        if mat is None:
-            raise Exception("无效条件表达式: " + condition)
-
-        return mat.group(1), mat.group(2), mat.group(3)
-
-    # 获得条件的操作对象: sys+proc 是必填，ygc+fgc非必填
-    def get_op_object(self, obj_name):
+    def get_op_object(self, obj_name, obj_key = None):
+        '''
+        获得条件的操作对象: sys+proc 是必填，ygc+fgc+gc非必填，executor是告警动作的执行器
+        :param obj_name: 对象名
+        :param obj_key: 对象key，如proc的进程分组名，为空则取默认进程
+        '''
         if 'sys' == obj_name:
             sys = get_var('sys')
             if sys is None: # 必填
                 raise Exception('未准备sys变量')
             return sys
 
-        if 'proc' == obj_name:
-            if self.boot._proc is None: # 必填
-                raise Exception("没用使用动作 monitor_pid/grep_pid 来监控进程")
-            return self.boot._proc
+        if 'proc' == obj_name: # 必填，没有监控进程则抛异常
+            return self.boot.get_proc(obj_key)
 
         if 'ygc' == obj_name:
             return self.boot.get_current_gc(False)
 
         if 'fgc' == obj_name:
             return self.boot.get_current_gc(True)
-        raise Exception(f"Invalid object name: {obj_name}")
 
-    # 从操作对象中获得指定字段值
-    def get_col_val(self, obj, col):
-        # dict类型: ygc+fgc
-        if isinstance(obj, dict):
-            return obj[col]
-
-        # 对象类型: sys+proc
-        return getattr(obj, col)
-
-    def run_op(self, op, val, param):
-        '''
-        执行操作符：就是调用函数
-        :param op: 操作符
-        :param val: 校验的值
-        :param param: 参数
-        :return:
-        '''
-        # 处理参数: 文件大小字符串换算为字节数
-        if param[-1] in file_size_units:
-           param = file_size2bytes(param)
-        # 校验操作符
-        if op not in self.ops:
-            raise Exception(f'无效校验符: {op}')
-        # 调用校验函数
-        # log.debug(f"Call operator: %s=%s", op, param)
-        op = self.ops[op]
-        return op(val, param)
+        if 'gc' == obj_name:
+            return self.boot.get_gc_metrics()
 
+        if 'executor' == obj_name:
+            return self.boot.action_executor
+        raise Exception(f"Invalid object name: {obj_name}")
 
 async def test():
-    sys = await SysInfo().presleep_all_fields()
-    set_var('sys', sys)
+    await metric_sampler.warmup()
+    set_var('sys', SysInfo())
     boot = None
     e = AlertExaminer(boot)
     e.run(condition)
 
 if __name__ == '__main__':
     condition = ' sys.net_sent >=10M '
-    '''
-    mat = re.match('([\w\.]+)\s*([><=]+)\s*(\d+\w?)', condition.strip())
-    print(mat)
-    for i in range(1, 4):
-        print(mat.group(i))
-    '''
     asyncio.run(test())
 
-
+    # 测试编译后的告警规则的性能: 1k条规则对单个样本的检查次数/秒
+    '''
+    import time
+    class Sample(object):
+        cpu_percent = 50.0
+        mem_used = 2048 * 1024 * 1024
+        mem_free = 1024 * 1024 * 1024
+        disk_read = 1024 * 1024
+    samples = {'sys': Sample(), 'proc': Sample()}
+    e = AlertExaminer(None)
+    e.get_op_object = lambda name, key: samples[name]
+    conditions = []
+    for i in range(1000):
+        conditions.append([
+            f'cpu_percent >= {90 + i % 10}',
+            f'sys.mem_free <= {i}M',
+            f'proc.mem_used / sys.mem_used > 0.{i % 10 + 1} and sys.disk_read > {i}K',
+            f'(sys.cpu_percent + proc.cpu_percent) / 2 > {i} or proc.mem_used > 100G',
+        ][i % 4])
+    rules = [e.compile(c) for c in conditions]
+    n = 100
+    start = time.time()
+    for i in range(n):
+        ctx = e.new_context() # 每轮是一个新样本
+        for rule in rules:
+            rule.eval(ctx)
+    print(f"AlertRule: {n * len(rules) / (time.time() - start):.0f} evals/sec")
+    '''
@@ -0,0 +1,452 @@
+import operator
+import re
+import time
+from pyutilb import ts
+from pyutilb.file import file_size_units, file_size_unit2bytes
+from MonitorBoot.rolling_window import RollingWindow, is_agg_func
+
+'''
+告警规则的编译器：将告警条件编译为闭包树，只编译一次，之后每次检查只是调用闭包
+   1 语法: 支持 and/or/not、括号、字段间的四则运算(如 proc.mem_used / sys.mem_used > 0.5)、带单位的常量(如 1024M、500ms、10s)
+   2 字段: 对象名[对象key].字段名，如 sys.cpu_percent、proc[order-svc].cpu_percent、ygc.costtime；没有对象名的默认是sys对象
+   3 空值: 字段值为None(如当前没有gc)时，参与的运算结果为None，参与的比较结果为False
+   4 窗口函数: 聚合函数(表达式, 窗口时长)，如 avg(sys.cpu_percent, 60s)、p95(ygc.costtime, 5m)、rate(fgc.count, 10m)，
+     每次检查时将表达式的当前值记录到滚动窗口中，聚合值由窗口增量维护，不用重新扫描历史
+   5 持续子句: 条件 for 时长，如 sys.cpu_percent > 90 for 2m，条件要持续成立该时长才告警
+'''
+
+# 词法的正则: 数值(带单位) | 字段/关键字 | 操作符
+token_reg = re.compile(r'\s*(?:(\d+(?:\.\d+)?)([A-Za-z%]*)|(\w+(?:\[[^\]]*\])?(?:\.\w+)*)|(>=|<=|==|!=|[<>=()+\-*/%,]))')
+
+# 字段的正则: 对象名[对象key].字段名
+field_reg = re.compile(r'(\w+)(?:\[([^\]]*)\])?\.(\w+)$')
+
+# 比较操作符
+cmp_ops = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '<': operator.lt,
+    '>=': operator.ge,
+    '<=': operator.le,
+}
+
+# 算术操作符
+arith_ops = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '%': operator.mod,
+}
+
+# 解析带单位的常量: 文件大小单位(B/K/M/G/T)换算为字节数，时间单位(ms/s/m/h/d)换算为秒数，%忽略
+def parse_const(num, unit):
+    val = float(num)
+    if unit == '' or unit == '%':
+        return val
+    if len(unit) == 1 and unit in file_size_units: # file_size_units是字符串，子串判断会放过KM之类的错误单位
+        return val * file_size_unit2bytes(unit)
+    if unit == 'ms':
+        return val / 1000
+    if unit in ts.age_unit2seconds:
+        return val * ts.age_unit2seconds[unit]
+    raise Exception(f"无效单位: {num}{unit}")
+
+'''
+告警条件的检查上下文: 缓存操作对象与字段值，同一次检查中多个条件引用的同一字段只读一次
+   dict的key是字段(对象名, 对象key, 字段名)，value是字段值
+'''
+class AlertContext(dict):
+
+    def __init__(self, get_op_object, objs = None):
+        '''
+        :param get_op_object: 获得操作对象的函数，参数为 (对象名, 对象key)
+        :param objs: 已绑定的操作对象: (对象名, 对象key) -> 对象
+        '''
+        super(AlertContext, self).__init__()
+        self.get_op_object = get_op_object
+        self.objs = objs if objs is not None else {}
+        self.token = object() # 标识本次检查，用于窗口中同一样本只记录一次
+        self.now = time.time()
+
+    # 获得操作对象
+    def obj(self, name, key):
+        k = (name, key)
+        if k not in self.objs:
+            self.objs[k] = self.get_op_object(name, key)
+        return self.objs[k]
+
+    # 复制上下文，并绑定对象，用于逐个检查一批gc
+    def bind(self, name, key, obj):
+        objs = dict(self.objs)
+        objs[(name, key)] = obj
+        ctx = AlertContext(self.get_op_object, objs)
+        ctx.token = self.token
+        ctx.now = self.now
+        return ctx
+
+    # 读字段值
+    def __missing__(self, field):
+        name, key, col = field
+        obj = self.obj(name, key)
+        if obj is None:
+            val = None
+        elif isinstance(obj, list): # 一批gc在 AlertRule.eval() 中逐个绑定，此处不会出现
+            raise Exception(f"对象[{name}]未绑定")
+        elif isinstance(obj, dict): # dict类型: ygc+fgc
+            val = obj[col]
+            if col == 'interval' and val == 0: # 第一次gc是interval=0, 是没有意义的, 视为空值
+                val = None
+        else: # 对象类型: sys+proc
+            val = getattr(obj, col)
+        if val is not None:
+            val = float(val)
+        self[field] = val
+        return val
+
+# ---- 闭包树的节点: 每个节点有 fn(ctx) 求值，有 render(ctx) 渲染告警消息 ----
+# 常量
+class Const(object):
+
+    def __init__(self, val, text):
+        self.text = text
+        self.fn = lambda ctx: val
+
+    def render(self, ctx):
+        return self.text
+
+# 字段
+class Field(object):
+
+    def __init__(self, name, key, col, text):
+        self.text = text
+        self.obj_key = (name, key)
+        field = (name, key, col)
+        self.fn = lambda ctx: ctx[field]
+
+    def render(self, ctx):
+        val = self.fn(ctx)
+        if isinstance(val, float) and val.is_integer():
+            val = int(val)
+        return f"{self.text}({val})"
+
+# 二元运算: 算术、比较、and/or
+class BinOp(object):
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+        lfn = left.fn
+        rfn = right.fn
+        if op == 'and':
+            self.fn = lambda ctx: bool(lfn(ctx)) and bool(rfn(ctx))
+        elif op == 'or':
+            self.fn = lambda ctx: bool(lfn(ctx)) or bool(rfn(ctx))
+        elif op in cmp_ops:
+            f = cmp_ops[op]
+            def fn(ctx):
+                a = lfn(ctx)
+                if a is None:
+                    return False
+                b = rfn(ctx)
+                if b is None:
+                    return False
+                return f(a, b)
+            self.fn = fn
+        else:
+            f = arith_ops[op]
+            def fn(ctx):
+                a = lfn(ctx)
+                if a is None:
+                    return None
+                b = rfn(ctx)
+                if b is None or (b == 0 and op in '/%'): # 除0视为空值
+                    return None
+                return f(a, b)
+            self.fn = fn
+
+    def render(self, ctx):
+        # and/or 只渲染成立的部分
+        if self.op == 'or':
+            return self.left.render(ctx) if self.left.fn(ctx) else self.right.render(ctx)
+        return f"{self.left.render(ctx)} {self.op} {self.right.render(ctx)}"
+
+# 一元运算: not、负号
+class UnaryOp(object):
+
+    def __init__(self, op, operand):
+        self.op = op
+        self.operand = operand
+        ofn = operand.fn
+        if op == 'not':
+            self.fn = lambda ctx: not ofn(ctx)
+        else:
+            def fn(ctx):
+                v = ofn(ctx)
+                return None if v is None else -v
+            self.fn = fn
+
+    def render(self, ctx):
+        return f"{self.op} {self.operand.render(ctx)}" if self.op == 'not' else f"-{self.operand.render(ctx)}"
+
+# 窗口函数: 聚合函数(表达式, 窗口时长)
+class Window(object):
+
+    def __init__(self, func, inner, window, objs, text):
+        '''
+        :param func: 聚合函数名
+        :param inner: 表达式节点
+        :param window: 滚动窗口，同一表达式+时长的多个窗口函数共用一个窗口
+        :param objs: 表达式引用的对象
+        :param text: 文本
+        '''
+        self.text = text
+        self.inner = inner
+        self.window = window
+        self.objs = list(objs)
+        self.fn = lambda ctx: window.agg(func)
+
+    # 记录表达式的当前值到窗口中
+    def feed(self, ctx):
+        # 同一次检查中同一对象(如同一个gc)的样本只记录一次
+        key = (ctx.token, tuple(id(ctx.obj(name, k)) for name, k in self.objs))
+        if self.window.last_key == key:
+            return
+        self.window.last_key = key
+        val = self.inner.fn(ctx)
+        if val is not None:
+            self.window.append(val, ctx.now)
+
+    def render(self, ctx):
+        val = self.fn(ctx)
+        if isinstance(val, float):
+            val = round(val, 4)
+        return f"{self.text}({val})"
+
+# 分组: 括号
+class Group(object):
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.fn = inner.fn
+
+    def render(self, ctx):
+        return f"({self.inner.render(ctx)})"
+
+'''
+告警规则: 编译后的告警条件
+'''
+class AlertRule(object):
+
+    def __init__(self, condition, alert_cols, windows = None):
+        '''
+        编译告警条件
+        :param condition: 告警条件，如 proc.mem_used / sys.mem_used > 0.5 and sys.cpu_percent >= 90
+        :param alert_cols: 合法的告警字段
+        :param windows: 滚动窗口的注册表: (表达式, 窗口秒数) -> RollingWindow，用于多个条件共用窗口
+        '''
+        self.condition = condition
+        self.alert_cols = alert_cols
+        self.windows = windows if windows is not None else {}
+        self.tokens = self.tokenize(condition)
+        self.pos = 0
+        self.objs = set() # 引用的对象: (对象名, 对象key)
+        self.obj_stack = [] # 正在解析的窗口函数的引用对象
+        self.window_nodes = [] # 窗口函数节点
+        self.root = self.parse_or()
+        # 持续子句
+        self.sustain = None # 持续秒数
+        self.true_since = None # 条件开始成立的时间
+        if self.peek()[1] == 'for':
+            self.next()
+            type, text, val = self.next()
+            if type != 'const':
+                raise Exception(f"无效条件表达式: {condition}, for后面要跟时长")
+            self.sustain = val
+            self.sustain_text = text
+        if self.pos < len(self.tokens):
+            raise Exception(f"无效条件表达式: {condition}, 多余的[{self.tokens[self.pos][1]}]")
+        del self.tokens
+        self.fn = self.root.fn
+
+    # 词法分析: 返回 (类型, 文本, 值) 的list
+    def tokenize(self, condition):
+        tokens = []
+        pos = 0
+        condition = condition.rstrip()
+        while pos < len(condition):
+            mat = token_reg.match(condition, pos)
+            if mat is None or mat.end() == pos:
+                raise Exception(f"无效条件表达式: {condition}, 位置{pos}")
+            num, unit, word, op = mat.groups()
+            if num is not None:
+                tokens.append(('const', num + unit, parse_const(num, unit)))
+            elif word is not None:
+                if word in ('and', 'or', 'not', 'for'):
+                    tokens.append(('op', word, None))
+                else:
+                    tokens.append(('field', word, None))
+            else:
+                tokens.append(('op', op, None))
+            pos = mat.end()
+        return tokens
+
+    # 看当前词
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None, None
+
+    # 读当前词
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    # or表达式
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek()[1] == 'or':
+            self.next()
+            node = BinOp('or', node, self.parse_and())
+        return node
+
+    # and表达式
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek()[1] == 'and':
+            self.next()
+            node = BinOp('and', node, self.parse_not())
+        return node
+
+    # not表达式
+    def parse_not(self):
+        if self.peek()[1] == 'not':
+            self.next()
+            return UnaryOp('not', self.parse_not())
+        return self.parse_cmp()
+
+    # 比较表达式
+    def parse_cmp(self):
+        node = self.parse_arith()
+        type, text, _ = self.peek()
+        if type == 'op' and text in cmp_ops:
+            self.next()
+            node = BinOp(text, node, self.parse_arith())
+        return node
+
+    # 加减表达式
+    def parse_arith(self):
+        node = self.parse_term()
+        while self.peek()[1] in ('+', '-'):
+            node = BinOp(self.next()[1], node, self.parse_term())
+        return node
+
+    # 乘除表达式
+    def parse_term(self):
+        node = self.parse_factor()
+        while self.peek()[1] in ('*', '/', '%'):
+            node = BinOp(self.next()[1], node, self.parse_factor())
+        return node
+
+    # 因子: 常量/字段/括号/负号
+    def parse_factor(self):
+        type, text, val = self.next()
+        if type == 'const':
+            return Const(val, text)
+        if type == 'field':
+            if self.peek()[1] == '(': # 窗口函数
+                return self.parse_window(text)
+            return self.parse_field(text)
+        if text == '-':
+            return UnaryOp('-', self.parse_factor())
+        if text == '(':
+            node = self.parse_or()
+            if self.next()[1] != ')':
+                raise Exception(f"无效条件表达式: {self.condition}, 缺少)")
+            return Group(node)
+        raise Exception(f"无效条件表达式: {self.condition}, 非预期的[{text}]")
+
+    # 字段
+    def parse_field(self, text):
+        if '.' not in text:
+            text = 'sys.' + text
+        mat = field_reg.match(text)
+        if mat is None:
+            raise Exception('无效告警字段: ' + text)
+        name, key, col = mat.groups()
+        if f"{name}.{col}" not in self.alert_cols:
+            raise Exception('无效告警字段: ' + text)
+        self.objs.add((name, key))
+        for objs in self.obj_stack:
+            objs.add((name, key))
+        return Field(name, key, col, text)
+
+    # 窗口函数: 聚合函数(表达式, 窗口时长)
+    def parse_window(self, func):
+        if not is_agg_func(func):
+            raise Exception(f"无效窗口函数: {func}")
+        self.next() # (
+        start = self.pos
+        objs = set()
+        self.obj_stack.append(objs)
+        inner = self.parse_or()
+        self.obj_stack.pop()
+        # 表达式文本: 补全字段的默认对象名，以便 cpu_percent 与 sys.cpu_percent 共用窗口
+        expr = ' '.join('sys.' + t[1] if t[0] == 'field' and '.' not in t[1] else t[1] for t in self.tokens[start:self.pos])
+        if self.next()[1] != ',':
+            raise Exception(f"无效条件表达式: {self.condition}, 窗口函数{func}()缺少窗口时长")
+        type, text, seconds = self.next()
+        if type != 'const':
+            raise Exception(f"无效条件表达式: {self.condition}, 窗口函数{func}()的窗口时长无效")
+        if self.next()[1] != ')':
+            raise Exception(f"无效条件表达式: {self.condition}, 缺少)")
+        # 同一表达式+时长的窗口共用
+        key = (expr, seconds)
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = RollingWindow(seconds)
+        node = Window(func, inner, window, objs, f"{func}({expr}, {text})")
+        self.window_nodes.append(node)
+        return node
+
+    def eval(self, ctx):
+        '''
+        检查告警条件
+        :param ctx: 检查上下文 AlertContext
+        :return: 成立则返回告警消息，否则返回None
+        '''
+        msg = self.match(ctx)
+        if self.sustain is None:
+            return msg
+        # 持续子句: 条件要持续成立一段时间才告警
+        if msg is None:
+            self.true_since = None
+            return None
+        if self.true_since is None:
+            self.true_since = ctx.now
+        if ctx.now - self.true_since < self.sustain:
+            return None
+        return f"{msg} for {self.sustain_text}"
+
+    # 匹配条件
+    def match(self, ctx):
+        # 批量模式下，gc操作对象是一批gc，逐个检查，有一个符合条件就告警
+        for name, key in self.objs:
+            obj = ctx.obj(name, key)
+            if isinstance(obj, list):
+                msg = None
+                for item in obj: # 匹配后也要继续，以便窗口记录所有gc
+                    ret = self.match(ctx.bind(name, key, item))
+                    if msg is None:
+                        msg = ret
+                return msg
+        # 先记录窗口的样本，再检查条件，以免and/or短路导致窗口漏记样本
+        for node in self.window_nodes:
+            node.feed(ctx)
+        if self.fn(ctx):
+            return self.root.render(ctx)
+        return None
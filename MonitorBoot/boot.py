@@ -14,17 +14,24 @@ from pyutilb.tail import Tail
 from pyutilb.util import *
 from pyutilb.file import *
 from pyutilb.cmd import *
-from pyutilb import YamlBoot, EventLoopThreadPool, ts
+from pyutilb import YamlBoot, ts
 from pyutilb.log import log
-from MonitorBoot import emailer
+from MonitorBoot import emailer, jvm_dumper
+from MonitorBoot.action_executor import ActionExecutor
+from MonitorBoot.alert_dedup import MemoryDedupStore, create_dedup_store
 from MonitorBoot.alert_examiner import AlertException, AlertExaminer
-from MonitorBoot.gc_log_parser import GcLogParser
+from MonitorBoot.csv_writer import CsvWriter
+from MonitorBoot.metric_store import MetricStore, sys_cols, proc_cols, gc_cols, gc_metric_cols
+from MonitorBoot.metrics_exporter import MetricsExporter
+from MonitorBoot.gc_log_parser import GcLogParser, GcLogTail
 from MonitorBoot.procinfo import ProcInfo
-from MonitorBoot.procstat import all_proc_stat2xlsx
+from MonitorBoot.procstat import ProcStat, all_proc_stat2report
+from MonitorBoot.proc_watcher import ProcWatcher, proc_index
+from MonitorBoot.sampler import metric_sampler
 from MonitorBoot.sysinfo import SysInfo
-
-# 协程线程池
-pool = EventLoopThreadPool(1)
+from MonitorBoot.tail_batcher import TailBatcher, BatchTail
+from MonitorBoot.thread_profiler import profile_threads
+from MonitorBoot.thread_dump_parser import ThreadDumpHistory, parse_thread_dump, hot_threads, save_analysis
 
 # 基于yaml的监控器
 class MonitorBoot(YamlBoot):
@@ -34,6 +41,10 @@ class MonitorBoot(YamlBoot):
         # 动作映射函数
         actions = {
             'config_email': self.config_email,
+            'config_executor': self.config_executor,
+            'config_alert_dedup': self.config_alert_dedup,
+            'config_csv': self.config_csv,
+            'config_dump': self.config_dump,
             'send_email': self.send_email,
             'schedule': self.schedule,
             'tail': self.tail,
@@ -46,10 +57,14 @@ class MonitorBoot(YamlBoot):
             # 异步动作
             'dump_jvm_heap': self.dump_jvm_heap,
             'dump_jvm_thread': self.dump_jvm_thread,
+            'dump_jvm_hot_threads': self.dump_jvm_hot_threads,
+            'profile_threads': self.profile_threads,
             'dump_jvm_gcs_xlsx': self.dump_jvm_gcs_xlsx,
             'dump_all_proc_xlsx': self.dump_all_proc_xlsx,
             'dump_sys_csv': self.dump_sys_csv,
             'dump_1proc_csv': self.dump_1proc_csv,
+            'dump_metrics': self.dump_metrics,
+            'expose_metrics': self.expose_metrics,
             'compare_gc_logs': self.compare_gc_logs,
             # 结束
             'stop_after': self.stop_after,
@@ -63,28 +78,56 @@ class MonitorBoot(YamlBoot):
         self.scheduler._eventloop = self.loop  # 调度器的loop = 线程的loop, 否则线程无法处理调度器的定时任务
         self.scheduler.start()
 
+        # 启动指标采样器: 每个周期统一采样一次，所有步骤共享，不用各自睡1s
+        metric_sampler.start(self.scheduler)
+
         # tail跟踪
         self.tails = {}
 
         # gc日志解析器，只支持解析单个日志，没必要支持解析多个日志
         self.gc_parser = None
 
-        # 进程信息
-        self._pid = None
-        self._pid_grep = None
-        self._proc = None
+        # 监控的进程: 进程分组名 -> ProcInfo，未命名的(默认)进程的分组名为空字符串
+        self._procs = {}
+        # 监控的进程的grep关键字: 进程分组名 -> grep关键字
+        self._pid_greps = {}
+        # 进程退出的监听器: 监控的进程退出时立即触发 when_no_run
+        self.proc_watcher = ProcWatcher(self.loop)
+        # 线程栈的历史: pid -> ThreadDumpHistory，用于跨多次dump检测锁护航
+        self.thread_dump_histories = {}
 
         # ----- 告警处理 -----
         # 告警条件的检查者
         self.alert_examiner = AlertExaminer(self)
 
-        # 记录告警条件的过期时间, key是告警条件(表示类型), value是过期时间，没过期就不处理告警，用来限制同条件的告警的处理频率，如限制导出进程xlsx或发邮件
-        self.alert_condition_expires = {}
+        # 告警去重存储: 记录告警条件的过期时间，没过期就不处理告警，用来限制同条件的告警的处理频率，如限制导出进程xlsx或发邮件
+        # 默认存内存，可用 config_alert_dedup 动作改为存sqlite，以便重启后不丢失+多进程共享
+        self.alert_dedup_store = MemoryDedupStore()
+
+        # 告警动作的执行器: 耗时的动作(如dump)扔到其他线程执行，且不阻塞通知类动作(如发邮件)
+        self.action_executor = ActionExecutor(self.run_steps_async)
+
+        # ----- 导出csv -----
+        # csv写入器: key -> CsvWriter，长期持有打开的文件
+        self.csv_writers = {}
+        # csv写入器的选项
+        self.csv_options = {}
+        # 指标的时序存储，由 dump_metrics 动作创建
+        self.metric_store = None
+        # 指标的http暴露，由 expose_metrics 动作创建
+        self.metrics_exporter = None
 
     # 执行完的后置处理
     def on_end(self):
-        # 死循环处理s
-        self.loop.run_forever()
+        try:
+            # 死循环处理s
+            self.loop.run_forever()
+        finally:
+            # 结束(含ctrl+c)时关闭csv写入器与指标存储: 刷盘+fsync
+            self.close_csv_writers()
+            self.proc_watcher.close()
+            if self.metric_store is not None:
+                self.metric_store.close()
 
     # -------------------------------- 普通动作 -----------------------------------
     # 睡眠
@@ -105,32 +148,70 @@ class MonitorBoot(YamlBoot):
         config = replace_var(config, False)
         emailer.config_email(config)
 
+    # 配置jvm dump，参考 jvm_dumper.config
+    def config_dump(self, config):
+        config = replace_var(config, False)
+        jvm_dumper.config_dump(config)
+
+    # 配置告警动作的执行器，参考 ActionExecutor.config()
+    def config_executor(self, options):
+        self.action_executor.config(options or {})
+
+    # 配置告警去重存储，参考 create_dedup_store()
+    def config_alert_dedup(self, options):
+        self.alert_dedup_store.close()
+        self.alert_dedup_store = create_dedup_store(options)
+
+    def config_csv(self, options):
+        '''
+        配置导出csv的写入器，必须在导出csv前调用
+        :param options: 选项，包含
+                    flush_rows: 每写多少行刷盘一次，默认100
+                    flush_seconds: 最多隔多少秒刷盘一次，默认5
+                    compress: 压缩格式: gzip/zstd，默认不压缩
+        '''
+        options = options or {}
+        self.csv_options = {
+            'flush_rows': int(options.get('flush_rows', 100)),
+            'flush_seconds': float(options.get('flush_seconds', 5)),
+            'compress': options.get('compress'),
+        }
+
     # 发送邮件
     def send_email(self, params):
-        self.do_send_email(params['title'], params['msg'])
+        return self.do_send_email(params['title'], params['msg'])
 
-    # 真正的发邮件
+    # 真正的发邮件: 事件循环还没运行(如在顶层步骤中)则同步发送，否则返回协程，异步发送，不阻塞事件循环
     def do_send_email(self, title, msg):
         if self.debug:
             log.info(f"----- 调试模式下模拟发邮件: title = %s, msg = %s -----", title, msg)
             return
+        if get_running_loop() is not None:
+            return self.do_send_email_async(title, msg)
         try:
             emailer.send_email(title, msg)
         except Exception as ex:
             log.error("MonitorBoot.do_send_email()异常: " + str(ex), exc_info=ex)
 
+    # 异步发邮件
+    async def do_send_email_async(self, title, msg):
+        try:
+            await emailer.send_email_async(title, msg)
+        except Exception as ex:
+            log.error("MonitorBoot.do_send_email()异常: " + str(ex), exc_info=ex)
+
     async def run_steps_async(self, steps, vars = {}, serial = True):
         '''
         异步执行步骤
-            主要是优化 psutil.cpu_percent(1) 的阻塞 + when_alert 耗时操作 所带来的性能问题，要扔到eventloop所在的线程中运行
+            主要是优化 when_alert 耗时操作 所带来的性能问题，要扔到eventloop所在的线程中运行
             因为要扔到其他线程执行，导致不能直接使用调用线程的变量，因此需要通过 vars 参数来传递
         :param steps: 要执行的步骤
         :param vars: 传递调用线程中的变量
         :param serial: 是否串行执行，否则并行执行(一般用于执行 when_alert 耗时操作)
         :return:
         '''
-        # 提前预备好SysInfo
-        vars['sys'] = await SysInfo().presleep_fields_in_steps(steps)
+        # 准备SysInfo: 指标取自采样器的最近快照，无需睡眠
+        vars['sys'] = SysInfo()
 
         # 应用变量，因为变量是在ThreadLocal中，只能在同步代码中应用
         with UseVars(vars):
@@ -166,7 +247,7 @@ class MonitorBoot(YamlBoot):
                 if coroutines.iscoroutine(ret):
                     async_rets.append(ret)
         # 等待所有结果
-        await asyncio.gather(async_rets)
+        await asyncio.gather(*async_rets)
 
     def schedule(self, steps, wait_seconds):
         '''
@@ -177,29 +258,51 @@ class MonitorBoot(YamlBoot):
         '''
         self.scheduler.add_job(self.run_steps_async, 'interval', args=(steps,), seconds=int(wait_seconds), next_run_time=datetime.datetime.now())
 
-    def tail(self, steps, file):
+    def tail(self, steps, file, batch_lines = None, batch_ms = None):
         '''
         监控文件内容追加，常用于订阅日志变更
            变量 tail_line 记录读到的行
+           批量模式下(指定了batch_lines或batch_ms)，变量 tail_lines 记录读到的一批行，变量 tail_line 记录该批的最后一行
         :param steps: 每次定时要执行的步骤
         :param file: 文件路径
+        :param batch_lines: 批量模式下每批最多行数，默认500
+        :param batch_ms: 批量模式下每批最多等待毫秒数，默认200
         :return:
         '''
-        async def read_line(line):
+        # 1 逐行模式
+        if not batch_lines and not batch_ms:
+            async def read_line(line):
+                # 将行塞到变量中，以便子步骤能读取
+                vars = {'tail_line': line}
+                # 执行子步骤
+                await self.run_steps_async(steps, vars)
+            self.do_tail(file, read_line)
+            return
+
+        # 2 批量模式: 一批行只执行一次子步骤(含告警)
+        async def read_lines(lines):
             # 将行塞到变量中，以便子步骤能读取
-            vars = {'tail_line': line}
+            vars = {
+                'tail_lines': lines,
+                'tail_line': lines[-1]
+            }
             # 执行子步骤
             await self.run_steps_async(steps, vars)
-        self.do_tail(file, read_line)
+        batcher = TailBatcher(read_lines, batch_lines, batch_ms)
+        self.do_tail(file, batcher.add, True)
 
-    def do_tail(self, file, callback):
+    def do_tail(self, file, callback, batch = False):
         '''
         监控文件内容追加，常用于订阅日志变更
         :param file: 文件路径
         :param callback: 回调
+        :param batch: 是否批量模式，批量模式下每次定时读完所有新增的行
         :return:
         '''
-        t = Tail(file, self.scheduler)
+        if batch:
+            t = BatchTail(file, self.scheduler)
+        else:
+            t = Tail(file, self.scheduler)
         self.tails[file] = t
         t.follow(callback)
 
@@ -223,9 +326,10 @@ class MonitorBoot(YamlBoot):
 
         try:
             # 1 逐个表达式来执行告警，如果报警发生则报异常
+            ctx = self.alert_examiner.new_context() # 多个条件共用上下文，同一字段只读一次
             for condition in conditions:
                 condition = condition.lstrip()
-                self.alert_examiner.run(condition)
+                self.alert_examiner.run(condition, ctx)
         except AlertException as ex:
             # 2 处理告警异常：异常=告警发生
             await self.handle_alert_exception(ex, int(expire_sec))
@@ -244,8 +348,9 @@ class MonitorBoot(YamlBoot):
         # 检查该条件的告警是否没过期, 是的话就不处理同条件(同类)异常
         condition = ex.condition
         if not self.check_alert_expired(condition, expire_sec):
-            if condition in self.alert_condition_expires:
-                print("过期时间为: "+ ts.timestamp2str(self.alert_condition_expires[condition]))
+            expire = self.alert_dedup_store.get_expire(condition)
+            if expire is not None:
+                log.info("告警条件[%s]的过期时间为: %s", condition, ts.timestamp2str(expire))
             log.info(f"在%s秒内忽略同条件[%s]的告警", expire_sec, condition)
             return
 
@@ -262,10 +367,11 @@ class MonitorBoot(YamlBoot):
             vars = {
                 'alert_msg': msg,
                 'alert_dir': dir,
+                'alert_proc': ex.procs[0] if ex.procs else None, # 告警条件中的进程分组名，dump动作默认导出该进程
             }
-            # 执行when_alert动作
+            # 执行when_alert动作: 拆分为单个动作，扔到执行器中排队并发执行
             # await self.run_steps_async(steps, vars)
-            pool.exec(self.run_steps_async, steps, vars) # 耗时操作扔到线程池执行
+            self.action_executor.submit_steps(steps, vars)
 
     def check_alert_expired(self, condition, expire_sec):
         '''
@@ -274,15 +380,12 @@ class MonitorBoot(YamlBoot):
         :param expire_sec: 同条件的告警的过期秒数(默认600秒)，没过期就不处理同条件告警，用于限制同条件的告警的处理频率
         :return:
         '''
-        now = time.time()
-        # 没过期时间(之前没发生过同条件告警) or 过期了
-        ret = condition not in self.alert_condition_expires \
-                or self.alert_condition_expires[condition] < now  # 过期了
-
-        # 过期后，要更新过期时间
-        if ret:
-            self.alert_condition_expires[condition] = now + expire_sec
-        return ret
+        # 没过期时间(之前没发生过同条件告警) or 过期了，则更新过期时间: 检查与更新是原子的，以便多个进程共享存储
+        try:
+            return self.alert_dedup_store.check_and_set(condition, expire_sec)
+        except Exception as ex: # 存储异常时宁可重复告警，也不能漏告警
+            log.error("MonitorBoot.check_alert_expired()异常: " + str(ex), exc_info=ex)
+            return True
 
     # 发送告警邮件
     def send_alert_email(self, _):
@@ -295,107 +398,206 @@ class MonitorBoot(YamlBoot):
         # alert_dir = os.getcwd()
         alert_dir = os.path.abspath(get_var('alert_dir'))
         msg = msg + "\n详细日志与导出文件在目录: " + alert_dir
-        self.do_send_email(title, msg)
+        return self.do_send_email(title, msg)
 
     # -------------------------------- 监控进程 -----------------------------------
-    # 监控的进程id
+    def get_proc(self, name = None):
+        '''
+        获得监控的进程
+        :param name: 进程分组名，为空则取默认(未命名的)进程，没有默认进程则取唯一监控的进程
+        :return: ProcInfo
+        '''
+        name = name or ''
+        proc = self._procs.get(name)
+        if proc is None and name in self._pid_greps:
+            self.grep_pid(self._pid_greps[name], name) # 先尝试grep pid
+            proc = self._procs.get(name)
+        if proc is None and name == '' and len(self._procs) > 0:
+            # 只监控了一个进程才能省略分组名，多个则不知道要哪个，不能随便取一个
+            if len(self._procs) > 1:
+                raise Exception(f"监控了多个进程分组{list(self._procs.keys())}，要指定进程分组名")
+            proc = next(iter(self._procs.values()))
+        if proc is None:
+            raise Exception(f"没用使用动作 monitor_pid/grep_pid 来监控进程{'[' + name + ']' if name else ''}")
+        return proc
+
+    def get_dump_proc(self, name = None):
+        '''
+        获得要导出的进程
+        :param name: 进程分组名，为空则取告警条件中的进程(在when_alert中)，否则取默认进程
+        :return: ProcInfo
+        '''
+        if not name:
+            name = get_var('alert_proc', False)
+        return self.get_proc(name)
+
+    # 默认监控的进程id
     @property
     def pid(self):
-        if self._pid is None:
-            self.grep_pid(self._pid_grep) # 先尝试grep pid
-            if self._pid is None:
-                raise Exception("没用使用动作 monitor_pid/grep_pid 来监控 pid")
-        return self._pid
+        return self.get_proc().pid
 
-    # 监控的进程名
+    # 默认监控的进程名
     @property
     def pname(self):
-        if self._proc is None:
-            self.grep_pid(self._pid_grep) # 先尝试grep pid
-        return self._proc.name
+        return self.get_proc().name
 
     # 检查是否监控java进程
-    def check_moniter_java(self, action):
-        if self._pid is None:
-            raise Exception("无pid")
-        if not self._proc.is_java:
-            pname = f"{self.pname}[{self.pid}]"
+    def check_moniter_java(self, action, proc):
+        if not proc.is_java:
+            pname = f"{proc.name}[{proc.pid}]"
             raise Exception(f"非java进程: {pname}, 不能执行{action}")
 
     def monitor_pid(self, options):
         '''
         监控进程，如果进程不存在，则抛异常
+            进程运行中: 监听进程退出事件(pidfd)，退出时立即重新检查，不用定时检查
+            进程没运行: 触发when_no_run，并定时检查进程是否已(被重新)启动
         :param options 选项，包含
-                    grep: 用ps aux搜索进程时要搜索的关键字
-                    interval: 定时检查的时间间隔，用于定时检查进程是否还存在，默认10秒
+                    name: 进程分组名，用于监控多个进程，告警条件中用 proc[分组名].字段 来引用该进程，默认为空
+                    grep: 搜索进程时要搜索的关键字
+                    interval: 进程没运行时，定时检查的时间间隔，默认10秒
                     when_no_run: 当进程没运行时执行的步骤
         :return:
         '''
-        # 1 使用 ps aux | grep 来获得pid
+        # 1 在/proc中搜索进程
         try:
-            self.grep_pid(options['grep'])
+            pid = self.grep_pid(options['grep'], options.get('name'))
         except Exception as ex:
+            pid = None
             # 2 当进程没运行时执行的步骤
             steps = options.get('when_no_run')
             if steps is not None:
                 log.info(f"进程[%s]没运行, 触发when_no_run注册的动作", options['grep'])
                 # await self.run_steps_async(steps) # 不要await，否则monitor_pid()要async，而执行yaml文件中的run_steps()是不支持调用async动作的
-                pool.exec(self.run_steps_async, steps) # 耗时操作扔到线程池执行
-                # pool.exec(self.run_steps_async, steps, get_vars(True))
+                # 扔到执行器中作为一个任务串行执行(如先重启进程再发邮件)，上次的还在排队则合并
+                self.action_executor.submit_steps(steps, name=f"when_no_run[{options['grep']}]")
 
-        # 3 使用递归+延迟来实现定时检查
+        # 3 进程运行中: 监听进程退出，退出时立即重新检查
+        if pid is not None:
+            self.proc_watcher.watch(options.get('name') or '', pid, lambda: self.monitor_pid(options))
+            return
+        # 4 进程没运行: 使用递归+延迟来实现定时检查
         interval = options.get('interval', 10)
         self.loop.call_later(interval, self.monitor_pid, options)
 
-    def grep_pid(self, grep):
+    def grep_pid(self, grep, name = None):
         '''
-        监控进程，如果进程不存在，则抛异常
-        :param grep: 用 `ps aux | grep` 搜索进程时要搜索的关键字，支持多个，用|分割
-        :return:
+        搜索进程，如果进程不存在，则抛异常
+            在进程内搜索/proc下的进程命令行(有缓存)，代替 `ps -ef | grep` 管道，不用fork子进程
+        :param grep: 搜索进程时要搜索的关键字，支持多个，用|分割，进程命令行要包含所有关键字
+        :param name: 进程分组名，用于监控多个进程，默认为空
+        :return: pid
         '''
-        if self._pid_grep is not None and self._pid_grep != grep:
-            raise Exception(f"框架只支持监控一个进程：已监控[{self._pid_grep}]进程")
-        self._pid_grep = grep
-        pid = get_pid_by_grep(grep)
-        if pid is None:
+        name = name or ''
+        old_grep = self._pid_greps.get(name)
+        if old_grep is not None and old_grep != grep:
+            raise Exception(f"进程分组[{name}]已监控[{old_grep}]进程")
+        self._pid_greps[name] = grep
+        pids = proc_index.grep(grep)
+        if len(pids) == 0:
             raise Exception(f"不存在匹配[{grep}]的进程")
-        if "\n" in pid:
-            raise Exception(f"关键字[{grep}]匹配了多个进程: " + pid.replace('\n', ','))
+        if len(pids) > 1:
+            raise Exception(f"关键字[{grep}]匹配了多个进程: " + ','.join(map(str, pids)))
+        pid = pids[0]
         log.info(f"关键字[%s]匹配进程: %s", grep, pid)
-        # 记录进程id+进程
-        self._pid = pid
-        self._proc = ProcInfo(pid)
+        # 记录进程: pid不变则复用ProcInfo
+        old = self._procs.get(name)
+        if old is not None and old.pid == pid:
+            return pid
+        if old is not None: # 进程重启了，不再采样旧进程
+            metric_sampler.unwatch_pid(old.pid)
+        proc = self._procs[name] = ProcInfo(pid)
+        # 立即让采样器监控该进程: 所有监控的进程在采样器的每个周期中一起采样
+        proc.proc
+        return pid
 
     # -------------------------------- 监控jvm(进程+gc日志+线程日志)的动作 -----------------------------------
-    def monitor_gc_log(self, steps, file):
+    def monitor_gc_log(self, steps, file, batch_lines = None, batch_ms = None, retention = None):
         '''
         监控gc日志文件内容追加，要解析gc日志
           变量 gc 记录当前行解析出来的gc信息
-          变量 gc_log 记录gc日志文件
+          批量模式下(指定了batch_lines或batch_ms)，变量 gcs 记录一批gc信息，变量 gc 记录该批的最后一个gc信息
         :param steps: 每次定时要执行的步骤
         :param file: gc日志文件路径
+        :param batch_lines: 批量模式下每批最多gc数，默认500
+        :param batch_ms: 批量模式下每批最多等待毫秒数，默认200
+        :param retention: gc记录的保留窗口，数字表示条数(如100000)，带时间单位表示秒数(如7d/12h)，默认全部保留
         :return:
         '''
         if self.gc_parser is not None:
             raise Exception('只支持解析单个gc log')
-        self.gc_parser = GcLogParser(file)
-        self.gc_parser.parse() # 先解析整个gc log，但不触发报警，只是为了记录历史gc
+        self.gc_parser = GcLogParser(file, checkpoint=True, retention=retention)
+        self.gc_parser.parse() # 先解析整个gc log(有断点则从断点继续解析)，但不触发报警，只是为了记录历史gc
+        # 定时保存断点，以便重启后从断点继续解析
+        self.scheduler.add_job(self.gc_parser.save_checkpoint, 'interval', seconds=10)
+
+        # 1 逐行模式
+        if not batch_lines and not batch_ms:
+            async def read_line(line):
+                # 解析gc信息
+                gc = self.gc_parser.parse_gc_line(line)
+                if gc != None:
+                    self.store_gc(gc)
+                    # 将gc信息塞到变量中，以便子步骤能读取
+                    vars = {'gc': gc}
+                    # 执行子步骤
+                    await self.run_steps_async(steps, vars)
+            self.tail_gc_log(file, read_line)
+            return
+
+        # 2 批量模式: 逐行解析gc，但一批gc只执行一次子步骤(含告警)
+        async def read_gcs(gcs):
+            # 将gc信息塞到变量中，以便子步骤能读取
+            vars = {
+                'gcs': gcs,
+                'gc': gcs[-1]
+            }
+            # 执行子步骤
+            await self.run_steps_async(steps, vars)
+        batcher = TailBatcher(read_gcs, batch_lines, batch_ms)
         async def read_line(line):
-            # 解析gc信息
+            # 解析gc信息，非gc行返回None，会被batcher忽略
             gc = self.gc_parser.parse_gc_line(line)
-            if gc != None:
-                # 将gc信息塞到变量中，以便子步骤能读取
-                vars = {'gc': gc}
-                # 执行子步骤
-                await self.run_steps_async(steps, vars)
-        self.do_tail(file, read_line)
+            if gc is not None:
+                self.store_gc(gc)
+            await batcher.add(gc)
+        self.tail_gc_log(file, read_line)
+
+    # tail gc日志: 从解析的断点处继续读，并跟随日志轮转
+    def tail_gc_log(self, file, callback):
+        t = GcLogTail(self.gc_parser, self.scheduler)
+        self.tails[file] = t
+        t.follow(callback)
+
+    # 将gc记录写入指标存储
+    def store_gc(self, gc):
+        if self.metric_store is None:
+            return
+        try:
+            gc_time = self.gc_parser.gc_time(gc)
+            self.metric_store.append('gc', gc_cols, gc, gc_time)
+            self.metric_store.append('gc_metrics', gc_metric_cols, gc, gc_time)
+        except Exception as ex:
+            log.error("MonitorBoot.store_gc()异常: " + str(ex), exc_info=ex)
+
+    # 获得gc的衍生指标
+    def get_gc_metrics(self):
+        if self.gc_parser is None:
+            raise Exception("没用使用动作 monitor_gc_log 来监控与解析gc日志")
+        return self.gc_parser.metrics
 
     def get_current_gc(self, is_full):
         '''
         获得当前gc信息
         :param is_full: 是否full gc
-        :return:
+        :return: 逐行模式下返回单个gc；批量模式下返回该批中匹配类型的gc的list
         '''
+        # 批量模式: 返回匹配类型的gc
+        gcs = get_var('gcs', False)
+        if gcs is not None:
+            gcs = [gc for gc in gcs if gc['is_full'] == is_full]
+            return gcs or None
+
         # 获得当前gc
         gc = get_var('gc')
         if gc is None:
@@ -408,49 +610,116 @@ class MonitorBoot(YamlBoot):
         return None
 
     # -------------------------------- dump -----------------------------------
-    async def dump_jvm_heap(self, filename_pref):
+    async def dump_jvm_heap(self, filename_pref, proc_name = None):
         '''
         导出监控的进程的jvm堆快照
         :param filename_pref: 文件名前缀
+        :param proc_name: 进程分组名，为空则取告警条件中的进程，否则取默认进程
         :return:
         '''
         try:
-            self.check_moniter_java('导出jvm堆快照')
+            proc = self.get_dump_proc(proc_name)
+            self.check_moniter_java('导出jvm堆快照', proc)
             # 如果有告警就用告警条件作为文件名前缀
             filename_pref = self.fix_alert_filename_pref(filename_pref, "JvmHeap")
-            now = ts.now2str("%Y%m%d%H%M%S")
-            file = f'{filename_pref}-{now}.hprof'
-            cmd = f"jmap -dump:live,format=b,file='{file}' {self.pid}"
-            await run_command_async(cmd)
-            # os.rename(file1, file2)
+            file = await jvm_dumper.dump_heap(proc.pid, filename_pref)
             log.info(f"导出jvm堆快照: %s", file)
             return file
         except Exception as ex:
             log.error("MonitorBoot.dump_jvm_heap()异常: " + str(ex), exc_info=ex)
 
-    async def dump_jvm_thread(self, filename_pref):
+    async def dump_jvm_thread(self, filename_pref, proc_name = None):
         '''
         导出监控的进程的jvm线程栈
         :param filename_pref: 文件名前缀
+        :param proc_name: 进程分组名，为空则取告警条件中的进程，否则取默认进程
         :return:
         '''
         try:
-            self.check_moniter_java('导出jvm线程栈')
+            proc = self.get_dump_proc(proc_name)
+            self.check_moniter_java('导出jvm线程栈', proc)
             # 如果有告警就用告警条件作为文件名前缀
             filename_pref = self.fix_alert_filename_pref(filename_pref, "JvmThread")
-            now = ts.now2str("%Y%m%d%H%M%S")
-            file = f'{filename_pref}-{now}.tdump'
-            cmd = f"jstack -l {self.pid} > '{file}'"
-            await run_command_async(cmd)
+            file = await jvm_dumper.dump_thread(proc.pid, filename_pref)
             log.info(f"导出jvm线程栈: %s", file)
+            try:
+                await self.analyze_thread_dump(proc.pid, file)
+            except Exception as ex: # 分析失败不影响导出
+                log.error("MonitorBoot.analyze_thread_dump()异常: " + str(ex), exc_info=ex)
             return file
         except Exception as ex:
             log.error("MonitorBoot.dump_jvm_thread()异常: " + str(ex), exc_info=ex)
 
+    async def dump_jvm_hot_threads(self, options = None):
+        '''
+        导出cpu最忙的jvm线程及其栈: 采集区间内的线程cpu，然后导出线程栈，按nid关联
+        :param options: 选项 {filename_pref, proc_name, interval, top, frames}
+        :return: 分析结果的文件
+        '''
+        try:
+            options = options or {}
+            proc = self.get_dump_proc(options.get('proc_name'))
+            self.check_moniter_java('导出cpu最忙的jvm线程', proc)
+            filename_pref = self.fix_alert_filename_pref(options.get('filename_pref'), "JvmHotThreads")
+            # 1 采集线程cpu: 区间内的增量，区间结束后立即dump，栈才对得上
+            stat = await ProcStat(options.get('interval')).collect()
+            threads_df = stat.threads_df(proc.pid)
+            # 2 导出线程栈
+            file = await jvm_dumper.dump_thread(proc.pid, filename_pref)
+            # 3 关联分析
+            file = await self.analyze_thread_dump(proc.pid, file, threads_df, int(options.get('top', 10)), int(options.get('frames', 20)))
+            log.info(f"导出cpu最忙的jvm线程: %s", file)
+            return file
+        except Exception as ex:
+            log.error("MonitorBoot.dump_jvm_hot_threads()异常: " + str(ex), exc_info=ex)
+
+    async def profile_threads(self, options = None):
+        '''
+        采样监控的进程的线程cpu，并导出火焰图的折叠栈文件，导出文件名如`ThreadProfile-20230505164657.collapsed`
+        :param options: 选项 {filename_pref, proc_name, hz, duration, stack_interval, thread_names}
+        :return: 折叠栈文件
+        '''
+        try:
+            options = options or {}
+            proc = self.get_dump_proc(options.get('proc_name'))
+            # 非java进程不采样线程栈，只按线程名聚合
+            stack_interval = options.get('stack_interval', 5) if proc.is_java else None
+            filename_pref = self.fix_alert_filename_pref(options.get('filename_pref'), "ThreadProfile")
+            file = await profile_threads(proc.pid, filename_pref, options.get('hz', 10), options.get('duration', 30), stack_interval, options.get('thread_names', False))
+            log.info(f"导出线程cpu的折叠栈: %s", file)
+            return file
+        except Exception as ex:
+            log.error("MonitorBoot.profile_threads()异常: " + str(ex), exc_info=ex)
+
+    async def analyze_thread_dump(self, pid, file, threads_df = None, top = 10, frames = 20):
+        '''
+        分析线程栈: 检测死锁与锁护航，有线程cpu则输出cpu最忙的线程及其栈
+        :param pid: 进程id
+        :param file: 线程栈文件
+        :param threads_df: 线程cpu的df，为空则不保存分析结果
+        :param top: 输出cpu最忙的前几个线程
+        :param frames: 每个线程最多输出几个栈帧
+        :return: 分析结果的文件
+        '''
+        # 解析是纯cpu计算，放到线程池中执行
+        dump = await asyncio.get_running_loop().run_in_executor(None, parse_thread_dump, file)
+        history = self.thread_dump_histories.get(pid)
+        if history is None:
+            history = self.thread_dump_histories[pid] = ThreadDumpHistory(jvm_dumper.config.get('convoy_waiters', 3), jvm_dumper.config.get('convoy_dumps', 2))
+        convoys = history.add(dump)
+        for cycle in dump.deadlocks():
+            log.warning("进程[%s]的线程死锁: %s", pid, ' -> '.join(f'"{t.name}"' for t in cycle + cycle[:1]))
+        for lock in convoys:
+            log.warning("进程[%s]的锁护航: <%s> (a %s) 连续%s次dump都有多个线程排队, 等待线程数=%s, 持有线程=%s", pid, lock['lock'], lock['class'], lock['dumps'], lock['waiters'], lock['owners'])
+        if threads_df is None:
+            return None
+        hots = hot_threads(threads_df, dump, top)
+        return save_analysis(substr_before(file, '.tdump') + '.txt', dump, hots, convoys, frames)
+
     async def dump_jvm_gcs_xlsx(self, config):
         '''
-        将jvm gc信息导出到xlsx
-        :param config 配置，包含 {filename_pref, bins, interval}
+        将jvm gc信息导出到xlsx(或html/json)
+        :param config 配置，包含 {filename_pref, bins, interval, format}，其中format为报告格式: xlsx/html/json，默认xlsx
         :return:
         '''
         try:
@@ -462,27 +731,40 @@ class MonitorBoot(YamlBoot):
             filename_pref = config.get('filename_pref')
             bins = config.get('bins')
             interval = config.get('interval')
+            format = config.get('format')
 
             # 如果有告警就用告警条件作为文件名前缀
             filename_pref = self.fix_alert_filename_pref(filename_pref, "JvmGC")
-            file = self.gc_parser.gcs2xlsx(filename_pref, bins, interval)
+            file = await self.gc_parser.gcs2report_async(filename_pref, bins, interval, format) # 不阻塞事件循环
             log.info(f"导出jvm gc信息: %s", file)
             return file
         except Exception as ex:
             log.error("MonitorBoot.dump_jvm_gcs_xlsx()异常: " + str(ex), exc_info=ex)
 
-    # 将所有进程信息导出到xlsx
-    async def dump_all_proc_xlsx(self, filename_pref):
+    async def dump_all_proc_xlsx(self, filename_pref, interval = None, format = None):
+        '''
+        将所有进程信息导出到xlsx(或html/json)
+        :param filename_pref: 文件名前缀，也可以是配置 {filename_pref, interval, format}
+        :param interval: 采集2次快照的间隔秒数，用于计算区间内的cpu/io速率，默认1
+        :param format: 报告格式: xlsx/html/json，默认xlsx
+        '''
         try:
-            proc = None
-            if self._pid is not None:
-                proc = {
-                    'PID': self._pid,
-                    'Command': self.pname,
+            if isinstance(filename_pref, dict):
+                config = filename_pref
+                filename_pref = config.get('filename_pref')
+                interval = config.get('interval', interval)
+                format = config.get('format', format)
+            # 监控的进程
+            procs = {}
+            for name, proc in self._procs.items():
+                key = f'monitor_proc[{name}]' if name else 'monitor_proc'
+                procs[key] = {
+                    'PID': proc.pid,
+                    'Command': proc.name,
                 }
             # 如果有告警就用告警条件作为文件名前缀
             filename_pref = self.fix_alert_filename_pref(filename_pref, "ProcStat")
-            file = await all_proc_stat2xlsx(filename_pref, proc)
+            file = await all_proc_stat2report(filename_pref, procs, interval, format)
             log.info(f"导出所有进程信息: %s", file)
             return file
         except Exception as ex:
@@ -505,73 +787,143 @@ class MonitorBoot(YamlBoot):
                 filename_pref = 'Sys'
             now = ts.now2str()
             today, time = now.split(' ')
-            # 建文件
-            file = f'{filename_pref}-{today}.csv'
-            if not os.path.exists(file):
-                cols = ['date', 'time', 'cpu%/s', 'mem%/s', 'mem_used(MB)', 'disk_read(MB/s)', 'disk_write(MB/s)', 'net_sent(MB/s)', 'net_recv(MB/s)']
-                self.append_csv_row(file, cols)
+            cols = ['date', 'time', 'cpu%/s', 'mem%/s', 'mem_used(MB)', 'disk_read(MB/s)', 'disk_write(MB/s)', 'net_sent(MB/s)', 'net_recv(MB/s)']
+            writer = self.get_csv_writer(('sys', filename_pref), filename_pref, cols)
 
             # 导出一行系统信息
-            sys = await SysInfo().presleep_all_fields()
+            sys = SysInfo()
             row = [today, time, sys.cpu_percent, sys.mem_percent, sys.mem_used, sys.disk_read, sys.disk_write, sys.net_sent, sys.net_recv]
             # 转可读的文件大小
             for i in range(3, len(row)):
                 row[i] = bytes2file_size(row[i], 'M', False)
-            self.append_csv_row(file, row)
-            return file
+            return writer.write(row, today)
         except Exception as ex:
             log.error("MonitorBoot.dump_sys_csv()异常: " + str(ex), exc_info=ex)
 
-    # 将监控的进程信息导出到csv
+    # 将监控的进程信息导出到csv: 每个监控的进程一个文件
     async def dump_1proc_csv(self, filename_pref):
         try:
             if filename_pref is None:
                 filename_pref = 'Proc'
             now = ts.now2str()
             today, time = now.split(' ')
-            # 建文件
-            file = f'{filename_pref}-{self.pname}[{self.pid}]-{today}.csv'
-            if not os.path.exists(file):
-                cols = ['date', 'time', 'cpu%/s', 'mem_used(MB)', 'mem%', 'status']
-                self.append_csv_row(file, cols)
-
-            # 导出一行进程信息
-            proc = await ProcInfo(self.pid).presleep_all_fields()
-            row = [today, time, proc.cpu_percent, bytes2file_size(proc.mem_used, 'M', False), proc.mem_percent, proc.status]
-            self.append_csv_row(file, row)
+            if len(self._procs) == 0:
+                self.get_proc() # 先尝试grep pid
+            cols = ['date', 'time', 'cpu%/s', 'mem_used(MB)', 'mem%', 'status']
+            for name, proc in list(self._procs.items()):
+                # 进程重启(pid变了)则换新文件
+                writer = self.get_csv_writer(('proc', filename_pref, name), f'{filename_pref}-{proc.name}[{proc.pid}]', cols)
+                # 导出一行进程信息
+                row = [today, time, proc.cpu_percent, bytes2file_size(proc.mem_used, 'M', False), proc.mem_percent, proc.status]
+                writer.write(row, today)
         except Exception as ex:
             log.error("MonitorBoot.dump_1proc_csv()异常: " + str(ex), exc_info=ex)
 
-    def append_csv_row(self, file, vals):
-        # 修正小数
-        self.fix_float(vals)
-        # 文件加一行
-        with open(file, 'a+', encoding='utf-8', newline='') as file_obj:
-            writer = csv.writer(file_obj)
-            writer.writerow(vals)
-
-    # 修正小数
-    def fix_float(self, vals):
-        for i in range(0, len(vals)):
-            v = vals[i]
-            if isinstance(v, float):
-                vals[i] = '%.4f' % v
+    def dump_metrics(self, options):
+        '''
+        将系统与监控的进程的指标写入列式时序存储，一般配合`schedule`动作来使用；首次调用后，监控到的gc记录也会写入存储
+        :param options: 存储目录，或选项，包含
+                    dir: 存储目录，默认metrics
+                    flush_rows: 每攒多少行追加到文件一次，默认60
+                    flush_seconds: 最多隔多少秒追加到文件一次，默认10
+        '''
+        try:
+            if self.metric_store is None:
+                if not isinstance(options, dict):
+                    options = {'dir': options}
+                self.metric_store = MetricStore(options.get('dir') or 'metrics', int(options.get('flush_rows', 60)), float(options.get('flush_seconds', 10)))
+            now = time.time()
+            # 1 系统指标
+            sys = SysInfo()
+            self.metric_store.append('sys', sys_cols, [getattr(sys, col) for col in sys_cols], now)
+            # 2 监控的进程指标: 每个进程分组一个序列
+            for name, proc in list(self._procs.items()):
+                try:
+                    vals = [getattr(proc, col) for col in proc_cols]
+                except psutil.Error as ex: # 进程已退出，等下次grep
+                    log.error("MonitorBoot.dump_metrics()异常: 读进程[%s]指标失败: %s", proc.pid, ex)
+                    continue
+                self.metric_store.append(f'proc.{name}' if name else 'proc', proc_cols, vals, now)
+        except Exception as ex:
+            log.error("MonitorBoot.dump_metrics()异常: " + str(ex), exc_info=ex)
+
+    def expose_metrics(self, options):
+        '''
+        启动http服务器来暴露指标，供prometheus抓取: GET http://host:port/metrics
+        :param options: 端口，或选项，包含
+                    port: 端口，默认9108
+                    host: 监听的地址，默认0.0.0.0
+                    cache_seconds: 响应的缓存秒数，默认1
+        '''
+        if not isinstance(options, dict):
+            options = {'port': options}
+        if self.metrics_exporter is not None:
+            raise Exception("已暴露指标, 不能重复暴露")
+        self.metrics_exporter = MetricsExporter(self, float(options.get('cache_seconds', 1)))
+        coro = self.metrics_exporter.start(options.get('host') or '0.0.0.0', int(options.get('port') or 9108))
+        # 事件循环还没运行(如在顶层步骤中)，则等事件循环运行时再启动
+        if get_running_loop() is None:
+            self.loop.create_task(coro)
+            return
+        return coro
+
+    def get_csv_writer(self, key, filename_pref, cols):
+        '''
+        获得csv写入器，没有则创建
+        :param key: 写入器的key，如系统或进程分组
+        :param filename_pref: 文件名前缀，变了(如进程重启后pid变了)则关闭旧的写入器，创建新的
+        :param cols: 表头
+        :return: CsvWriter
+        '''
+        writer = self.csv_writers.get(key)
+        if writer is not None and writer.filename_pref != filename_pref:
+            writer.close()
+            writer = None
+        if writer is None:
+            writer = self.csv_writers[key] = CsvWriter(filename_pref, cols, **self.csv_options)
+        return writer
+
+    # 关闭所有csv写入器
+    def close_csv_writers(self):
+        for writer in self.csv_writers.values():
+            try:
+                writer.close()
+            except Exception as ex:
+                log.error("MonitorBoot.close_csv_writers()异常: " + str(ex), exc_info=ex)
+        self.csv_writers = {}
 
     def compare_gc_logs(self, config):
         '''
         对比多个gc log，并将对比结果存到excel中
-        :param config: {logs, interval, filename_pref}，其中
+            多个gc log在子进程中并行解析；如果在事件循环中执行(如在schedule/when_alert中)，则扔到线程中执行，不阻塞事件循环
+        :param config: {logs, interval, filename_pref, format}，其中
                         logs: gc log，必填
                         interval: 分区的时间间隔，单位秒，必填
                         filename_pref: 生成的结果excel文件前缀
+                        format: 报告格式: xlsx/html/json，默认xlsx
         :return:
         '''
         logs = config['logs']
         interval = config.get('interval') or 30
         interval = int(interval)
         filename_pref = config.get('filename_pref')
-        file = GcLogParser.compare_gclogs2xlsx(logs, interval, filename_pref)
-        log.info(f"对比gc log并将结果存到excel: %s", file)
+        format = config.get('format')
+        # 事件循环还没运行(如在顶层步骤中)，则直接执行
+        if get_running_loop() is None:
+            self.do_compare_gc_logs(logs, interval, filename_pref, format)
+            return
+        # 否则扔到线程中执行
+        return self.compare_gc_logs_async(logs, interval, filename_pref, format)
+
+    async def compare_gc_logs_async(self, logs, interval, filename_pref, format = None):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.do_compare_gc_logs, logs, interval, filename_pref, format)
+        except Exception as ex:
+            log.error("MonitorBoot.compare_gc_logs()异常: " + str(ex), exc_info=ex)
+
+    def do_compare_gc_logs(self, logs, interval, filename_pref, format = None):
+        file = GcLogParser.compare_gclogs2report(logs, interval, filename_pref, format=format)
+        log.info(f"对比gc log并将结果存到报告: %s", file)
 
     # 在指定秒数后结束
     def stop_after(self, run_seconds):
@@ -1,7 +1,14 @@
+import asyncio
+import queue
 import smtplib
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.header import Header
 from email.mime.text import MIMEText
+from pyutilb.asyncio_threadpool import EventLoopThread
+from pyutilb.log import log
 
 # 配置
 config = {
@@ -11,19 +18,71 @@ config = {
     'from_email': '',
     # 'to_email': '',
     # 'to_name': '',
+    # 'port': 465, # 端口，465为ssl，默认先试465再试25
+    # 'timeout': 30, # 连接与收发的超时秒数
+    # 'pool_size': 2, # 连接池大小
+    # 'retries': 3, # 发送失败的重试次数
+    # 'backoff': 1, # 第一次重试前等待的秒数，之后每次加倍
+    # 'digest_window': 0, # 合并告警的窗口秒数，窗口内的多个告警合并为一封邮件发送，0为不合并
+    # 'digest_max': 20, # 一封合并邮件最多包含几个告警，够数就立即发送
 }
 
 # 配置邮件
 def config_email(config2):
-    global config
+    global config, _pool, _digest
     config = config2
+    # 配置变了, 旧的连接池与合并器作废
+    if _pool is not None:
+        _pool.close()
+    _pool = None
+    if _digest is not None:
+        _digest.close()
+    _digest = None
 
-# 发邮件
+# 发邮件: 同步，用于没有事件循环的场景(如顶层步骤)
 def send_email(title, msg, to_email = None, to_name = None):
+    to_email, message = build_message(title, msg, to_email, to_name)
+    retries = int(config.get('retries', 3))
+    for i in range(retries + 1):
+        try:
+            get_pool().send(message, to_email)
+            return
+        except Exception as ex:
+            if i == retries or not is_retryable(ex):
+                raise ex
+            log.warning("发邮件失败, 第%s次重试: %s", i + 1, ex)
+            time.sleep(backoff_seconds(i))
+
+# 发邮件: 异步，不阻塞事件循环; 配置了digest_window则先合并再发
+async def send_email_async(title, msg, to_email = None, to_name = None):
+    window = float(config.get('digest_window') or 0)
+    if window > 0 and to_email is None and to_name is None: # 只合并发给默认收件人的告警
+        get_digest(window).add(title, msg)
+        return
+    await do_send_email_async(title, msg, to_email, to_name)
+
+# 真正的异步发邮件: smtplib在连接池的线程中执行，失败则退避重试
+async def do_send_email_async(title, msg, to_email = None, to_name = None):
+    to_email, message = build_message(title, msg, to_email, to_name)
+    pool = get_pool()
+    loop = asyncio.get_running_loop()
+    retries = int(config.get('retries', 3))
+    for i in range(retries + 1):
+        try:
+            await loop.run_in_executor(pool.executor, pool.send, message, to_email)
+            return
+        except Exception as ex:
+            if i == retries or not is_retryable(ex):
+                raise ex
+            log.warning("发邮件失败, 第%s次重试: %s", i + 1, ex)
+            await asyncio.sleep(backoff_seconds(i)) # 退避时不占用线程
+
+# 构建邮件
+def build_message(title, msg, to_email = None, to_name = None):
     # 收件人默认从配置中取
     if to_email is None and to_name is None:
         to_email = config['to_email']
-        to_name = config['to_name']
+        to_name = config.get('to_name')
     if to_name is None:
         to_name = to_email
 
@@ -31,27 +90,216 @@ def send_email(title, msg, to_email = None, to_name = None):
     message['Subject'] = Header(title, 'utf-8')
     message['From'] = f"{config['from_name']} <{config['from_email']}>"
     message['To'] = to_email
+    return to_email, message
+
+# 是否可重试的异常: 连接断开/连接失败/超时/网络错误/服务器临时错误(4xx)，而认证失败或收件人被拒等是不可重试的
+def is_retryable(ex):
+    if isinstance(ex, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(ex, smtplib.SMTPResponseException):
+        return 400 <= ex.smtp_code < 500
+    # SMTPException是OSError的子类，因此要在判断网络错误之前排除其他smtp错误，如 SMTPRecipientsRefused
+    if isinstance(ex, smtplib.SMTPException):
+        return False
+    return isinstance(ex, OSError)
+
+# 第i次重试前等待的秒数: 指数退避
+def backoff_seconds(i):
+    return float(config.get('backoff', 1)) * (2 ** i)
+
+'''
+smtp连接池
+    1 连接复用: 发完不quit，放回池中，下次直接用
+    2 断线重连: 借出空闲过久的连接时先noop检查，发送失败的连接直接丢弃，下次借出时新建
+    3 smtplib是阻塞的，因此在专用的线程池中发送，线程数=连接数，慢的smtp服务器不会阻塞事件循环
+'''
+class SmtpPool(object):
+
+    def __init__(self, size = 2, max_idle = 30):
+        '''
+        :param size: 连接数
+        :param max_idle: 空闲超过该秒数的连接在借出前要检查是否存活
+        '''
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = queue.LifoQueue() # 空闲连接: (连接, 归还时间)
+        self.slots = threading.Semaphore(size) # 限制连接数
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix='SmtpPool')
+
+    # 新建连接并登录
+    def connect(self):
+        host = config['host']
+        port = config.get('port')
+        timeout = float(config.get('timeout', 30))
+        if port is not None and int(port) != 465:
+            smtp = smtplib.SMTP(host, int(port), timeout=timeout)
+        else:
+            try:
+                smtp = smtplib.SMTP_SSL(host, 465, timeout=timeout)  # qq邮箱
+            except socket.error:
+                if port is not None:
+                    raise
+                smtp = smtplib.SMTP(host, 25, timeout=timeout)  # 163邮箱
+        if config.get('password'):
+            smtp.login(config['from_email'], config['password'])
+        return smtp
+
+    # 借出连接
+    def acquire(self):
+        while True:
+            try:
+                smtp, release_time = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if time.time() - release_time < self.max_idle:
+                return smtp
+            # 空闲过久，检查是否存活
+            try:
+                if smtp.noop()[0] == 250:
+                    return smtp
+            except Exception:
+                pass
+            self.quit(smtp)
 
-    do_send_email(message, to_email)
+    # 归还连接
+    def release(self, smtp):
+        self.idle.put((smtp, time.time()))
 
-# 真正的发邮件
-def do_send_email(message, to_email):
-    smtp = login()
-    smtp.sendmail(config['from_email'], to_email, message.as_string())
-    smtp.quit()
+    # 发送: 失败则丢弃连接并抛异常，由调用方重试
+    def send(self, message, to_email):
+        with self.slots:
+            smtp = self.acquire()
+            try:
+                smtp.sendmail(config['from_email'], to_email, message.as_string())
+            except Exception:
+                self.quit(smtp)
+                raise
+            self.release(smtp)
 
-# 登录邮件server
-_smtp = None
-def login():
-    global _smtp
-    if _smtp is None:
+    # 关闭连接，忽略异常
+    def quit(self, smtp):
         try:
-            _smtp = smtplib.SMTP_SSL(config['host'], 465)  # qq邮箱
-        except socket.error:
-            _smtp = smtplib.SMTP(config['host'], 25)  # 163邮箱
-        _smtp.login(config['from_email'], config['password'])
-    return _smtp
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    # 关闭所有空闲连接
+    def close(self):
+        while True:
+            try:
+                smtp, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.quit(smtp)
+        self.executor.shutdown(wait=False)
+
+'''
+告警邮件的合并器: 窗口内的多个告警合并为一封邮件发送，以免告警风暴时刷屏或被邮件服务器限流
+    第一个告警到来时开始计时，窗口结束或攒够digest_max个告警就发送
+    会在多个线程中调用(告警动作执行器的各通道与主线程各有事件循环)，因此告警列表加锁，计时器与发送都放到自己的事件循环线程中
+'''
+class EmailDigest(object):
+
+    def __init__(self, window, max_count = 20):
+        '''
+        :param window: 窗口秒数
+        :param max_count: 一封邮件最多包含几个告警
+        '''
+        self.window = window
+        self.max_count = max_count
+        self.items = [] # 待发送的告警: (标题, 内容)
+        self.lock = threading.Lock()
+        self.scheduled = False # 是否已开始计时
+        self.timer = None # 计时器，只在self.thread中访问
+        self.thread = EventLoopThread() # 递延启动
+
+    # 添加告警，线程安全
+    def add(self, title, msg):
+        with self.lock:
+            self.items.append((title, msg))
+            full = len(self.items) >= self.max_count
+            schedule = not full and not self.scheduled
+            if schedule:
+                self.scheduled = True
+        if full:
+            self.thread.exec(self.flush)
+        elif schedule:
+            self.thread.exec(self.schedule)
+
+    # 开始计时，在self.thread中执行
+    def schedule(self):
+        if self.timer is None:
+            self.timer = self.thread.loop.call_later(self.window, self.flush)
+
+    # 发送合并邮件，在self.thread中执行
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        with self.lock:
+            items = self.items
+            self.items = []
+            self.scheduled = False
+        if len(items) == 0:
+            return
+        if len(items) == 1:
+            title, msg = items[0]
+        else:
+            title = f"[{len(items)}个告警] {items[0][0]}"
+            msg = "\n\n----------\n\n".join(f"{i + 1}. {t}\n{m}" for i, (t, m) in enumerate(items))
+        self.thread.loop.create_task(self.send(title, msg))
+
+    async def send(self, title, msg):
+        try:
+            await do_send_email_async(title, msg)
+        except Exception as ex:
+            log.error("EmailDigest.send()异常: " + str(ex), exc_info=ex)
+
+    # 停止事件循环线程，未发送的告警丢弃
+    def close(self):
+        if self.thread.thread is not None:
+            self.thread.shutdown()
+            self.thread.thread.join(1)
+        if not self.thread.loop.is_running():
+            self.thread.loop.close()
+
+# 连接池: 递延创建
+_pool = None
+_pool_lock = threading.Lock()
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SmtpPool(int(config.get('pool_size', 2)))
+        return _pool
 
+# 合并器: 递延创建
+_digest = None
+_digest_lock = threading.Lock()
+def get_digest(window):
+    global _digest
+    with _digest_lock:
+        if _digest is None:
+            _digest = EmailDigest(window, int(config.get('digest_max', 20)))
+        return _digest
 
 if __name__ == '__main__':
-    send_email(1)
+    # 测试: 先启动本地smtp服务器 python -m aiosmtpd -n -l localhost:8025
+    config_email({
+        'host': 'localhost',
+        'port': 8025,
+        'password': '',
+        'from_name': 'MonitorBoot',
+        'from_email': 'aaa@localhost',
+        'to_email': 'bbb@localhost',
+        'digest_window': 1,
+    })
+    send_email('sync', 'hello')
+    async def test():
+        for i in range(5):
+            await send_email_async(f'alert {i}', f'msg {i}')
+        await asyncio.sleep(2)
+    asyncio.run(test())
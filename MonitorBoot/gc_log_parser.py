@@ -1,196 +1,536 @@
+import asyncio
+import bisect
+import datetime
+import glob
+import hashlib
+import json
 import math
+import multiprocessing
 import os
 import re
-
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from openpyxl.utils import get_column_letter
 from pyutilb import ts
 from pyutilb.file import *
 from pyutilb.log import log
-from pyutilb.strs import substr_before
 from pyutilb.tail import Tail
-from pyutilb.util import set_vars, val2df
-from ExcelBoot.boot import Boot as EBoot
+from pyutilb.util import val2df
+from MonitorBoot.gc_metrics import GcMetrics
+from MonitorBoot.gc_store import GcStore, parse_retention, columns2df
+from MonitorBoot.report_worker import export_excel, export_excel_async
+from MonitorBoot.html_report import HtmlReport, check_format, report_file, downsample, save_json
 
 # ExcelBoot的步骤文件
 gcs_excel_boot_yaml = __file__.replace("gc_log_parser.py", "eb-gcs2xlsx.yml")
 compare_gcs_excel_boot_yaml = __file__.replace("gc_log_parser.py", "eb-compare_gcs2xlsx.yml")
 
+# ---- 预编译的gc行正则 ----
+# 旧格式(-XX:+PrintGCDetails)的头部: [系统时间: ]jvm时间: [GC类型 (原因)
+legacy_head_reg = re.compile(r'(?:(\d{4}-\d\d-\d\dT[\d:.]+[+-]\d{4}): )?([\d.]+): \[((?:Full )?GC)(?: \(((?:[^()]|\([^()]*\))*)\))?')
+# 旧格式的空间变化: 有年代名的是单个年代，如 [PSYoungGen: 1525K->512K(1536K)]；没有的是总的，如 3556K->2886K(5632K), 0.0039928 secs
+legacy_size_reg = re.compile(r'(?:\[([^\[\]:]+): +|(?<![\w.]))(\d+)K->(\d+)K\((\d+)K\)(?:, ([\d.]+) secs)?')
+# 旧格式的耗时: 0.0416957 secs] [Times: user=0.13 sys=0.00, real=0.04 secs]
+legacy_times_reg = re.compile(r'([\d.]+) secs\] \[Times: user=([\d.]+) sys=([\d.]+), real=([\d.]+) secs\]')
+# 统一日志(-Xlog:gc*)的头部: [uptime][level][tags] GC(id)
+unified_head_reg = re.compile(r'\[(\d+(?:\.\d+)?)(s|ms)\](?:\[[^\]]*\])* GC\((\d+)\) ')
+# 统一日志的gc记录: 名字 空间变化 [耗时]，如 Pause Young (Normal) (G1 Evacuation Pause) 24M->4M(256M) 3.456ms，ZGC 如 Garbage Collection (Warmup) 48M(5%)->20M(2%)
+unified_record_reg = re.compile(r'(.+?) (\d+)([KMG])(?:\(\d+%\))?->(\d+)([KMG])(?:\(\d+%\))?(?:\((\d+)([KMG])\))?(?: (\d+(?:\.\d+)?)(ms|s|us))?\s*$')
+# 统一日志的年代空间变化(gc,heap/gc,metaspace)，如 PSYoungGen: 6144K->1019K(7168K)，jdk17+为 PSYoungGen: 6144K(7168K)->1019K(7168K) Eden: ...
+unified_gen_reg = re.compile(r'([A-Za-z][\w ]*?): (\d+)([KMG])(?:\(\d+[KMG]\))?->(\d+)([KMG])\((\d+)([KMG])\)')
+# 统一日志的无空间变化的暂停，如ZGC的 Pause Mark Start 0.123ms(分代ZGC为 y: Pause Mark Start)，Shenandoah的 Pause Init Mark 0.123ms
+unified_pause_reg = re.compile(r'(?:[yO]: )?Pause \D*?(\d+(?:\.\d+)?)(ms|s|us)\s*$')
+# 统一日志中代表一次gc的汇总行的名字前缀，其他有空间变化的行(如Shenandoah的 Concurrent marking)只是gc的阶段
+unified_summary_prefs = ('Pause', 'Garbage Collection', 'Minor Collection', 'Major Collection', 'Concurrent cleanup')
+# 统一日志中并发周期的暂停，如G1的 Pause Remark/Pause Cleanup，既不是年轻代gc也不是full gc
+unified_concurrent_prefs = ('Pause Remark', 'Pause Cleanup')
+# 统一日志的cpu时间: User=0.01s Sys=0.00s Real=0.00s
+unified_cpu_reg = re.compile(r'User=([\d.]+)s Sys=([\d.]+)s Real=([\d.]+)s')
+# 空间单位换算为K
+size_units = {'K': 1, 'M': 1024, 'G': 1024 * 1024}
+# 时间单位换算为秒
+time_units = {'s': 1, 'ms': 0.001, 'us': 0.000001}
+
+# 文件指纹的最大字节数: 旧格式日志的前几行是相同的jvm版本与参数，只比较首行不足以识别文件被覆盖
+head_bytes = 64 * 1024
+
+# gc耗时直方图的区间上界(秒)，同prometheus的默认区间
+pause_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
 '''
 gc日志解析，主要用于识别频繁gc 或 gc效率不高
     -Xms20M -Xmx20M -Xmn10M -XX:SurvivorRatio=8 # 堆大小
     -verbose:gc -XX:+PrintGCDetails  -Xloggc:gc.log # gc日志 
     -XX:+HeapDumpOnOutOfMemoryError # oom时dump出堆快照，如java_pid30949.hprof
     -XX:MaxTenuringThreshold=1 -XX:+PrintTenuringDistribution # 晋升老年代的age阈值 
+    -Xlog:gc*:file=gc.log # jdk9+的统一日志，支持 G1/Parallel/Serial/ZGC/Shenandoah
 '''
 class GcLogParser(object):
 
-    def __init__(self, log_file):
+    def __init__(self, log_file, checkpoint = False, retention = None):
+        '''
+        :param log_file: gc日志文件，如果开启了日志轮转，则会跟随解析轮转的文件集
+        :param checkpoint: 是否启用断点，启用后会在日志旁边的断点文件中记录已解析的字节偏移，重启后从断点继续解析
+        :param retention: gc记录的保留窗口，数字表示条数(如100000)，带时间单位表示秒数(如7d/12h)，默认全部保留
+        '''
         self.log_file = os.path.abspath(log_file)
-        self.start_time = os.path.getctime(self.log_file)
-        self.gcs = [] # 收集日志信息
+        self.start_time = os.path.getctime(self.log_file) if os.path.exists(self.log_file) else None
+        max_count, max_seconds = parse_retention(retention)
+        self.gcs = GcStore(max_count, max_seconds) # 收集日志信息: 列式存储
+        self.last_gcs = {} # 记录上一条年轻代与老年代的gc信息, key是is_full
+        self.gc_counts = {False: 0, True: 0} # 年轻代与老年代的gc的累计次数, key是is_full
+        # 年轻代与老年代的gc耗时直方图: 各区间的gc次数(非累计，最后一个为+Inf区间) + 总耗时, key是is_full
+        self.pause_hists = {False: [0] * (len(pause_buckets) + 1), True: [0] * (len(pause_buckets) + 1)}
+        self.pause_sums = {False: 0.0, True: 0.0}
+        self.metrics = GcMetrics() # 衍生指标: 分配/晋升速率、老年代占用趋势、HDR风格的耗时直方图
+        self.last_unified_gc = None # 记录统一日志的上一条gc信息，用于补充后续行的cpu时间
+        self.pending_pauses = {} # 记录统一日志中尚未汇总的暂停时间, key是gc id
+        self.pending_gens = {} # 记录统一日志中尚未汇总的年代空间变化, key是gc id
+        # 断点
+        self.checkpoint = checkpoint
+        self.offsets = {} # 记录各文件已解析的字节偏移, key是inode, value是 {offset, head(文件前head_len字节的指纹), head_len}
+        if checkpoint:
+            self.load_checkpoint()
 
     # 获得上一条年轻代或老年代的gc信息
     def last_gc(self, is_full):
-        is_full = bool(is_full)
-        for gc in reversed(self.gcs):
-            if gc['is_full'] == is_full:
-                return gc
+        return self.last_gcs.get(bool(is_full))
 
-        return None
+    # gc发生的系统时间戳: 有日期戳(-XX:+PrintGCDateStamps)则用日期戳，否则为None(由调用方用当前时间，适用于tail到的新gc)
+    def gc_time(self, gc):
+        timestamp = gc.get('timestamp')
+        if timestamp is None:
+            return None
+        return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
 
-    # 解析gc日志
-    # :param log_file 日志文件路径
+    # 解析gc日志: 按写入顺序逐个解析轮转的文件集
     def parse(self):
-        txt = read_file(self.log_file)
-        for line in txt.splitlines():
-            # 解析单行
-            gc = self.parse_gc_line(line)
+        for file in self.rotated_files():
+            self.parse_file(file)
+        if self.checkpoint:
+            self.save_checkpoint()
+
+    def parse_file(self, file):
+        '''
+        流式解析单个gc日志文件，不一次性读入整个文件
+           有断点时从断点的字节偏移处继续解析
+        :param file: 日志文件
+        '''
+        inode = str(os.stat(file).st_ino)
+        offset = 0
+        # 检查断点: 文件头变了(如轮转覆盖了旧文件或jvm重启后重写了日志)或文件变小了(被截断)，则从头解析
+        ckpt = self.offsets.get(inode)
+        if ckpt is not None and ckpt['offset'] <= os.path.getsize(file) \
+                and ckpt.get('head_len') is not None and ckpt['head'] == file_fingerprint(file, ckpt['head_len']):
+            offset = ckpt['offset']
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            for line in f: # 带缓冲的逐行读
+                if not line.endswith(b'\n'): # 不完整的行，留待下次解析
+                    break
+                offset += len(line)
+                # 解析单行
+                self.parse_gc_line(line.decode('utf-8', errors='ignore').rstrip('\r\n'))
+        self.set_offset(inode, offset, file)
+
+    def set_offset(self, inode, offset, file = None):
+        '''
+        记录文件已解析的字节偏移
+        :param inode: 文件的inode
+        :param offset: 字节偏移
+        :param file: 文件路径，有则更新文件指纹: 取已解析部分的前head_bytes字节，因为文件是追加写的，这部分不会再变
+        '''
+        ckpt = self.offsets.get(inode)
+        if ckpt is None:
+            ckpt = self.offsets[inode] = {'offset': 0, 'head': file_fingerprint(None, 0), 'head_len': 0}
+        ckpt['offset'] = offset
+        head_len = min(offset, head_bytes)
+        if file is not None and ckpt['head_len'] != head_len:
+            ckpt['head'] = file_fingerprint(file, head_len)
+            ckpt['head_len'] = head_len
+
+    def rotated_files(self):
+        '''
+        获得gc日志的文件集，按写入顺序排序
+           开启 -XX:+UseGCLogFileRotation 后，日志文件为 gc.log.0 / gc.log.1 ... 其中正在写的文件为 gc.log.N.current
+        :return:
+        '''
+        base = re.sub(r'\.\d+(\.current)?$', '', self.log_file)
+        files = [f for f in glob.glob(glob.escape(base) + '.*') if re.search(r'\.\d+(\.current)?$', f)]
+        if os.path.exists(self.log_file) and self.log_file not in files:
+            files.append(self.log_file)
+        # 按修改时间排序，正在写的文件放最后
+        files.sort(key=lambda f: (f.endswith('.current'), os.path.getmtime(f)))
+        return files
+
+    # 断点文件: 日志旁边的隐藏文件，不会被当成轮转的日志文件
+    @property
+    def checkpoint_file(self):
+        dir, name = os.path.split(re.sub(r'\.\d+(\.current)?$', '', self.log_file))
+        return os.path.join(dir, f'.{name}.checkpoint')
+
+    # 加载断点
+    def load_checkpoint(self):
+        file = self.checkpoint_file
+        if not os.path.exists(file):
+            return
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.offsets = data['offsets']
+            # 恢复上一条gc，以便继续计算gc间隔
+            for gc in data['last_gcs']:
+                self.last_gcs[gc['is_full']] = gc
+            # 恢复最近的gc，以便继续计算分配速率
+            if self.last_gcs:
+                self.metrics.prev = max(self.last_gcs.values(), key=lambda gc: gc['jvm_time'])
+            log.info(f"加载gc日志断点: %s", file)
+        except Exception as ex:
+            log.error("GcLogParser.load_checkpoint()异常: " + str(ex), exc_info=ex)
+
+    # 保存断点: 先写临时文件再重命名，保证原子性
+    def save_checkpoint(self):
+        # 只保留现存文件的断点，tail时只推进了偏移，要补上文件指纹
+        inodes = set()
+        for f in self.rotated_files():
+            inode = str(os.stat(f).st_ino)
+            inodes.add(inode)
+            ckpt = self.offsets.get(inode)
+            if ckpt is not None:
+                self.set_offset(inode, ckpt['offset'], f)
+        data = {
+            'offsets': {k: v for k, v in self.offsets.items() if k in inodes},
+            'last_gcs': list(self.last_gcs.values()),
+        }
+        file = self.checkpoint_file
+        try:
+            with open(file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(file + '.tmp', file)
+        except Exception as ex:
+            log.error("GcLogParser.save_checkpoint()异常: " + str(ex), exc_info=ex)
 
     # 快速判断是否gc line
     def is_gc_line(self, line):
-        return ': [' in line \
-               and '->' in line \
-               and 'secs] [Times: user=' in line
+        return ('->' in line and ' secs]' in line) \
+               or 'GC(' in line
 
     def parse_gc_line(self, line):
         '''
-        解析gc日志行, 其中 fullgc比gc多了[Perm:28671K->28635K(28672K)]
+        解析gc日志行: 使用预编译的正则，直接在原始行上匹配，不生成中间字符串
+        1 旧格式(-XX:+PrintGCDetails), 其中 fullgc比gc多了[Perm:28671K->28635K(28672K)]
            Parallel Scavenge GC
             0.084: [GC (Allocation Failure) [PSYoungGen: 1525K->512K(1536K)] 3556K->2886K(5632K), 0.0039928 secs] [Times: user=0.01 sys=0.00, real=0.00 secs]
             0.089: [Full GC (Ergonomics) [PSYoungGen: 1536K->0K(1536K)] [ParOldGen: 3312K->4088K(4096K)] 4848K->4088K(5632K), [Metaspace: 3313K->3313K(1056768K)], 0.0416957 secs] [Times: user=0.13 sys=0.00, real=0.04 secs]
-          ParNew/CParNew/MS GC，与 Parallel Scavenge GC相比，其jvm time(如0.064: )重复了2次，需要特殊处理
+          ParNew/CParNew/MS GC，与 Parallel Scavenge GC相比，其jvm time(如0.064: )重复了2次
             0.064: [GC (Allocation Failure) 0.064: [ParNew: 509K->64K(576K), 0.0032549 secs] 509K->282K(1984K), 0.0033544 secs] [Times: user=0.01 sys=0.00, real=0.00 secs]
             104429.457: [Full GC (System) 104429.457: [CMS: 219741K->215266K(1835008K), 0.5469450 secs] 244623K->215266K(2070976K), [CMS Perm : 128846K->128831K(262144K)], 0.5470720 secs] [Times: user=0.54 sys=0.00, real=0.55 secs]
+        2 统一日志(-Xlog:gc*): 一次gc有多行，只有汇总行(tag为gc)才算一条gc记录，其他行补充到该gc中
+          G1/Parallel/Serial: 汇总行之前的年代行(gc,heap/gc,metaspace)记为该gc的年代空间，如 PSYoungGen.before
+            [2.344s][info][gc,heap] GC(12) PSYoungGen: 6144K->1019K(7168K)
+            [2.344s][info][gc,heap] GC(12) ParOldGen: 0K->2000K(13824K)
+            [2.344s][info][gc,metaspace] GC(12) Metaspace: 3313K->3313K(1056768K)
+            [2.345s][info][gc] GC(12) Pause Young (Allocation Failure) 6M->2M(20M) 3.456ms
+            [2.346s][info][gc,cpu] GC(12) User=0.01s Sys=0.00s Real=0.00s
+          G1的并发周期的暂停: 单独归类(is_concurrent)，不算年轻代gc或full gc
+            [5.678s][info][gc] GC(20) Pause Remark 30M->30M(256M) 1.234ms
+            [5.689s][info][gc] GC(20) Pause Cleanup 30M->30M(256M) 0.123ms
+          ZGC: 耗时为该次gc的所有暂停时间之和
+            [1.230s][info][gc,phases] GC(3) Pause Mark Start 0.123ms
+            [1.234s][info][gc] GC(3) Garbage Collection (Warmup) 48M(5%)->20M(2%)
+          Shenandoah: 耗时为该次gc的所有暂停时间之和，jdk17+一次gc有2行 Concurrent cleanup，合并为一条gc记录
+            [1.230s][info][gc] GC(1) Pause Init Mark 0.123ms
+            [1.234s][info][gc] GC(1) Concurrent cleanup 60M->20M(256M) 0.045ms
         :param line:
         :return:
         '''
         if not self.is_gc_line(line):
             return None
         try:
-            gens = []
-            # print("解析gc行: " + line)
-            line = line.replace('--', '') # 特殊例子: 0.095: [GC (Allocation Failure) --[PSYoungGen: 1520K->1520K(1536K)] 4784K->5608K(5632K), 0.0099458 secs] [Times: user=0.03 sys=0.00, real=0.01 secs]
-            # 1 处理几个年代的空间+时间
-            items = re.findall('\[[^\[^\]]+\]', line)
-            for item in items:
-                # 1.1 解析单个年代
-                if item.startswith('[Times:'): # 忽略 [Times: user=0.13 sys=0.00, real=0.04 secs]
-                    # print("忽略非年代: " + item)
-                    pass
-                else: # 解析单个年代
-                    data = self.parse_gen(item)
-                    if data is None:
-                        raise Exception("解析年代失败: " + item)
-                    # print("解析年代: " + item + ", 结果为: " + str(data))
-                    gens.append(data) # 记录解析结果
-                # 1.2 去掉解析过的年代部分字符串
-                line = line.replace(item, '')
-                # print("剩余gc行: " + line)
-
-            # 2 处理总的空间+时间
-            # 如 0.089: [Full GC (Ergonomics)   4848K->4088K(5632K), , 0.0416957 secs]
-            # 如 0.084: [GC (Allocation Failure)  3556K->2886K(5632K), 0.0039928 secs]
-            # 如 0.064: [GC (Allocation Failure) 0.064:  509K->282K(1984K), 0.0033544 secs] -- ParNew/CMS GC与 Parallel Scavenge GC相比，其jvm time(如0.064: )重复了2次，需要特殊处理；注: 也可能不重复，但两个时间相差0.001秒，反正就是同一个gc段内
-            # 优先处理 jvm time： 干掉
-            jvm_time = substr_before(line, ': [') # gc发生时vm运行了多少秒
-            line = line.replace(jvm_time + ': ', '')  # 干掉 jvm time，有可能2次
-            if ':' in jvm_time: # 前面有可能有时间: `time: jvm_time: [`, 如 2019-03-28T18:09:15.774+0800: 389.142: [
-                time, jvm_time = jvm_time.rsplit(':', 1)
-                # todo: 也解析time(系统时间)
-            # 规整line为年代格式
-            line = line.replace(', ,', ',').replace(') ', '):')
-            # 解析总的年代
-            gc = self.parse_gen(line)
-            gc['jvm_time'] = float(jvm_time)  # gc发生时vm运行了多少秒
-            is_full = 'Full GC' in line
+            if line.startswith('['): # 统一日志的行以装饰器开头
+                gc = self.parse_unified_gc_line(line)
+            else:
+                gc = self.parse_legacy_gc_line(line)
+            if gc is None:
+                return None
+
+            # 并发周期的暂停(如G1的Remark/Cleanup): 只记录，不算年轻代或full gc，也不触发告警
+            if gc.get('is_concurrent'):
+                self.metrics.add(gc)
+                self.gcs.append(gc)
+                return None
+
             # 计算两次gc之间的时间间隔
+            is_full = gc['is_full']
             lastgc = self.last_gc(is_full)
             if lastgc is None:
                 # gc['interval'] = gc['jvm_time'] # 你不知道他是从啥时开始监控日志的，也不知道监控之前有没有gc过
                 gc['interval'] = 0
             else:
                 gc['interval'] = gc['jvm_time'] - lastgc['jvm_time']
-            gc['is_full'] = is_full
-            # print("解析总年代: " + line + ", 结果为: " + str(gc))
-
-            # 3 展平多个年代
-            # gc['gens'] = gens
-            self.flatten_gens(gc, gens)
+            # 累计次数，用于告警条件中计算窗口内的gc次数，如 rate(fgc.count, 10m)
+            self.gc_counts[is_full] += 1
+            gc['count'] = self.gc_counts[is_full]
+            # 耗时直方图
+            costtime = gc.get('costtime')
+            if costtime is not None:
+                self.pause_hists[is_full][bisect.bisect_left(pause_buckets, costtime)] += 1
+                self.pause_sums[is_full] += costtime
+            # 衍生指标
+            self.metrics.add(gc)
 
             # print(gc)
             self.gcs.append(gc)
+            self.last_gcs[is_full] = gc
             return gc
         except Exception as ex:
             log.error("GcLogParser.parse_gc_line()异常: " + str(ex), exc_info=ex)
             return None
 
-    # 解析一代: 如 [PSYoungGen: 1536K->0K(1536K)]
-    def parse_gen(self, gen):
-        mat = re.search('\[([^:]+): +(\d+)K->(\d+)K\((\d+)K\)(, ([\d\.]+) secs)?', gen)
-        if mat == None:
+    # 解析旧格式的gc行
+    def parse_legacy_gc_line(self, line):
+        head = legacy_head_reg.match(line)
+        if head is None:
             return None
-        data = {
-            'name': mat.group(1),
-            'before': float(mat.group(2)),
-            'after': float(mat.group(3)),
-            'total': float(mat.group(4)),
+        timestamp, jvm_time, type, cause = head.groups()
+        gc = {
+            'name': f"{type} ({cause})" if cause else type,
         }
-        # 总的才有secs部分
-        secs = mat.group(6)
-        if secs is not None:
-            data['costtime'] = float(secs)
-        return data
+        # 1 处理总的+几个年代的空间(年代展平为一维，年代名作为key的前缀，如 PSYoungGen.before)
+        gens = {}
+        for mat in legacy_size_reg.finditer(line, head.end()):
+            gen, before, after, total, secs = mat.groups()
+            data = gc if gen is None else gens
+            pref = '' if gen is None else gen.rstrip() + '.' # 去掉年代名末尾的空格，如 CMS Perm
+            data[pref + 'before'] = float(before)
+            data[pref + 'after'] = float(after)
+            data[pref + 'total'] = float(total)
+            if secs is not None:
+                data[pref + 'costtime'] = float(secs)
+        if 'before' not in gc: # 没有总的空间变化，非gc行
+            return None
+        # 2 处理耗时: Times前的secs为总耗时，先用rfind定位再match，比search快
+        end = line.rfind(' secs] [Times:')
+        times = legacy_times_reg.match(line, line.rfind(' ', 0, end) + 1) if end > 0 else None
+        if times is not None:
+            secs, user, sys, real = times.groups()
+            gc['costtime'] = float(secs)
+            gc['user'] = float(user)
+            gc['sys'] = float(sys)
+            gc['real'] = float(real)
+        gc['jvm_time'] = float(jvm_time) # gc发生时vm运行了多少秒
+        gc['is_full'] = type == 'Full GC'
+        if timestamp is not None:
+            gc['timestamp'] = timestamp # 系统时间
+        gc.update(gens)
+        return gc
+
+    # 解析统一日志的gc行
+    def parse_unified_gc_line(self, line):
+        head = unified_head_reg.search(line)
+        if head is None:
+            return None
+        uptime, unit, gc_id = head.groups()
+        gc_id = int(gc_id)
+        pos = head.end()
+        mat = unified_record_reg.match(line, pos)
+        if mat is None or mat.group(1).endswith(':'):
+            # 1 年代空间变化: 记到该次gc，等汇总行
+            gen = unified_gen_reg.match(line, pos)
+            if gen is not None:
+                name, before, before_unit, after, after_unit, total, total_unit = gen.groups()
+                gens = self.pending_gens.setdefault(gc_id, {})
+                gens[name + '.before'] = float(before) * size_units[before_unit]
+                gens[name + '.after'] = float(after) * size_units[after_unit]
+                gens[name + '.total'] = float(total) * size_units[total_unit]
+                return None
+            # 2 无空间变化的暂停: 累计到该次gc的暂停时间
+            pause = unified_pause_reg.match(line, pos)
+            if pause is not None:
+                self.pending_pauses[gc_id] = self.pending_pauses.get(gc_id, 0) + float(pause.group(1)) * time_units[pause.group(2)]
+                return None
+            # 3 cpu时间: 补充到上一条gc
+            cpu = unified_cpu_reg.match(line, pos)
+            gc = self.last_unified_gc
+            if cpu is not None and gc is not None and gc['gc_id'] == gc_id:
+                cpu_times = dict(zip(('user', 'sys', 'real'), map(float, cpu.groups())))
+                gc.update(cpu_times)
+                self.gcs.set_last(cpu_times)
+            return None
 
-    def flatten_gens(self, gc, gens):
-        '''
-        展平一次gc中的多个年代的变更：二维变为一维
-           二维: 年代的数组  [{'name': 'PSYoungGen', 'before': 1536.0, 'after': 0.0, 'total': 1536.0}, {'name': 'ParOldGen', 'before': 3312.0, 'after': 4088.0, 'total': 4096.0}, {'name': 'Metaspace', 'before': 3313.0, 'after': 3313.0, 'total': 1056768.0}]
-           一维: 年代名作为key的前缀 {'PSYoungGen.before': 1536.0, 'PSYoungGen.after': 0.0, 'PSYoungGen.total': 1536.0, 'ParOldGen.before': 3312.0, 'ParOldGen.after': 4088.0, 'ParOldGen.total': 4096.0, 'Metaspace.before': 3313.0, 'Metaspace.after': 3313.0, 'Metaspace.total': 1056768.0}
-        :param gc:
-        :param gens:
-        :return:
-        '''
-        for gen in gens:
-            name = gen['name']
-            del gen['name']
-            for k, v in gen.items():
-                key = name + '.' + k
-                gc[key] = v
+        # 4 gc记录: 只认汇总行，其他有空间变化的行只是gc的阶段(如Shenandoah的 Concurrent marking)
+        name, before, before_unit, after, after_unit, total, total_unit, secs, secs_unit = mat.groups()
+        if not name.startswith(unified_summary_prefs):
+            return None
+        pause_secs = self.pending_pauses.pop(gc_id, 0)
+        gens = self.pending_gens.pop(gc_id, None)
+        for pending in (self.pending_pauses, self.pending_gens): # 清理过期的暂停时间与年代空间
+            for id in [id for id in pending if id < gc_id]:
+                del pending[id]
+        if name.startswith('Pause') and secs is not None: # 暂停: 耗时为本身耗时
+            costtime = float(secs) * time_units[secs_unit]
+        else: # 并发gc(ZGC/Shenandoah): 耗时为暂停时间之和
+            costtime = pause_secs
+        after = float(after) * size_units[after_unit]
+        total = float(total) * size_units[total_unit] if total is not None else float('nan')
+        # 同一次gc的多条同名汇总行(如Shenandoah的2行 Concurrent cleanup): 合并到上一条gc，不重复计数
+        # 注: 耗时直方图只计入了第一行的耗时
+        last = self.last_unified_gc
+        if last is not None and last['gc_id'] == gc_id and last['name'] == name:
+            vals = {'after': after, 'total': total, 'costtime': last['costtime'] + costtime}
+            last.update(vals)
+            self.gcs.set_last(vals)
+            return None
+        gc = {
+            'name': name,
+            'before': float(before) * size_units[before_unit],
+            'after': after,
+            'total': total,
+            'costtime': costtime,
+            'jvm_time': float(uptime) * time_units[unit],
+            'is_full': 'Full' in name,
+            'gc_id': gc_id,
+        }
+        if name.startswith(unified_concurrent_prefs):
+            gc['is_concurrent'] = True
+        if gens is not None:
+            gc.update(gens)
+        self.last_unified_gc = gc
+        return gc
 
     # 获得所有 gc
     def all_gcs(self):
-        return pd.DataFrame(self.gcs, columns=['name', 'before', 'after', 'total', 'costtime', 'jvm_time', 'interval'])
-
-    def filter_gcs(self, is_full):
-        # return [gc for gc in self.gcs if gc['is_full'] == is_full]
-        ret = []
-        for gc in self.gcs:
-            if gc['is_full'] == is_full:
-                gc2 = gc.copy()
-                del gc2['is_full']
-                ret.append(gc2)
-        return ret
+        return self.gcs.to_df()
 
     # 获得full gc
     def full_gcs(self):
-        return self.filter_gcs(True)
+        return self.gcs.to_df(True)
 
     # 获得minor gc
     def minor_gcs(self):
-        return self.filter_gcs(False)
+        return self.gcs.to_df(False)
 
     def gcs2xlsx(self, filename_pref, bins=None, interval=None):
         '''
-        导出gc信息
+        导出gc信息: 在工作进程中生成xlsx，当前线程等待结果
+        :param filename_pref:
+        :param bins: 分区数，bins与interval参数是二选一
+        :param interval: 分区的时间间隔，单位秒，bins与interval参数是二选一
+        :return:
+        '''
+        vars = self.build_gcs_xlsx_vars(filename_pref, bins, interval)
+        if vars is None:
+            return None
+        return export_excel(gcs_excel_boot_yaml, vars)
+
+    async def gcs2xlsx_async(self, filename_pref, bins=None, interval=None):
+        '''
+        异步导出gc信息: 在工作进程中生成xlsx，不阻塞事件循环
+        :param filename_pref:
+        :param bins: 分区数，bins与interval参数是二选一
+        :param interval: 分区的时间间隔，单位秒，bins与interval参数是二选一
+        :return:
+        '''
+        vars = self.build_gcs_xlsx_vars(filename_pref, bins, interval)
+        if vars is None:
+            return None
+        return await export_excel_async(gcs_excel_boot_yaml, vars)
+
+    def gcs2report(self, filename_pref, bins=None, interval=None, format='xlsx'):
+        '''
+        导出gc报告
+        :param filename_pref:
+        :param bins: 分区数，bins与interval参数是二选一
+        :param interval: 分区的时间间隔，单位秒，bins与interval参数是二选一
+        :param format: 报告格式: xlsx/html/json
+        :return: 导出的文件
+        '''
+        format = check_format(format)
+        if format == 'xlsx':
+            return self.gcs2xlsx(filename_pref, bins, interval)
+        data = self.build_gcs_report(bins, interval)
+        if data is None:
+            return None
+        return save_gcs_report(report_file(filename_pref or 'JvmGC', format), data, format)
+
+    async def gcs2report_async(self, filename_pref, bins=None, interval=None, format='xlsx'):
+        '''
+        异步导出gc报告: xlsx在工作进程中生成，html/json在线程中生成，都不阻塞事件循环
         :param filename_pref:
         :param bins: 分区数，bins与interval参数是二选一
         :param interval: 分区的时间间隔，单位秒，bins与interval参数是二选一
+        :param format: 报告格式: xlsx/html/json
+        :return: 导出的文件
+        '''
+        format = check_format(format)
+        if format == 'xlsx':
+            return await self.gcs2xlsx_async(filename_pref, bins, interval)
+        # 在当前线程中读gc记录，以免与tail的写入并发，读出的数据已降采样，很小
+        data = self.build_gcs_report(bins, interval)
+        if data is None:
+            return None
+        file = report_file(filename_pref or 'JvmGC', format)
+        return await asyncio.get_running_loop().run_in_executor(None, save_gcs_report, file, data, format)
+
+    def build_gcs_report(self, bins=None, interval=None):
+        '''
+        准备gc报告(html/json)的数据: 摘要 + 分区统计 + 最慢的gc + 降采样后的曲线，数据量与gc数无关
+        :param bins: 分区数，bins与interval参数是二选一
+        :param interval: 分区的时间间隔，单位秒，bins与interval参数是二选一
         :return:
         '''
         if len(self.gcs) == 0:
             log.warning("无gc记录可导出")
-            return
+            return None
+        all_gcs = self.all_gcs()
+        minor_gcs = self.minor_gcs()
+        full_gcs = self.full_gcs()
+        jvm_times = all_gcs['jvm_time'].to_numpy(dtype=float)
+        costtimes = np.nan_to_num(all_gcs['costtime'].to_numpy(dtype=float))
+        # 摘要
+        duration = float(np.nanmax(jvm_times) - np.nanmin(jvm_times)) if len(jvm_times) > 1 else 0.0
+        summary = {
+            'log_file': self.log_file,
+            'duration': round(duration, 3), # 秒
+            'throughput': round((1 - costtimes.sum() / duration) * 100, 4) if duration > 0 else None, # 非gc时间的占比%
+            'max_heap_after': float(np.nanmax(all_gcs['after'])), # K
+            'max_heap_total': float(np.nanmax(all_gcs['total'])), # K
+            'mean_alloc_rate': float(np.nanmean(all_gcs['alloc_rate'])) if all_gcs['alloc_rate'].notna().any() else None, # MB/s
+            'mean_promotion_rate': float(np.nanmean(all_gcs['promotion_rate'])) if all_gcs['promotion_rate'].notna().any() else None, # MB/s
+            'old_after_slope': self.metrics.old_after_slope, # MB/h
+            'all': pause_summary(all_gcs),
+            'minor': pause_summary(minor_gcs),
+            'full': pause_summary(full_gcs),
+        }
+        # 最慢的gc: argpartition只做部分排序
+        n = min(20, len(costtimes))
+        top = np.argpartition(-costtimes, n - 1)[:n]
+        top = top[np.argsort(-costtimes[top], kind='stable')]
+        return {
+            'summary': summary,
+            'bins': {
+                'all': self.gcs2bins(all_gcs, bins=bins, interval=interval),
+                'minor': self.gcs2bins(minor_gcs, bins=bins, interval=interval),
+                'full': self.gcs2bins(full_gcs, bins=bins, interval=interval),
+            },
+            'slowest_gcs': all_gcs.iloc[top].reset_index(drop=True),
+            'series': {
+                'minor_pause': downsample(minor_gcs['jvm_time'], minor_gcs['costtime']),
+                'full_pause': downsample(full_gcs['jvm_time'], full_gcs['costtime']),
+                'heap_after': downsample(jvm_times, all_gcs['after']),
+                'heap_total': downsample(jvm_times, all_gcs['total']),
+                'alloc_rate': downsample(jvm_times, all_gcs['alloc_rate']),
+                'promotion_rate': downsample(jvm_times, all_gcs['promotion_rate']),
+                'old_after': downsample(full_gcs['jvm_time'], full_gcs['old_after']),
+            },
+        }
+
+    # 准备导出gc信息的变量
+    def build_gcs_xlsx_vars(self, filename_pref, bins=None, interval=None):
+        if len(self.gcs) == 0:
+            log.warning("无gc记录可导出")
+            return None
 
         # excel文件名
         filename_pref = filename_pref or 'JvmGC'
@@ -212,62 +552,95 @@ class GcLogParser(object):
             'full_gc_bins': self.gcs2bins(full_gcs, bins=bins, interval=interval),
             'minor_gc_bins': self.gcs2bins(minor_gcs, bins=bins, interval=interval),
         }
-        set_vars(vars)
-
-        # 导出excel
-        boot = EBoot()
-        boot.run_1file(gcs_excel_boot_yaml)
-        return file
+        return vars
 
     @classmethod
     def gcs2bins(self, gcs, bins=None, interval=None):
         '''
         将gc记录按时间划分区间，并统计各区间个数+耗时
+           向量化实现: 用 pd.cut 的区间编码 + np.bincount 一次扫描统计，复杂度与gc数成线性
         :param gcs: gc的df
         :param bins: 分区个数
         :param interval: 时间间隔，如果要对比2次gc的频率或耗时，特别是优化前后，需在同一个时间粒度(interval)上对比
-        :return:
+        :return: 各区间的 time(区间右边界), bin(区间), count(个数), costtime(总耗时), mean_costtime(平均耗时), max_costtime(最大耗时), p99_costtime(99分位耗时)
         '''
         df = val2df(gcs)
+        if len(df) == 0:
+            return pd.DataFrame([], columns=['time', 'bin', 'count', 'costtime', 'mean_costtime', 'max_costtime', 'p99_costtime'])
         if bins is None:
             if interval is None:
                 # raise Exception("未指定参数：bins 或 interval")
-                bins = min(8, len(gcs))
+                bins = min(8, len(df))
             else:
                 bins = math.ceil(df['jvm_time'].max() / interval)  # 区间的right不是interval的倍数(如interval=2，区间right应该是2/4/6，但生成的却是1.8,3.9,5.9之类的)，不易读，必须手动拼接区间
                 bins = [interval * i for i in range(0, bins + 1)]  # 手动拼接区间
-        bins = pd.cut(df['jvm_time'], bins=bins, include_lowest=True, right=True, duplicates='drop')
-        # Series: index是区间Interval，如[0.054, 4.428), [4.428, 8.802), [8.802, 13.189)
-        counts = pd.value_counts(bins)  # 统计各区间的个数
-
-        # 统计各区间的耗时
-        costtimes = []
-        for bin in counts.index: # counts.index不是有序的
-            costime = 0
-            for i, r in df.iterrows():
-                if r['jvm_time'] in bin:
-                    costime += r['costtime']
-                    break
-            costtimes.append(costime)
+        cats = pd.cut(df['jvm_time'], bins=bins, include_lowest=True, right=True, duplicates='drop')
+        # 区间Interval，如[0.054, 4.428), [4.428, 8.802), [8.802, 13.189)，是有序的
+        intervals = cats.cat.categories
+        n = len(intervals)
+        # 各gc所在的区间编码，-1表示不在任何区间内
+        codes = cats.cat.codes.to_numpy()
+        costtimes = np.nan_to_num(df['costtime'].to_numpy(dtype=float))
+        valid = codes >= 0
+        codes = codes[valid]
+        costtimes = costtimes[valid]
+
+        # 1 统计各区间的个数+总耗时+平均耗时
+        counts = np.bincount(codes, minlength=n)
+        totals = np.bincount(codes, weights=costtimes, minlength=n)
+        means = np.divide(totals, counts, out=np.zeros(n), where=counts > 0)
+
+        # 2 统计各区间的最大耗时+99分位耗时: 按(区间, 耗时)排序后，直接按下标取值
+        # 耗时>=0，合成单个排序键 区间*跨度+耗时 再argsort，比lexsort快几倍
+        span = costtimes.max() + 1 if len(costtimes) > 0 else 1
+        sorted_costtimes = costtimes[np.argsort(codes * span + costtimes)]
+        ends = np.cumsum(counts) # 各区间在排序后数组中的结束位置
+        starts = ends - counts
+        nonempty = counts > 0
+        maxs = np.zeros(n)
+        maxs[nonempty] = sorted_costtimes[ends[nonempty] - 1]
+        # 99分位: 线性插值，同 pd.Series.quantile()
+        p99s = np.zeros(n)
+        pos = starts[nonempty] + 0.99 * (counts[nonempty] - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        p99s[nonempty] = sorted_costtimes[lo] + (sorted_costtimes[hi] - sorted_costtimes[lo]) * (pos - lo)
 
         # 返回
-        df2 = pd.DataFrame([], columns=['time', 'bin', 'count', 'costtime'])
-        df2['bin'] = counts.index  # 区间
-        df2['bin'] = df2['bin'].astype('str')
-        df2['time'] = [bin.right for bin in counts.index]  # 区间
-        df2['count'] = counts.to_list()  # 各区间的个数
-        df2['costtime'] = costtimes  # 各区间的耗时
-        return df2.sort_values(by='time')  # 按时间排序
+        return pd.DataFrame({
+            'time': np.asarray(intervals.right), # 区间右边界
+            'bin': intervals.astype('str'), # 区间
+            'count': counts, # 各区间的个数
+            'costtime': totals, # 各区间的总耗时
+            'mean_costtime': means,
+            'max_costtime': maxs,
+            'p99_costtime': p99s,
+        })
 
     @classmethod
-    def compare_gclogs2xlsx(cls, logs, interval, filename_pref = None):
+    def compare_gclogs2xlsx(cls, logs, interval, filename_pref = None, max_workers = None):
         '''
         对比多个gc log，并将对比结果存到excel中
         :param logs gc log
         :param interval: 分区的时间间隔，单位秒，必填，2个gc log的对比必须基于同一个时间维度与粒度
         :param filename_pref:
+        :param max_workers: 并行解析gc log的进程数，默认为min(log数, cpu核数)
         :return:
         '''
+        return cls.compare_gclogs2report(logs, interval, filename_pref, max_workers, 'xlsx')
+
+    @classmethod
+    def compare_gclogs2report(cls, logs, interval, filename_pref = None, max_workers = None, format = 'xlsx'):
+        '''
+        对比多个gc log，并将对比结果存到报告中
+        :param logs gc log
+        :param interval: 分区的时间间隔，单位秒，必填，2个gc log的对比必须基于同一个时间维度与粒度
+        :param filename_pref:
+        :param max_workers: 并行解析gc log的进程数，默认为min(log数, cpu核数)
+        :param format: 报告格式: xlsx/html/json
+        :return:
+        '''
+        format = check_format(format)
         # 1 修正参数
         if logs is None or len(logs) == 0:
             log.warning("无gc log可对比")
@@ -287,14 +660,15 @@ class GcLogParser(object):
                     logs2[key] = logs[i]
                 logs = logs2
 
-        # 2 解析gc log
+        # 2 解析gc log: 一个log一个子进程并行解析，子进程返回列式数组
+        # 用spawn启动子进程: 本进程有asyncio循环与线程(采样器/tail等)，fork出的子进程可能继承被持有的锁而死锁
+        max_workers = min(len(logs), max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            columns_list = list(executor.map(parse_gclog2columns, logs.values()))
         log2gcs = []
         jvm_times = []
-        for key, file in logs.items():
-            # 解析gc log
-            parser = GcLogParser(file)
-            parser.parse()
-            gcs = parser.all_gcs()
+        for key, columns in zip(logs.keys(), columns_list):
+            gcs = columns2df(columns)
             # 记录
             item = {
                 'key': key,
@@ -326,10 +700,16 @@ class GcLogParser(object):
             compare_costtime_df[key + 'costtime'] = item['gc_bins']['costtime']
 
         # 5 导出
-        # excel文件名
         filename_pref = filename_pref or 'JvmGCCompare'
-        now = ts.now2str("%Y%m%d%H%M%S")
-        file = f'{filename_pref}-{now}.xlsx'
+        file = report_file(filename_pref, format)
+        if format != 'xlsx':
+            data = {
+                'interval': interval,
+                'summary': {item['key']: pause_summary(item['gcs']) for item in log2gcs},
+                'compare_count': compare_count_df,
+                'compare_costtime': compare_costtime_df,
+            }
+            return save_compare_gcs_report(file, data, format)
         # 设置变量
         vars = {
             'file': file,
@@ -339,12 +719,176 @@ class GcLogParser(object):
             'max_col': get_column_letter(len(log2gcs)+1), # 最大列名，用于设置列样式
             'plot_col': get_column_letter(len(log2gcs)+3) # 插入plot绘图的列
         }
-        set_vars(vars)
 
-        # 导出excel
-        boot = EBoot()
-        boot.run_1file(compare_gcs_excel_boot_yaml)
-        return file
+        # 导出excel: 在工作进程中生成
+        return export_excel(compare_gcs_excel_boot_yaml, vars)
+
+# gc耗时的摘要
+def pause_summary(gcs):
+    costtimes = gcs['costtime'].to_numpy(dtype=float)
+    costtimes = costtimes[~np.isnan(costtimes)]
+    if len(costtimes) == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(costtimes, [50, 90, 99])
+    return {
+        'count': len(costtimes),
+        'total_costtime': float(costtimes.sum()),
+        'mean_costtime': float(costtimes.mean()),
+        'max_costtime': float(costtimes.max()),
+        'p50_costtime': float(p50),
+        'p90_costtime': float(p90),
+        'p99_costtime': float(p99),
+    }
+
+# 将gc报告的数据存为html/json
+def save_gcs_report(file, data, format):
+    if format == 'json':
+        return save_json(file, {
+            'summary': data['summary'],
+            'bins': data['bins'],
+            'slowest_gcs': data['slowest_gcs'],
+        })
+    summary = data['summary']
+    report = HtmlReport('JVM GC: ' + str(summary['log_file']))
+    report.add_heading('Summary')
+    report.add_summary({k: v for k, v in summary.items() if not isinstance(v, dict)})
+    report.add_table(pd.DataFrame([{'gc': k, **summary[k]} for k in ('all', 'minor', 'full')]))
+    series = data['series']
+    report.add_heading('Pause Time')
+    report.add_chart(None, {'minor': series['minor_pause'], 'full': series['full_pause']}, 'scatter', 'jvm time(s)', 'costtime(s)')
+    report.add_heading('Heap')
+    report.add_chart(None, {'after': series['heap_after'], 'total': series['heap_total']}, 'line', 'jvm time(s)', 'heap(K)')
+    report.add_heading('Allocation / Promotion Rate')
+    report.add_chart(None, {'alloc': series['alloc_rate'], 'promotion': series['promotion_rate']}, 'line', 'jvm time(s)', 'rate(MB/s)')
+    report.add_heading('Old Gen After Full GC')
+    report.add_chart(None, {'old_after': series['old_after']}, 'line', 'jvm time(s)', 'old gen(MB)')
+    for key, df in data['bins'].items():
+        report.add_heading(f'{key.capitalize()} GC Bins')
+        report.add_chart(df['time'], {'count': df['count']}, 'bar', 'jvm time(s)', 'count')
+        report.add_chart(df['time'], {'max_costtime': df['max_costtime'], 'p99_costtime': df['p99_costtime'], 'mean_costtime': df['mean_costtime']}, 'line', 'jvm time(s)', 'costtime(s)')
+        report.add_table(df)
+    report.add_heading('Slowest GC')
+    report.add_table(data['slowest_gcs'])
+    return report.save(file)
+
+# 将gc log对比的数据存为html/json
+def save_compare_gcs_report(file, data, format):
+    if format == 'json':
+        return save_json(file, data)
+    count_df = data['compare_count']
+    costtime_df = data['compare_costtime']
+    report = HtmlReport('JVM GC Compare')
+    report.add_heading('Summary')
+    report.add_table(pd.DataFrame([{'log': k, **v} for k, v in data['summary'].items()]))
+    report.add_heading(f"GC Count per {data['interval']}s")
+    report.add_chart(count_df['time'], {col: count_df[col] for col in count_df.columns[1:]}, 'bar', 'jvm time(s)', 'count')
+    report.add_table(count_df)
+    report.add_heading(f"GC Costtime per {data['interval']}s")
+    report.add_chart(costtime_df['time'], {col: costtime_df[col] for col in costtime_df.columns[1:]}, 'bar', 'jvm time(s)', 'costtime(s)')
+    report.add_table(costtime_df)
+    return report.save(file)
+
+# 解析单个gc log，并返回列式数组，用于在子进程中执行
+def parse_gclog2columns(file):
+    parser = GcLogParser(file)
+    parser.parse()
+    return parser.gcs.to_columns()
+
+# 文件前n个字节的指纹，用于识别文件是否被轮转覆盖
+def file_fingerprint(file, n):
+    data = b''
+    if n > 0:
+        with open(file, 'rb') as f:
+            data = f.read(n)
+    return hashlib.sha1(data).hexdigest()
+
+'''
+跟随gc日志文件集的tail
+    1 从解析器的断点处开始读，解析与tail之间写入的行不会丢
+    2 每次定时读完所有新增的完整行，用二进制文件的tell()推进断点，空行/CRLF/不完整的行都不会算错偏移
+    3 跟随日志轮转: 正在写的文件被重命名(如 gc.log.0.current -> gc.log.0)或重建(如 -Xlog的 gc.log)时，先读完旧文件，再从头读新的正在写的文件
+'''
+class GcLogTail(object):
+
+    def __init__(self, parser, scheduler):
+        '''
+        :param parser: gc日志解析器，已解析过现有的日志
+        :param scheduler: 定时器
+        '''
+        self.parser = parser
+        self.scheduler = scheduler
+        self.callback = None
+        self.path = None # 当前文件
+        self.file = None # 当前文件的二进制句柄
+        self.inode = None
+        if not self.open_current():
+            raise Exception(f"File '{parser.log_file}' does not exist")
+
+    # 打开正在写的文件，从断点处开始读
+    def open_current(self):
+        files = self.parser.rotated_files()
+        if len(files) == 0:
+            return False
+        path = files[-1]
+        file = open(path, 'rb')
+        inode = str(os.fstat(file.fileno()).st_ino)
+        ckpt = self.parser.offsets.get(inode)
+        offset = ckpt['offset'] if ckpt is not None else 0 # 没解析过的新文件从头读
+        file.seek(offset)
+        self.parser.set_offset(inode, offset)
+        if self.file is not None:
+            self.file.close()
+        self.path = path
+        self.file = file
+        self.inode = inode
+        return True
+
+    def follow(self, callback, interval = 1):
+        '''
+        定时读新增的行
+        :param callback: 行的回调，可以是协程函数
+        :param interval: 定时秒数
+        '''
+        self.callback = callback
+        self.scheduler.add_job(self.read_line, 'interval', seconds=interval, id=f'tail:{self.parser.log_file}')
+
+    async def read_line(self):
+        # 1 文件被截断(如copytruncate)，则从头读
+        if os.fstat(self.file.fileno()).st_size < self.file.tell():
+            self.file.seek(0)
+            self.parser.set_offset(self.inode, 0)
+        # 2 读完当前文件
+        await self.read_lines()
+        # 3 轮转了则切到新的正在写的文件
+        if self.is_rotated() and self.open_current():
+            log.info("gc日志轮转, 改为tail文件: %s", self.path)
+            await self.read_lines()
+
+    # 读当前文件的所有新增的完整行
+    async def read_lines(self):
+        while True:
+            line = self.file.readline()
+            if not line:
+                break
+            if not line.endswith(b'\n'): # 不完整的行，退回去留待下次读
+                self.file.seek(-len(line), 1)
+                break
+            self.parser.set_offset(self.inode, self.file.tell())
+            line = line.decode('utf-8', errors='ignore').rstrip('\r\n')
+            if line: # 忽略空行
+                ret = self.callback(line)
+                if asyncio.iscoroutine(ret):
+                    await ret
+
+    # 当前文件是否已不是正在写的文件
+    def is_rotated(self):
+        try:
+            if str(os.stat(self.path).st_ino) == self.inode: # 文件名与inode都没变，大部分时候只需一次stat
+                return False
+        except FileNotFoundError: # 被重命名了
+            pass
+        files = self.parser.rotated_files()
+        return len(files) > 0 and str(os.stat(files[-1]).st_ino) != self.inode
 
 if __name__ == '__main__':
     # file = '../logs/gc2.log'
@@ -373,8 +917,7 @@ if __name__ == '__main__':
     '''
     # 解析文件
     parser.parse()
-    for gc in parser.gcs:
-        print(gc)
+    print(parser.all_gcs())
     # 导出excel
     parser.gcs2xlsx(None, interval=10)
     '''
@@ -393,7 +936,40 @@ if __name__ == '__main__':
     t.follow(handle_line)
     '''
 
-    # 4 对比gc log
+    # 4 测试解析gc行的性能(行/秒)，用于防止性能回退
+    '''
+    import time
+    lines = {
+        'parallel': '0.084: [GC (Allocation Failure) [PSYoungGen: 1525K->512K(1536K)] 3556K->2886K(5632K), 0.0039928 secs] [Times: user=0.01 sys=0.00, real=0.00 secs]',
+        'parallel_full': '2019-03-28T18:09:15.774+0800: 389.142: [Full GC (Ergonomics) [PSYoungGen: 17010K->0K(925184K)] [ParOldGen: 2098093K->2103707K(2776064K)] 2115103K->2103707K(3701248K), [Metaspace: 62299K->62299K(1105920K)], 5.5291426 secs] [Times: user=14.83 sys=0.09, real=5.53 secs]',
+        'cms': '0.064: [GC (Allocation Failure) 0.064: [ParNew: 509K->64K(576K), 0.0032549 secs] 509K->282K(1984K), 0.0033544 secs] [Times: user=0.01 sys=0.00, real=0.00 secs]',
+        'g1': '[2.345s][info][gc] GC(12) Pause Young (Normal) (G1 Evacuation Pause) 24M->4M(256M) 3.456ms',
+        'zgc': '[1.234s][info][gc] GC(3) Garbage Collection (Warmup) 48M(5%)->20M(2%)',
+        'shenandoah': '[1.234s][info][gc] GC(1) Concurrent cleanup 60M->20M(256M) 0.045ms',
+    }
+    n = 100000
+    for format, line in lines.items():
+        parser = GcLogParser(file)
+        start = time.time()
+        for i in range(n):
+            parser.parse_gc_line(line)
+        print(f"parse_gc_line: {format}, {n / (time.time() - start):.0f} lines/sec")
+    '''
+
+    # 5 测试gcs2bins性能: 耗时应与gc数成线性
+    '''
+    import time
+    for n in [100000, 1000000, 2000000, 4000000]:
+        gcs = pd.DataFrame({
+            'jvm_time': np.sort(np.random.uniform(0, 86400 * 3, n)),
+            'costtime': np.random.exponential(0.05, n),
+        })
+        start = time.time()
+        GcLogParser.gcs2bins(gcs, interval=30)
+        print(f"gcs2bins: {n} gcs, {time.time() - start:.3f} secs")
+    '''
+
+    # 6 对比gc log
     '''
     files = [
         '/home/shi/code/testing/kt-test/gc2.log',
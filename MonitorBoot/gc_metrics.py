@@ -0,0 +1,209 @@
+import math
+from collections import deque
+
+# gc的衍生指标的列: 分配速率(MB/s)、晋升速率(MB/s)、gc后的老年代占用(MB)、full gc后老年代占用的增长斜率(MB/h)
+derived_cols = ['alloc_rate', 'promotion_rate', 'old_after', 'old_after_slope']
+
+# gc日志中的年轻代名与老年代名，如旧格式的 [PSYoungGen: 1525K->512K(1536K)]，统一日志的gc,heap行 PSYoungGen: 1525K->512K(1536K)
+young_gens = ('PSYoungGen', 'ParNew', 'DefNew', 'ASParNew')
+old_gens = ('ParOldGen', 'PSOldGen', 'CMS', 'Tenured', 'ASCMS')
+
+# 找gc中的年代名，没有则返回None
+def find_gen(gc, gens):
+    for gen in gens:
+        if gen + '.before' in gc:
+            return gen
+    return None
+
+'''
+HDR风格的gc耗时直方图: 对数-线性分桶，记录是O(1)的，内存固定，相对误差不超过 1/2^sub_bits
+    耗时以微秒为单位，每个2的幂区间再等分为 2^sub_bits 个子桶，如sub_bits=5时 [1024us, 2048us) 的桶宽为32us，误差约3%
+'''
+class PauseHistogram(object):
+
+    def __init__(self, sub_bits = 5, max_bits = 40):
+        '''
+        :param sub_bits: 每个2的幂区间的子桶数的位数，决定精度
+        :param max_bits: 最大耗时(微秒)的位数，2^40us约12天
+        '''
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits
+        self.counts = [0] * ((max_bits - sub_bits + 1) * self.sub_count)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # 微秒数对应的桶
+    def index(self, us):
+        if us < self.sub_count:
+            return us
+        exp = us.bit_length() - 1 - self.sub_bits
+        return min((exp + 1) * self.sub_count + (us >> exp) - self.sub_count, len(self.counts) - 1)
+
+    # 桶的上界(微秒)
+    def upper(self, i):
+        if i < self.sub_count:
+            return i + 1
+        exp = i // self.sub_count - 1
+        return (i % self.sub_count + self.sub_count + 1) << exp
+
+    # 记录耗时(秒)
+    def record(self, secs):
+        us = int(secs * 1000000)
+        if us < self.sub_count:
+            i = us
+        else: # 同 index()，内联以省掉方法调用
+            exp = us.bit_length() - 1 - self.sub_bits
+            i = min((exp + 1) * self.sub_count + (us >> exp) - self.sub_count, len(self.counts) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += secs
+        if secs > self.max:
+            self.max = secs
+
+    def percentile(self, p):
+        '''
+        分位数，取所在桶的上界，但不超过最大值
+        :param p: 百分位，如99
+        :return: 秒数，没有记录则返回None
+        '''
+        if self.count == 0:
+            return None
+        target = max(math.ceil(p / 100 * self.count), 1)
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if total >= target:
+                return min(self.upper(i) / 1000000, self.max)
+        return self.max
+
+'''
+gc的衍生指标，每条gc增量计算，都是O(1)的
+    1 分配速率: 两次gc之间新分配的空间 / 间隔，新分配的空间 = 本次gc前的年轻代 - 上次gc后的年轻代，没有年代信息(如G1/ZGC)则用整个堆
+    2 晋升速率: 年轻代gc中从年轻代晋升到老年代的空间 / 间隔，晋升的空间 = 年轻代减少的 - 整个堆减少的，要有年代信息
+    3 老年代占用的趋势: 最近几次full gc后的老年代占用对时间做线性回归，斜率持续为正说明有内存泄露
+'''
+class GcMetrics(object):
+
+    def __init__(self, slope_window = 20, min_slope_points = 3):
+        '''
+        :param slope_window: 用最近几次full gc做线性回归
+        :param min_slope_points: 至少几次full gc才计算斜率
+        '''
+        self.slope_window = slope_window
+        self.min_slope_points = min_slope_points
+        self.prev = None # 上一条gc，不论类型
+        self.gens = {} # gc名 -> (年轻代名, 老年代名)，同名gc的年代是一样的，不用每次都找
+        # 耗时直方图: None为所有gc, False为年轻代gc, True为full gc
+        self.hists = {None: PauseHistogram(), False: PauseHistogram(), True: PauseHistogram()}
+        # 最新的衍生指标
+        self.alloc_rate = None
+        self.promotion_rate = None
+        self.old_after = None
+        self.old_after_slope = None
+        # 线性回归的点(小时, MB) + 累加和，x以第一个点为原点，以免累加和过大丢精度
+        self.points = deque()
+        self.x0 = None
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def add(self, gc):
+        '''
+        添加gc，计算衍生指标，并写到gc中(不能计算的不写)
+        :param gc: gc信息，空间单位为K
+        '''
+        costtime = gc.get('costtime')
+        # 并发周期的暂停(如G1的Remark/Cleanup): 只计入所有gc的耗时，不算年轻代/full gc，也不参与速率计算
+        if gc.get('is_concurrent'):
+            if costtime is not None and costtime == costtime:
+                self.hists[None].record(costtime)
+            return
+        if costtime is not None and costtime == costtime: # 非nan
+            self.hists[None].record(costtime)
+            self.hists[gc['is_full']].record(costtime)
+
+        prev = self.prev
+        self.prev = gc
+        gens = self.gens.get(gc['name'])
+        if gens is None:
+            gens = self.gens[gc['name']] = (find_gen(gc, young_gens), find_gen(gc, old_gens))
+        young, old = gens
+        # 统一日志的年代信息在单独的行中，个别gc可能缺失(如从gc中间开始tail)
+        if young is not None and young + '.before' not in gc:
+            young = None
+        if old is not None and old + '.after' not in gc:
+            old = None
+        dt = None if prev is None else gc['jvm_time'] - prev['jvm_time']
+        # 1 分配速率
+        if dt is not None and dt > 0:
+            if young is not None and young + '.after' in prev:
+                alloc = gc[young + '.before'] - prev[young + '.after']
+            else:
+                alloc = gc['before'] - prev['after']
+            self.alloc_rate = gc['alloc_rate'] = max(alloc, 0) / 1024 / dt
+        # 2 晋升速率
+        if young is not None and not gc['is_full'] and dt is not None and dt > 0:
+            promoted = (gc[young + '.before'] - gc[young + '.after']) - (gc['before'] - gc['after'])
+            self.promotion_rate = gc['promotion_rate'] = max(promoted, 0) / 1024 / dt
+        # 3 老年代占用
+        if old is not None:
+            old_after = gc[old + '.after']
+        elif young is not None:
+            old_after = gc['after'] - gc[young + '.after']
+        elif gc['is_full']: # 没有年代信息，full gc后年轻代基本是空的
+            old_after = gc['after']
+        else:
+            old_after = None
+        if old_after is not None:
+            self.old_after = gc['old_after'] = old_after / 1024
+            if gc['is_full']:
+                self.add_point(gc['jvm_time'] / 3600, self.old_after)
+        if self.old_after_slope is not None:
+            gc['old_after_slope'] = self.old_after_slope
+
+    # 添加线性回归的点，超过窗口则干掉最旧的点
+    def add_point(self, x, y):
+        if self.x0 is None:
+            self.x0 = x
+        x -= self.x0
+        self.points.append((x, y))
+        self.accumulate(x, y, 1)
+        if len(self.points) > self.slope_window:
+            self.accumulate(*self.points.popleft(), -1)
+        n = len(self.points)
+        d = n * self.sxx - self.sx * self.sx
+        if n >= self.min_slope_points and d > 0:
+            self.old_after_slope = round((n * self.sxy - self.sx * self.sy) / d, 3)
+
+    # 累加(sign=1)或减掉(sign=-1)一个点
+    def accumulate(self, x, y, sign):
+        self.sx += sign * x
+        self.sy += sign * y
+        self.sxx += sign * x * x
+        self.sxy += sign * x * y
+
+    # 所有gc的耗时的50分位
+    @property
+    def pause_p50(self):
+        return self.hists[None].percentile(50)
+
+    # 所有gc的耗时的99分位
+    @property
+    def pause_p99(self):
+        return self.hists[None].percentile(99)
+
+    # 所有gc的最大耗时
+    @property
+    def pause_max(self):
+        hist = self.hists[None]
+        return hist.max if hist.count > 0 else None
+
+    # 年轻代gc的耗时的99分位
+    @property
+    def ygc_p99(self):
+        return self.hists[False].percentile(99)
+
+    # full gc的耗时的99分位
+    @property
+    def fgc_p99(self):
+        return self.hists[True].percentile(99)
+
@@ -0,0 +1,269 @@
+import numpy as np
+import pandas as pd
+from pyutilb import ts
+from MonitorBoot.gc_metrics import derived_cols
+
+# gc记录的基础字段(数值列)
+base_cols = ['before', 'after', 'total', 'costtime', 'jvm_time', 'interval', 'user', 'sys', 'real'] + derived_cols
+
+'''
+可增长的int数组，用于记录年轻代或老年代的gc记录下标
+'''
+class IntArray(object):
+
+    def __init__(self, capacity = 1024):
+        self.data = np.zeros(capacity, dtype=np.int64)
+        self.start = 0 # 第一个有效元素的下标
+        self.size = 0 # 有效元素的结束下标
+
+    def __len__(self):
+        return self.size - self.start
+
+    # 有效元素的视图
+    @property
+    def values(self):
+        return self.data[self.start:self.size]
+
+    def append(self, v):
+        self.extend([v])
+
+    def extend(self, vals):
+        n = len(vals)
+        if self.size + n > len(self.data):
+            self.resize(n)
+        self.data[self.size:self.size + n] = vals
+        self.size += n
+
+    def resize(self, need = 0):
+        '''
+        扩容或压缩: 干掉已无效的前部元素，空间不够则加倍
+        :param need: 需要新增的元素数
+        '''
+        n = len(self)
+        capacity = len(self.data)
+        if n >= capacity // 2:
+            capacity *= 2
+        while capacity < n + need:
+            capacity *= 2
+        data = np.zeros(capacity, dtype=np.int64)
+        data[:n] = self.values
+        self.data = data
+        self.start = 0
+        self.size = n
+
+    # 干掉 < v 的元素，元素是递增的
+    def trim_below(self, v):
+        self.start += int(np.searchsorted(self.values, v, 'left'))
+
+    # 所有元素偏移
+    def shift(self, delta):
+        self.values[:] += delta
+
+'''
+gc记录的列式存储
+    1 每个字段一个可增长的numpy数组，而不是每个gc一个dict
+    2 gc名与年代名驻留在名字表中，列中只存id
+    3 年轻代与老年代的gc各有一个下标索引，并发周期的暂停只在全部记录中
+    4 支持保留窗口(按条数或秒数)，以便长期运行时内存有界
+'''
+class GcStore(object):
+
+    def __init__(self, max_count = None, max_seconds = None, capacity = 1024, buffer_size = 256):
+        '''
+        :param max_count: 最多保留多少条gc记录
+        :param max_seconds: 最多保留多少秒(jvm time)内的gc记录
+        :param capacity: 初始容量
+        :param buffer_size: 写缓冲的大小，攒够一批记录再批量写入列中，避免逐个元素赋值的开销
+        '''
+        self.max_count = max_count
+        self.max_seconds = max_seconds
+        self.capacity = capacity
+        self.buffer_size = buffer_size
+        self.buffer = [] # 写缓冲: 尚未写入列的gc记录
+        self.start = 0 # 第一条保留的记录的下标
+        self.size = 0 # 记录的结束下标
+        # 基础字段的列
+        self.cols = {col: np.full(capacity, np.nan) for col in base_cols}
+        self.is_full = np.zeros(capacity, dtype=bool)
+        self.name_ids = np.zeros(capacity, dtype=np.int32)
+        # gc名的驻留表
+        self.names = []
+        self.name2id = {}
+        # 年代名的驻留表 + 年代字段的列, 如 PSYoungGen.before
+        self.gen_names = []
+        self.gen_cols = {}
+        # 年轻代与老年代的gc记录下标
+        self.young_idx = IntArray()
+        self.full_idx = IntArray()
+
+    def __len__(self):
+        self.flush()
+        return self.size - self.start
+
+    # 驻留gc名
+    def intern_name(self, name):
+        id = self.name2id.get(name)
+        if id is None:
+            id = self.name2id[name] = len(self.names)
+            self.names.append(name)
+        return id
+
+    # 获得年代字段的列，没有则创建
+    def gen_col(self, key):
+        col = self.gen_cols.get(key)
+        if col is None:
+            gen = key.split('.', 1)[0]
+            if gen not in self.gen_names:
+                self.gen_names.append(gen)
+            col = self.gen_cols[key] = np.full(self.capacity, np.nan)
+        return col
+
+    def append(self, gc):
+        '''
+        添加gc记录: 先放到写缓冲，攒够一批再写入列中
+        :param gc: 单个gc的dict，年代字段已展平，如 PSYoungGen.before
+        '''
+        self.buffer.append(gc)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    # 将写缓冲中的记录批量写入列中
+    def flush(self):
+        rows = self.buffer
+        n = len(rows)
+        if n == 0:
+            return
+        self.buffer = []
+        if self.size + n > self.capacity:
+            self.resize(n)
+        i = self.size
+        j = i + n
+        # 1 基础字段
+        for col in base_cols:
+            self.cols[col][i:j] = [row.get(col, np.nan) for row in rows]
+        is_full = np.array([bool(row['is_full']) for row in rows])
+        self.is_full[i:j] = is_full
+        self.name_ids[i:j] = [self.intern_name(row['name']) for row in rows]
+        # 2 年代字段: 同一类gc的字段是一样的，先按字段组合分组，再按组批量赋值
+        groups = {}
+        for k, row in enumerate(rows):
+            keys = tuple(row)
+            group = groups.get(keys)
+            if group is None:
+                group = groups[keys] = []
+            group.append(k)
+        for keys, ks in groups.items():
+            group = [rows[k] for k in ks]
+            idx = np.array(ks) + i
+            for key in keys:
+                if '.' in key:
+                    self.gen_col(key)[idx] = [row[key] for row in group]
+        # 3 年轻代与老年代的下标，并发周期的暂停(如G1的Remark/Cleanup)两者都不算
+        idx = np.arange(i, j)
+        is_concurrent = np.array([bool(row.get('is_concurrent')) for row in rows])
+        self.full_idx.extend(idx[is_full])
+        self.young_idx.extend(idx[~is_full & ~is_concurrent])
+        self.size = j
+        # 按保留窗口淘汰旧记录
+        self.retain()
+
+    # 修改最后一条记录的字段值，如统一日志中后续行的cpu时间
+    def set_last(self, vals):
+        if len(self.buffer) > 0:
+            self.buffer[-1].update(vals)
+            return
+        if self.size == self.start:
+            return
+        for col, val in vals.items():
+            self.cols[col][self.size - 1] = val
+
+    def resize(self, need = 0):
+        '''
+        扩容或压缩: 干掉已淘汰的前部记录，空间不够则加倍
+        :param need: 需要新增的记录数
+        '''
+        n = self.size - self.start
+        capacity = self.capacity
+        if n >= capacity // 2:
+            capacity *= 2
+        while capacity < n + need:
+            capacity *= 2
+        start = self.start
+        def copy(arr, fill):
+            arr2 = np.full(capacity, fill, dtype=arr.dtype)
+            arr2[:n] = arr[start:self.size]
+            return arr2
+        self.cols = {k: copy(v, np.nan) for k, v in self.cols.items()}
+        self.gen_cols = {k: copy(v, np.nan) for k, v in self.gen_cols.items()}
+        self.is_full = copy(self.is_full, False)
+        self.name_ids = copy(self.name_ids, 0)
+        self.young_idx.shift(-start)
+        self.full_idx.shift(-start)
+        self.capacity = capacity
+        self.start = 0
+        self.size = n
+
+    # 按保留窗口淘汰旧记录：只是移动start，空间在扩容时回收
+    def retain(self):
+        start = self.start
+        if self.max_count is not None and self.size - self.start > self.max_count:
+            start = self.size - self.max_count
+        if self.max_seconds is not None:
+            jvm_times = self.cols['jvm_time']
+            cutoff = jvm_times[self.size - 1] - self.max_seconds
+            start = max(start, self.start + int(np.searchsorted(jvm_times[self.start:self.size], cutoff, 'left')))
+        if start != self.start:
+            self.start = start
+            self.young_idx.trim_below(start)
+            self.full_idx.trim_below(start)
+
+    def to_df(self, is_full = None):
+        '''
+        导出为DataFrame
+        :param is_full: None表示所有gc(只有基础字段，含并发周期的暂停)，True表示full gc，False表示minor gc(有基础字段+年代字段)
+        :return:
+        '''
+        self.flush()
+        if is_full is None: # 切片是视图，不复制
+            idx = slice(self.start, self.size)
+        elif is_full:
+            idx = self.full_idx.values
+        else:
+            idx = self.young_idx.values
+        data = {'name': pd.Categorical.from_codes(self.name_ids[idx], self.names)}
+        for col in base_cols:
+            data[col] = self.cols[col][idx]
+        if is_full is not None:
+            for key, col in self.gen_cols.items():
+                col = col[idx]
+                if not np.isnan(col).all(): # 忽略该类gc没有的年代
+                    data[key] = col
+        return pd.DataFrame(data, copy=False)
+
+    def to_columns(self):
+        '''
+        导出为紧凑的列式数组(只有基础字段)，用于跨进程传递，比传递dict的list序列化开销小得多
+        :return: dict, 包含 names(gc名表), name_ids(gc名id列), 以及各基础字段的列
+        '''
+        self.flush()
+        idx = slice(self.start, self.size)
+        ret = {col: self.cols[col][idx] for col in base_cols}
+        ret['name_ids'] = self.name_ids[idx]
+        ret['names'] = self.names
+        return ret
+
+# 将列式数组转为DataFrame，是 GcStore.to_columns() 的逆操作
+def columns2df(columns):
+    data = {'name': pd.Categorical.from_codes(columns['name_ids'], columns['names'])}
+    for col in base_cols:
+        data[col] = columns[col]
+    return pd.DataFrame(data, copy=False)
+
+# 解析保留窗口: 数字表示条数(如100000)，带时间单位表示秒数(如7d/12h/30m)
+def parse_retention(retention):
+    if retention is None or retention == '':
+        return None, None
+    retention = str(retention).strip()
+    if retention.isdigit():
+        return int(retention), None
+    return None, ts.age2seconds(retention)
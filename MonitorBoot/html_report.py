@@ -0,0 +1,240 @@
+import html
+import json
+import math
+import os
+import numpy as np
+import pandas as pd
+from pyutilb import ts
+
+# 支持的报告格式
+report_formats = ['xlsx', 'html', 'json']
+
+# 曲线的颜色
+colors = ['#4e79a7', '#e15759', '#f28e2b', '#59a14f', '#76b7b2', '#b07aa1', '#edc948']
+
+# 每条曲线最多画多少个点，多了就降采样
+max_points = 1000
+
+# 表格最多输出多少行
+max_rows = 200
+
+# 检查报告格式
+def check_format(format):
+    format = format or 'xlsx'
+    if format not in report_formats:
+        raise Exception(f"无效的报告格式: {format}, 仅支持: {', '.join(report_formats)}")
+    return format
+
+# 报告文件名: 前缀-时间.格式
+def report_file(filename_pref, format):
+    now = ts.now2str("%Y%m%d%H%M%S")
+    return f'{filename_pref}-{now}.{format}'
+
+def downsample(x, y, max_points = max_points):
+    '''
+    降采样: 将点按顺序等分为 max_points/2 个桶，每桶保留y最小与最大的点，这样gc暂停的毛刺不会被平均掉
+    :param x: x值，要有序
+    :param y: y值
+    :param max_points: 最多保留多少个点
+    :return: (x, y) 的numpy数组
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if not valid.all():
+        x = x[valid]
+        y = y[valid]
+    n = len(x)
+    if n <= max_points:
+        return x, y
+    # 补nan后变形为 行数*桶大小 的矩阵，按行求最值的下标
+    size = math.ceil(n / (max_points // 2))
+    rows = math.ceil(n / size)
+    padded = np.full(rows * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(rows, size)
+    base = np.arange(rows) * size
+    idx = np.unique(np.concatenate([base + np.nanargmin(padded, axis=1), base + np.nanargmax(padded, axis=1)]))
+    return x[idx], y[idx]
+
+# 刻度: 将[lo, hi]划分为约n段，步长取1/2/2.5/5的10的幂倍
+def nice_ticks(lo, hi, n = 5):
+    if not hi > lo:
+        hi = lo + 1
+    step = (hi - lo) / n
+    mag = 10 ** math.floor(math.log10(step))
+    for m in (1, 2, 2.5, 5, 10):
+        if step <= m * mag:
+            step = m * mag
+            break
+    start = math.floor(lo / step)
+    end = math.ceil(hi / step)
+    return [round(i * step, 10) for i in range(start, end + 1)]
+
+# 格式化数值
+def format_num(v):
+    if isinstance(v, (float, np.floating)):
+        if math.isnan(v):
+            return ''
+        return '%.4g' % v if abs(v) < 1e4 else '%.0f' % v
+    return str(v)
+
+def svg_chart(x, series, kind = 'line', xlabel = '', ylabel = '', width = 960, height = 280):
+    '''
+    生成svg图表
+    :param x: x值
+    :param series: 曲线名 -> y值，或 (x值, y值) 以便各曲线的x不同
+    :param kind: 图表类型: line(折线)/scatter(散点)/bar(柱状)
+    :param xlabel: x轴名
+    :param ylabel: y轴名
+    :param width: 宽
+    :param height: 高
+    :return: svg的html
+    '''
+    left, right, top, bottom = 64, 16, 10, 36
+    plot_w = width - left - right
+    plot_h = height - top - bottom
+    series = {name: y if isinstance(y, tuple) else (x, y) for name, y in series.items()}
+    # 柱子太多就画成折线
+    if kind == 'bar' and max(len(px) for px, _ in series.values()) > max_points // 4:
+        kind = 'line'
+    if kind == 'bar':
+        points = {name: (np.asarray(px, dtype=float), np.nan_to_num(np.asarray(py, dtype=float))) for name, (px, py) in series.items()}
+    else:
+        points = {name: downsample(px, py) for name, (px, py) in series.items()}
+    xs = np.concatenate([p[0] for p in points.values()] + [np.zeros(0)])
+    ys = np.concatenate([p[1] for p in points.values()] + [np.zeros(0)])
+    if len(xs) == 0:
+        return '<p class="empty">无数据</p>'
+    xticks = nice_ticks(float(xs.min()), float(xs.max()))
+    yticks = nice_ticks(min(0.0, float(ys.min())), float(ys.max()))
+    x0, x1, y0, y1 = xticks[0], xticks[-1], yticks[0], yticks[-1]
+    sx = lambda v: left + (v - x0) / (x1 - x0) * plot_w
+    sy = lambda v: top + plot_h - (v - y0) / (y1 - y0) * plot_h
+
+    out = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">']
+    # 网格与刻度
+    for t in yticks:
+        y = sy(t)
+        out.append(f'<line class="grid" x1="{left}" y1="{y:.1f}" x2="{left + plot_w}" y2="{y:.1f}"/>')
+        out.append(f'<text x="{left - 6}" y="{y + 4:.1f}" text-anchor="end">{format_num(t)}</text>')
+    for t in xticks:
+        x = sx(t)
+        out.append(f'<text x="{x:.1f}" y="{top + plot_h + 16}" text-anchor="middle">{format_num(t)}</text>')
+    out.append(f'<line class="axis" x1="{left}" y1="{top + plot_h}" x2="{left + plot_w}" y2="{top + plot_h}"/>')
+    if xlabel:
+        out.append(f'<text x="{left + plot_w / 2:.1f}" y="{height - 4}" text-anchor="middle">{html.escape(xlabel)}</text>')
+    if ylabel:
+        out.append(f'<text x="12" y="{top + plot_h / 2:.1f}" text-anchor="middle" transform="rotate(-90 12 {top + plot_h / 2:.1f})">{html.escape(ylabel)}</text>')
+    # 曲线
+    bar_w = 0
+    if kind == 'bar':
+        n = max(len(p[0]) for p in points.values())
+        bar_w = max(plot_w / max(n, 1) * 0.8 / len(points), 1)
+    for i, (name, (px, py)) in enumerate(points.items()):
+        color = colors[i % len(colors)]
+        if kind == 'line':
+            coords = ' '.join(f'{sx(a):.1f},{sy(b):.1f}' for a, b in zip(px, py))
+            out.append(f'<polyline fill="none" stroke="{color}" stroke-width="1.2" points="{coords}"/>')
+        elif kind == 'scatter':
+            out.extend(f'<circle cx="{sx(a):.1f}" cy="{sy(b):.1f}" r="1.8" fill="{color}"/>' for a, b in zip(px, py))
+        else:
+            base = sy(max(y0, 0))
+            for a, b in zip(px, py):
+                bx = sx(a) - bar_w * len(points) / 2 + bar_w * i
+                by = sy(b)
+                out.append(f'<rect x="{bx:.1f}" y="{min(by, base):.1f}" width="{bar_w:.1f}" height="{abs(base - by):.1f}" fill="{color}"><title>{format_num(a)}: {format_num(b)}</title></rect>')
+    out.append('</svg>')
+    # 图例
+    legend = ''.join(f'<span class="legend"><i style="background:{colors[i % len(colors)]}"></i>{html.escape(str(name))}</span>' for i, name in enumerate(points))
+    return f'<div class="chart">{legend}<br/>{"".join(out)}</div>'
+
+# DataFrame转html表格
+def table_html(df, limit = max_rows):
+    head = ''.join(f'<th>{html.escape(str(col))}</th>' for col in df.columns)
+    rows = []
+    for row in df.head(limit).itertuples(index=False):
+        rows.append('<tr>' + ''.join(f'<td>{html.escape(format_num(v))}</td>' for v in row) + '</tr>')
+    more = f'<p class="more">只显示前{limit}行，共{len(df)}行</p>' if len(df) > limit else ''
+    return f'<table><thead><tr>{head}</tr></thead><tbody>{"".join(rows)}</tbody></table>{more}'
+
+# 报告的样式
+css = '''
+body { font-family: -apple-system, "Segoe UI", "Microsoft YaHei", sans-serif; margin: 20px; color: #333; }
+h1 { font-size: 22px; } h2 { font-size: 18px; border-bottom: 1px solid #ddd; padding-bottom: 4px; margin-top: 28px; }
+table { border-collapse: collapse; font-size: 12px; margin: 8px 0; }
+th { background: lightskyblue; } th, td { border: 1px solid #ccc; padding: 2px 6px; text-align: right; white-space: nowrap; }
+svg text { font-size: 11px; fill: #555; } .grid { stroke: #eee; } .axis { stroke: #999; }
+.legend { font-size: 12px; margin-right: 12px; } .legend i { display: inline-block; width: 10px; height: 10px; margin-right: 4px; }
+.chart { margin: 8px 0; } .more, .empty { font-size: 12px; color: #999; }
+'''
+
+'''
+自包含的html报告: 图表是内联的svg，无需js与外部资源，浏览器直接打开
+'''
+class HtmlReport(object):
+
+    def __init__(self, title):
+        self.title = title
+        self.parts = []
+
+    # 章节标题
+    def add_heading(self, text):
+        self.parts.append(f'<h2>{html.escape(text)}</h2>')
+
+    # 键值对的摘要
+    def add_summary(self, summary):
+        rows = ''.join(f'<tr><th>{html.escape(str(k))}</th><td>{html.escape(format_num(v))}</td></tr>' for k, v in summary.items())
+        self.parts.append(f'<table>{rows}</table>')
+
+    # 图表
+    def add_chart(self, x, series, kind = 'line', xlabel = '', ylabel = ''):
+        self.parts.append(svg_chart(x, series, kind, xlabel, ylabel))
+
+    # 表格
+    def add_table(self, df, limit = max_rows):
+        self.parts.append(table_html(df, limit))
+
+    def render(self):
+        title = html.escape(self.title)
+        return f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"/><title>{title}</title><style>{css}</style></head>\n<body><h1>{title}</h1>\n' + '\n'.join(self.parts) + '\n</body></html>\n'
+
+    # 保存到文件
+    def save(self, file):
+        write_text(file, self.render())
+        return file
+
+# 转为json可序列化的值
+def to_json_val(v):
+    if isinstance(v, dict):
+        return {str(k): to_json_val(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [to_json_val(x) for x in v]
+    if isinstance(v, pd.DataFrame):
+        return df2records(v)
+    if isinstance(v, np.ndarray):
+        return [to_json_val(x) for x in v.tolist()]
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, float) and (math.isnan(v) or math.isinf(v)): # json不支持nan
+        return None
+    return v
+
+# DataFrame转记录的list
+def df2records(df, limit = None):
+    if limit is not None:
+        df = df.head(limit)
+    return [{str(k): to_json_val(v) for k, v in zip(df.columns, row)} for row in df.itertuples(index=False)]
+
+# 保存json文件
+def save_json(file, data):
+    write_text(file, json.dumps(to_json_val(data), ensure_ascii=False, indent=2))
+    return file
+
+# 写文本文件，没有目录则创建
+def write_text(file, text):
+    dir = os.path.dirname(file)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write(text)
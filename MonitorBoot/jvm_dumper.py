@@ -0,0 +1,282 @@
+import asyncio
+import gzip
+import os
+import shutil
+import signal
+import psutil
+from pyutilb import ts
+from pyutilb.file import file_size2bytes
+from pyutilb.log import log
+from MonitorBoot.csv_writer import compress_exts
+
+# 配置
+config = {
+    'tool': 'jcmd', # dump工具: jcmd(jcmd GC.heap_dump/Thread.print) 或 jmap(jmap -dump/jstack)
+    'heap_compress': 'gzip', # 堆快照的压缩格式: gzip/zstd/None
+    'thread_compress': None, # 线程栈的压缩格式: gzip/zstd/None
+    'compress_level': 1, # 压缩级别，堆快照很大，默认用最快的级别
+    'live': True, # 堆快照是否只dump存活对象(会先触发full gc)
+    'heap_timeout': 600, # 堆快照的超时秒数
+    'thread_timeout': 30, # 线程栈的超时秒数
+    'heap_settle': 5, # 堆快照失败(如超时)后，jvm可能还在写文件，要等文件多少秒不再增长才删掉
+    'quota': '20G', # dump根目录下(含告警目录)dump文件的总大小上限，超了则先删最旧的dump文件，None为不限
+    'dump_root': None, # 配额作用的dump根目录，统计其下与其子目录(如每次告警新建的告警目录)中的dump文件，None为当前目录
+    'min_free': '1G', # dump后磁盘至少要剩余的空间
+    'convoy_waiters': 3, # 锁至少有几个线程排队，才算锁护航
+    'convoy_dumps': 2, # 锁至少在连续几次线程栈中都有排队，才算锁护航
+}
+
+# dump文件名中的后缀
+dump_exts = ('.hprof', '.tdump')
+
+# 执行dump工具超时
+class ToolTimeoutException(Exception):
+    pass
+
+# 正在执行的dump: (类型, pid)，同一进程同时只执行一个同类dump，以免超时的dump堆积
+_running = set()
+
+# 配置dump
+def config_dump(config2):
+    config.update(config2 or {})
+
+# 文件大小转为字节数，如 20G
+def to_bytes(size):
+    if size is None or isinstance(size, (int, float)):
+        return size
+    return int(file_size2bytes(str(size).strip().upper()))
+
+# 打开写的文件，支持压缩
+def open_write(file, compress = None):
+    if compress is None:
+        return open(file, 'wb')
+    level = int(config.get('compress_level', 1))
+    if compress == 'gzip':
+        return gzip.open(file, 'wb', compresslevel=level)
+    if compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd压缩要先安装zstandard: pip install zstandard")
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(file, 'wb'))
+    raise Exception(f"无效的压缩格式: {compress}")
+
+# 压缩文件: 流式读写，内存占用与文件大小无关
+def compress_file(src, dst, compress):
+    with open(src, 'rb') as fin, open_write(dst, compress) as fout:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+
+# 根目录及其子目录(如告警目录，只扫一层)下的dump文件: [(修改时间, 大小, 文件)]，按修改时间排序
+def list_dumps(root):
+    ret = []
+    dirs = [root]
+    for dir in dirs:
+        try:
+            entries = list(os.scandir(dir))
+        except OSError: # 目录已被删掉
+            continue
+        for entry in entries:
+            if entry.is_file() and any(ext in entry.name for ext in dump_exts):
+                st = entry.stat()
+                ret.append((st.st_mtime, st.st_size, entry.path))
+            elif dir == root and entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+    return sorted(ret)
+
+# 配额作用的dump根目录: dump目录不在配置的根目录下，则以dump目录为根
+def dump_root(dir):
+    root = os.path.abspath(config.get('dump_root') or '.')
+    if os.path.commonpath([root, dir]) != root:
+        return dir
+    return root
+
+def prepare_space(dir, need):
+    '''
+    dump前准备磁盘空间: 超过配额则先删最旧的dump文件(跨根目录下的所有告警目录)，再检查剩余空间是否足够
+    :param dir: dump目录
+    :param need: dump要占用的字节数
+    '''
+    quota = to_bytes(config.get('quota'))
+    if quota is not None:
+        root = dump_root(dir)
+        dumps = list_dumps(root)
+        total = sum(size for _, size, _ in dumps)
+        for _, size, file in dumps:
+            if total + need <= quota:
+                break
+            log.warning("dump根目录[%s]超过配额%s, 删除最旧的dump文件: %s", root, config.get('quota'), file)
+            os.remove(file)
+            total -= size
+    min_free = to_bytes(config.get('min_free')) or 0
+    free = shutil.disk_usage(dir).free
+    if free - need < min_free:
+        raise Exception(f"磁盘空间不足: 目录[{dir}]剩余{free // 1024 // 1024}M, 预计要占用{need // 1024 // 1024}M, 要保留{min_free // 1024 // 1024}M")
+
+# dump文件名: 前缀-时间.后缀[.压缩后缀]，并创建目录
+def dump_file(filename_pref, ext, compress):
+    now = ts.now2str("%Y%m%d%H%M%S")
+    file = os.path.abspath(f'{filename_pref}-{now}{ext}{compress_exts[compress]}') # 绝对路径: jcmd/jmap是由目标jvm来写文件，相对路径是相对jvm的工作目录
+    # 同一秒内多次dump则加序号，以免覆盖
+    i = 1
+    while os.path.exists(file):
+        file = os.path.abspath(f'{filename_pref}-{now}-{i}{ext}{compress_exts[compress]}')
+        i += 1
+    dir = os.path.dirname(file)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    return file, dir
+
+async def run_tool(args, timeout, stdout = None):
+    '''
+    执行jdk工具，超时则杀掉，以免卡住的jmap越积越多
+    :param args: 命令参数
+    :param timeout: 超时秒数
+    :param stdout: 标准输出的处理协程函数，参数为输出流，为空则返回输出
+    :return: 标准输出
+    '''
+    # 新会话: 超时时杀掉整个进程组，子进程也不会残留并占着输出管道
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    try:
+        if stdout is None:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        else:
+            _, err, _ = await asyncio.wait_for(asyncio.gather(stdout(proc.stdout), proc.stderr.read(), proc.wait()), timeout)
+            out = b''
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        raise ToolTimeoutException(f"执行命令超时({timeout}秒): {' '.join(args)}")
+    if proc.returncode != 0:
+        raise Exception(f"执行命令失败({proc.returncode}): {' '.join(args)}\n{(err or out).decode(errors='replace')}")
+    return out.decode(errors='replace')
+
+async def dump_heap(pid, filename_pref):
+    '''
+    导出jvm堆快照
+        1 dump前按进程内存估算快照大小，检查磁盘空间+配额
+        2 jcmd + gzip 时用jvm自带的压缩(jdk15+的 GC.heap_dump -gz)，不产生未压缩的文件；不支持(jdk9~14的jcmd报错退出)则先dump再流式压缩，然后删掉未压缩的文件
+    :param pid: 进程id
+    :param filename_pref: 文件名前缀
+    :return: 导出的文件
+    '''
+    pid = int(pid)
+    key = ('heap', pid)
+    if key in _running:
+        raise Exception(f"进程[{pid}]的堆快照正在导出中")
+    _running.add(key)
+    file = raw = None
+    started = False # 是否已执行dump工具
+    try:
+        compress = config.get('heap_compress')
+        file, dir = dump_file(filename_pref, '.hprof', compress)
+        jcmd = config.get('tool', 'jcmd') == 'jcmd'
+        live = config.get('live', True)
+        timeout = float(config.get('heap_timeout', 600))
+        # 快照大小不超过进程的常驻内存
+        expected = psutil.Process(pid).memory_info().rss
+        # 1 jvm自带压缩
+        if jcmd and compress == 'gzip':
+            prepare_space(dir, expected // 2)
+            started = True
+            try:
+                out = await run_tool(['jcmd', str(pid), 'GC.heap_dump'] + ([] if live else ['-all']) + [f"-gz={config.get('compress_level', 1)}", file], timeout)
+                if os.path.exists(file):
+                    return file
+            except ToolTimeoutException: # 超时不是不支持-gz，不能再dump一次
+                raise
+            except Exception as ex: # jdk9~14的jcmd不认识-gz选项，退出码非0
+                out = str(ex)
+                remove_files([file])
+            log.warning("jcmd不支持-gz压缩, 改为先dump再压缩: %s", out.strip())
+        # 2 先dump未压缩的文件
+        prepare_space(dir, expected)
+        raw = file if compress is None else file[:-len(compress_exts[compress])]
+        started = True
+        if jcmd:
+            out = await run_tool(['jcmd', str(pid), 'GC.heap_dump'] + ([] if live else ['-all']) + [raw], timeout)
+        else:
+            out = await run_tool(['jmap', f"-dump:{'live,' if live else ''}format=b,file={raw}", str(pid)], timeout)
+        if not os.path.exists(raw): # jcmd失败时退出码也可能是0，错误在输出中
+            raise Exception(f"导出jvm堆快照失败: {out.strip()}")
+        # 3 再在线程中流式压缩
+        if compress is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, compress_file, raw, file, compress)
+            finally:
+                os.remove(raw)
+        return file
+    except Exception:
+        # 删掉不完整的文件: 超时只杀掉了jcmd/jmap，jvm可能还在写，要等写完再删，期间仍占着该进程的dump，以免并发dump
+        if started:
+            await wait_settled([file, raw], float(config.get('heap_settle', 5)))
+        remove_files([file, raw])
+        raise
+    finally:
+        _running.discard(key)
+
+# 等待文件不再增长: 连续settle秒大小不变
+async def wait_settled(files, settle):
+    files = [f for f in dict.fromkeys(files) if f is not None]
+    sizes = None
+    while True:
+        sizes2 = [os.path.getsize(f) if os.path.exists(f) else -1 for f in files]
+        if sizes2 == sizes:
+            return
+        sizes = sizes2
+        await asyncio.sleep(settle)
+
+# 删掉文件，忽略不存在的
+def remove_files(files):
+    for file in dict.fromkeys(files):
+        if file is not None and os.path.exists(file):
+            log.warning("删除不完整的dump文件: %s", file)
+            os.remove(file)
+
+# 打印jvm线程栈，不写文件，用于采样
+async def thread_print(pid):
+    if config.get('tool', 'jcmd') == 'jcmd':
+        args = ['jcmd', str(pid), 'Thread.print']
+    else:
+        args = ['jstack', str(pid)]
+    return await run_tool(args, float(config.get('thread_timeout', 30)))
+
+async def dump_thread(pid, filename_pref):
+    '''
+    导出jvm线程栈: 边读jcmd/jstack的输出边写文件(可压缩)
+    :param pid: 进程id
+    :param filename_pref: 文件名前缀
+    :return: 导出的文件
+    '''
+    pid = int(pid)
+    key = ('thread', pid)
+    if key in _running:
+        raise Exception(f"进程[{pid}]的线程栈正在导出中")
+    _running.add(key)
+    try:
+        compress = config.get('thread_compress')
+        file, dir = dump_file(filename_pref, '.tdump', compress)
+        prepare_space(dir, 0)
+        if config.get('tool', 'jcmd') == 'jcmd':
+            args = ['jcmd', str(pid), 'Thread.print', '-l']
+        else:
+            args = ['jstack', '-l', str(pid)]
+        f = open_write(file, compress)
+        async def copy(stream):
+            while True:
+                chunk = await stream.read(64 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+        try:
+            await run_tool(args, float(config.get('thread_timeout', 30)), copy)
+        except Exception:
+            f.close()
+            os.remove(file) # 删掉不完整的文件
+            raise
+        f.close()
+        return file
+    finally:
+        _running.discard(key)
@@ -0,0 +1,278 @@
+import json
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from pyutilb import ts
+from pyutilb.log import log
+from MonitorBoot.gc_metrics import derived_cols
+
+# 系统指标的列
+sys_cols = ['cpu_percent', 'mem_percent', 'mem_used', 'mem_free', 'disk_read', 'disk_write', 'net_sent', 'net_recv']
+# 进程指标的列
+proc_cols = ['pid', 'cpu_percent', 'mem_used', 'mem_rss', 'mem_pss', 'mem_percent', 'disk_read', 'disk_write']
+# gc记录的列
+gc_cols = ['is_full', 'jvm_time', 'costtime', 'interval', 'before', 'after', 'total', 'user', 'sys', 'real']
+# gc的衍生指标的列，单独一个序列，以免已有的gc序列的列变了
+gc_metric_cols = ['is_full', 'jvm_time'] + derived_cols
+
+'''
+指标序列: 追加写的定长二进制文件，每天一个文件，每条记录是 time + 各列 的float64
+   1 定长记录可以直接用numpy内存映射读取，不用解析文本
+   2 记录按时间追加，time列是有序的，因此时间范围查询只需二分查找，文件名中的日期则用于跳过范围外的文件
+   3 写入有缓冲，每flush_rows行或每flush_seconds秒才追加到文件
+   4 进程崩溃导致的不完整的末尾记录在读取时被忽略，在追加前被截掉，以免后续记录错位
+'''
+class MetricSeries(object):
+
+    def __init__(self, dir, cols, flush_rows = 60, flush_seconds = 10):
+        '''
+        :param dir: 序列的目录
+        :param cols: 列名(不含time列)
+        :param flush_rows: 每攒多少行追加到文件一次
+        :param flush_seconds: 最多隔多少秒追加到文件一次
+        '''
+        self.dir = dir
+        self.cols = list(cols)
+        self.dtype = np.dtype([(col, '<f8') for col in ['time'] + self.cols])
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.buffer = [] # 写缓冲: 记录的tuple
+        self.flush_time = time.time()
+        self.last_time = 0 # 最后一条记录的时间，用于保证time列有序
+        self.day = None # 当前文件的日期
+        self.fp = None
+        self.check_schema()
+
+    # 检查或保存列名: 同一序列的列名不能变，否则旧文件无法读取
+    def check_schema(self):
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        file = os.path.join(self.dir, 'schema.json')
+        if os.path.exists(file):
+            with open(file, 'r', encoding='utf-8') as f:
+                cols = json.load(f)['cols']
+            if cols != self.cols:
+                raise Exception(f"指标序列[{self.dir}]的列已存在且不同: {cols}")
+        else:
+            with open(file, 'w', encoding='utf-8') as f:
+                json.dump({'cols': self.cols}, f)
+        # 最后一条记录的时间: 先截掉不完整的末尾记录，再从对齐的数据中读
+        files = self.day_files()
+        if len(files) > 0:
+            self.truncate_torn(files[-1][1])
+            data = self.mmap(files[-1][1])
+            if len(data) > 0:
+                self.last_time = float(data['time'][-1])
+
+    def append(self, vals, now = None):
+        '''
+        追加一条记录
+        :param vals: 各列的值，dict或list，缺的值为nan
+        :param now: 记录时间，默认当前时间
+        '''
+        now = max(now or time.time(), self.last_time) # 时间不能倒退，否则二分查找失效
+        self.last_time = now
+        if isinstance(vals, dict):
+            vals = [vals.get(col) for col in self.cols]
+        self.buffer.append((now, *(np.nan if v is None else float(v) for v in vals)))
+        if len(self.buffer) >= self.flush_rows or now - self.flush_time >= self.flush_seconds:
+            self.flush()
+
+    # 将写缓冲追加到文件: 一批记录可能跨天，按天分组
+    def flush(self):
+        self.flush_time = time.time()
+        if len(self.buffer) == 0:
+            return
+        rows = np.array(self.buffer, dtype=self.dtype)
+        self.buffer = []
+        times = rows['time']
+        first_day = ts.timestamp2str(times[0], '%Y-%m-%d')
+        if first_day == ts.timestamp2str(times[-1], '%Y-%m-%d'): # 大部分批次都不跨天，不用逐条算日期
+            self.write_day(first_day, rows)
+        else:
+            days = np.array([ts.timestamp2str(t, '%Y-%m-%d') for t in times])
+            for day in dict.fromkeys(days): # 有序去重
+                self.write_day(day, rows[days == day])
+        self.fp.flush()
+
+    # 追加某天的记录
+    def write_day(self, day, rows):
+        if day != self.day:
+            self.open(day)
+        rows.tofile(self.fp)
+
+    # 打开某天的文件
+    def open(self, day):
+        self.close_file()
+        self.day = day
+        file = os.path.join(self.dir, f'{day}.bin')
+        self.truncate_torn(file)
+        self.fp = open(file, 'ab')
+
+    # 截掉不完整的末尾记录(如进程崩溃时写了一半)，否则之后追加的记录都会错位
+    def truncate_torn(self, file):
+        if not os.path.exists(file):
+            return
+        size = os.path.getsize(file)
+        aligned = size - size % self.dtype.itemsize
+        if aligned != size:
+            log.warning("指标文件[%s]的末尾记录不完整, 截掉%s字节", file, size - aligned)
+            os.truncate(file, aligned)
+
+    def close_file(self, fsync = False):
+        if self.fp is None:
+            return
+        self.fp.flush()
+        if fsync:
+            os.fsync(self.fp.fileno())
+        self.fp.close()
+        self.fp = None
+        self.day = None
+
+    # 关闭: 刷盘+fsync
+    def close(self):
+        self.flush()
+        self.close_file(True)
+
+    # 所有的日期文件: [(日期, 文件)]，按日期排序
+    def day_files(self):
+        ret = []
+        for file in os.listdir(self.dir):
+            if file.endswith('.bin'):
+                ret.append((file[:-4], os.path.join(self.dir, file)))
+        return sorted(ret)
+
+    # 内存映射单个文件，忽略不完整的末尾记录
+    def mmap(self, file):
+        n = os.path.getsize(file) // self.dtype.itemsize
+        if n == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(file, dtype=self.dtype, mode='r', shape=(n,))
+
+    def query(self, start = None, end = None, cols = None):
+        '''
+        查询时间范围内的记录
+        :param start: 开始时间(含)，时间戳或时间字符串，默认不限
+        :param end: 结束时间(不含)，时间戳或时间字符串，默认不限
+        :param cols: 要查询的列，默认所有列
+        :return: DataFrame，time列为时间戳(秒)
+        '''
+        self.flush()
+        start = to_timestamp(start)
+        end = to_timestamp(end)
+        start_day = ts.timestamp2str(start, '%Y-%m-%d') if start is not None else None
+        end_day = ts.timestamp2str(end, '%Y-%m-%d') if end is not None else None
+        cols = ['time'] + (cols or self.cols)
+        parts = []
+        for day, file in self.day_files():
+            # 按文件名的日期跳过范围外的文件
+            if (start_day is not None and day < start_day) or (end_day is not None and day > end_day):
+                continue
+            data = self.mmap(file)
+            times = data['time']
+            i = 0 if start is None else int(np.searchsorted(times, start, 'left'))
+            j = len(data) if end is None else int(np.searchsorted(times, end, 'left'))
+            if i < j:
+                parts.append({col: np.array(data[col][i:j]) for col in cols}) # 复制，以便关闭映射
+        if len(parts) == 0:
+            return pd.DataFrame({col: np.zeros(0) for col in cols})
+        return pd.DataFrame({col: np.concatenate([part[col] for part in parts]) for col in cols})
+
+'''
+指标的列式时序存储: 一个目录下有多个指标序列，如 sys/proc/gc，每个序列一个子目录
+'''
+class MetricStore(object):
+
+    def __init__(self, dir = 'metrics', flush_rows = 60, flush_seconds = 10):
+        '''
+        :param dir: 存储目录
+        :param flush_rows: 每攒多少行追加到文件一次
+        :param flush_seconds: 最多隔多少秒追加到文件一次
+        '''
+        self.dir = dir
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.series = {} # 序列名 -> MetricSeries
+
+    def get_series(self, name, cols = None):
+        '''
+        获得指标序列，没有则创建
+        :param name: 序列名，如 sys、proc、proc.分组名、gc
+        :param cols: 列名，为空则从已有的schema中读取
+        :return: MetricSeries
+        '''
+        series = self.series.get(name)
+        if series is None:
+            if not re.match(r'^[\w.\-\[\]]+$', name) or '..' in name:
+                raise Exception(f"无效的指标序列名: {name}")
+            dir = os.path.join(self.dir, name)
+            if cols is None:
+                file = os.path.join(dir, 'schema.json')
+                if not os.path.exists(file):
+                    raise Exception(f"指标序列不存在: {name}")
+                with open(file, 'r', encoding='utf-8') as f:
+                    cols = json.load(f)['cols']
+            series = self.series[name] = MetricSeries(dir, cols, self.flush_rows, self.flush_seconds)
+        return series
+
+    # 追加一条记录
+    def append(self, name, cols, vals, now = None):
+        self.get_series(name, cols).append(vals, now)
+
+    # 所有的序列名
+    def list_series(self):
+        if not os.path.exists(self.dir):
+            return []
+        return sorted(name for name in os.listdir(self.dir) if os.path.exists(os.path.join(self.dir, name, 'schema.json')))
+
+    def query(self, name, start = None, end = None, cols = None, interval = None, agg = 'mean'):
+        '''
+        查询时间范围内的记录，可降采样
+        :param name: 序列名
+        :param start: 开始时间(含)，时间戳或时间字符串，默认不限
+        :param end: 结束时间(不含)，时间戳或时间字符串，默认不限
+        :param cols: 要查询的列，默认所有列
+        :param interval: 降采样的时间间隔，秒数或带单位(如5m/1h)，默认不降采样
+        :param agg: 降采样的聚合函数，如 mean/max/min/sum/count/last，或 {列: 聚合函数}
+        :return: DataFrame，time列为时间戳(秒)，降采样时为区间开始时间
+        '''
+        df = self.get_series(name).query(start, end, cols)
+        if interval is None:
+            return df
+        interval = interval if isinstance(interval, (int, float)) else ts.age2seconds(str(interval))
+        buckets = (df['time'] // interval) * interval
+        df = df.drop(columns='time').groupby(buckets.rename('time')).agg(agg)
+        return df.reset_index()
+
+    # 关闭所有序列: 刷盘+fsync
+    def close(self):
+        for series in self.series.values():
+            series.close()
+
+# 时间字符串转时间戳
+def to_timestamp(t):
+    if t is None or isinstance(t, (int, float)):
+        return t
+    return ts.str2timestamp(str(t))
+
+if __name__ == '__main__':
+    # 测试: 写入30天的1s采样(259万条)，再查询与降采样
+    dir = '/tmp/MetricStoreTest'
+    store = MetricStore(dir, flush_rows=100000)
+    now = time.time() - 30 * 86400
+    n = 30 * 86400
+    start = time.time()
+    series = store.get_series('sys', sys_cols)
+    vals = np.random.rand(len(sys_cols)) * 100
+    for i in range(n):
+        series.append(vals, now + i)
+    store.close()
+    print(f"append: {n / (time.time() - start):.0f} rows/sec")
+    start = time.time()
+    df = store.query('sys')
+    print(f"query {len(df)} rows: {time.time() - start:.3f} sec")
+    start = time.time()
+    df = store.query('sys', now + 7 * 86400, now + 14 * 86400, ['cpu_percent'], '1h', 'max')
+    print(f"query 1 week downsample to {len(df)} rows: {time.time() - start:.3f} sec")
@@ -0,0 +1,231 @@
+import asyncio
+import math
+import time
+import psutil
+from pyutilb.log import log
+from MonitorBoot.gc_log_parser import pause_buckets
+from MonitorBoot.sysinfo import SysInfo
+
+# 指标名前缀
+prefix = 'monitorboot_'
+
+# 系统指标: 字段 -> (指标名, 说明)
+sys_metrics = {
+    'cpu_percent': ('sys_cpu_percent', 'System cpu usage percent'),
+    'mem_percent': ('sys_mem_percent', 'System memory usage percent'),
+    'mem_used': ('sys_mem_used_bytes', 'System used memory'),
+    'mem_free': ('sys_mem_free_bytes', 'System free memory'),
+    'disk_percent': ('sys_disk_percent', 'Root disk usage percent'),
+    'disk_read': ('sys_disk_read_bytes_per_second', 'System disk read rate'),
+    'disk_write': ('sys_disk_write_bytes_per_second', 'System disk write rate'),
+    'net_recv': ('sys_net_recv_bytes_per_second', 'System network receive rate'),
+    'net_sent': ('sys_net_sent_bytes_per_second', 'System network send rate'),
+}
+
+# 进程指标: 字段 -> (指标名, 说明)
+proc_metrics = {
+    'cpu_percent': ('proc_cpu_percent', 'Process cpu usage percent'),
+    'mem_used': ('proc_mem_uss_bytes', 'Process unique memory (uss)'),
+    'mem_rss': ('proc_mem_rss_bytes', 'Process resident memory (rss)'),
+    'mem_pss': ('proc_mem_pss_bytes', 'Process proportional memory (pss)'),
+    'mem_percent': ('proc_mem_percent', 'Process memory usage percent'),
+    'disk_read': ('proc_disk_read_bytes_per_second', 'Process disk read rate'),
+    'disk_write': ('proc_disk_write_bytes_per_second', 'Process disk write rate'),
+}
+
+# gc类型的标签值
+gc_types = {False: 'young', True: 'full'}
+
+# 转义标签值
+def escape_label(val):
+    return str(val).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+# 格式化指标值
+def format_value(val):
+    if val is None:
+        return 'NaN'
+    val = float(val)
+    if math.isnan(val):
+        return 'NaN'
+    if math.isinf(val):
+        return '+Inf' if val > 0 else '-Inf'
+    if val.is_integer():
+        return str(int(val))
+    return repr(val)
+
+'''
+指标族: 同名的一组样本
+'''
+class MetricFamily(object):
+
+    def __init__(self, name, type, help):
+        '''
+        :param name: 指标名(不含前缀，counter不含_total后缀)
+        :param type: 类型: gauge/counter/histogram
+        :param help: 说明
+        '''
+        self.name = prefix + name
+        self.type = type
+        self.help = help
+        self.samples = [] # (后缀, 标签, 值)
+
+    def add(self, val, labels = None, suffix = ''):
+        self.samples.append((suffix, labels, val))
+        return self
+
+    def render(self, out, openmetrics):
+        '''
+        输出文本格式
+        :param out: 输出的行的list
+        :param openmetrics: 是否OpenMetrics格式，否则是prometheus的文本格式(0.0.4)，两者的区别是counter的TYPE行的指标名是否带_total
+        '''
+        name = self.name
+        if self.type == 'counter' and not openmetrics:
+            name += '_total'
+        out.append(f'# HELP {name} {self.help}')
+        out.append(f'# TYPE {name} {self.type}')
+        for suffix, labels, val in self.samples:
+            if labels:
+                labels = '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + '}'
+            else:
+                labels = ''
+            out.append(f'{self.name}{suffix}{labels} {format_value(val)}')
+
+'''
+指标的http暴露: 在现有的事件循环中运行asyncio的http服务器，输出OpenMetrics/prometheus文本格式的指标
+   1 指标有: 系统指标、监控的进程的指标、gc的次数与耗时直方图
+   2 响应缓存cache_seconds秒，多个抓取者同时抓取不会重复读取指标
+   3 只支持 GET /metrics，足够prometheus抓取，无需引入web框架
+'''
+class MetricsExporter(object):
+
+    def __init__(self, boot, cache_seconds = 1):
+        '''
+        :param boot: MonitorBoot，用于读取监控的进程与gc日志解析器
+        :param cache_seconds: 响应的缓存秒数，默认等于采样器的采样周期
+        '''
+        self.boot = boot
+        self.cache_seconds = cache_seconds
+        self.cache = {} # 是否OpenMetrics格式 -> (过期时间, 响应体)
+        self.server = None
+
+    async def start(self, host, port):
+        '''
+        启动http服务器
+        :param host: 监听的地址
+        :param port: 监听的端口
+        '''
+        self.server = await asyncio.start_server(self.handle, host, port)
+        log.info("暴露指标: http://%s:%s/metrics", host, port)
+
+    # 处理http请求
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            lines = request.decode('latin-1').split('\r\n')
+            parts = lines[0].split(' ')
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    k, v = line.split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+            if len(parts) < 2 or parts[0] not in ('GET', 'HEAD'):
+                self.write_response(writer, '405 Method Not Allowed', 'text/plain', b'Method Not Allowed\n')
+            elif parts[1].split('?', 1)[0] != '/metrics':
+                self.write_response(writer, '404 Not Found', 'text/plain', b'Not Found\n')
+            else:
+                openmetrics = 'application/openmetrics-text' in headers.get('accept', '')
+                if openmetrics:
+                    content_type = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+                else:
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                body = self.get_body(openmetrics)
+                self.write_response(writer, '200 OK', content_type, b'' if parts[0] == 'HEAD' else body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as ex:
+            log.error("MetricsExporter.handle()异常: " + str(ex), exc_info=ex)
+        finally:
+            writer.close()
+
+    # 输出响应
+    def write_response(self, writer, status, content_type, body):
+        head = f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+        writer.write(head.encode('latin-1') + body)
+
+    # 获得响应体，有缓存
+    def get_body(self, openmetrics):
+        now = time.time()
+        item = self.cache.get(openmetrics)
+        if item is not None and item[0] > now:
+            return item[1]
+        out = []
+        for family in self.collect():
+            family.render(out, openmetrics)
+        if openmetrics:
+            out.append('# EOF')
+        body = ('\n'.join(out) + '\n').encode('utf-8')
+        self.cache[openmetrics] = (now + self.cache_seconds, body)
+        return body
+
+    # 收集指标
+    def collect(self):
+        return self.collect_sys() + self.collect_procs() + self.collect_gc()
+
+    # 系统指标
+    def collect_sys(self):
+        sys = SysInfo()
+        ret = []
+        for col, (name, help) in sys_metrics.items():
+            try:
+                ret.append(MetricFamily(name, 'gauge', help).add(getattr(sys, col)))
+            except Exception as ex:
+                log.error("MetricsExporter.collect_sys()异常: " + str(ex), exc_info=ex)
+        return ret
+
+    # 监控的进程的指标: 进程分组名与pid作为标签
+    def collect_procs(self):
+        families = {col: MetricFamily(name, 'gauge', help) for col, (name, help) in proc_metrics.items()}
+        up = MetricFamily('proc_up', 'gauge', 'Whether the monitored process is running')
+        for group, proc in list(self.boot._procs.items()):
+            labels = {'group': group, 'pid': proc.pid}
+            try:
+                vals = {col: getattr(proc, col) for col in proc_metrics}
+            except (psutil.Error, AttributeError): # 进程已退出(proc为None)
+                up.add(0, labels)
+                continue
+            up.add(1, labels)
+            for col, val in vals.items():
+                families[col].add(val, labels)
+        return [up] + list(families.values())
+
+    # gc指标: 次数 + 耗时直方图 + 最近一次gc
+    def collect_gc(self):
+        parser = self.boot.gc_parser
+        if parser is None:
+            return []
+        count = MetricFamily('gc', 'counter', 'Number of gc')
+        pause = MetricFamily('gc_pause_seconds', 'histogram', 'Gc pause time')
+        last_pause = MetricFamily('gc_last_pause_seconds', 'gauge', 'Pause time of the last gc')
+        last_interval = MetricFamily('gc_last_interval_seconds', 'gauge', 'Interval between the last two gc')
+        heap_after = MetricFamily('gc_last_heap_after_bytes', 'gauge', 'Heap used after the last gc')
+        heap_total = MetricFamily('gc_last_heap_total_bytes', 'gauge', 'Heap capacity at the last gc')
+        for is_full, type in gc_types.items():
+            labels = {'type': type}
+            count.add(parser.gc_counts[is_full], labels, '_total')
+            # 直方图的区间是累计的
+            hist = parser.pause_hists[is_full]
+            total = 0
+            for le, n in zip(pause_buckets + [float('inf')], hist):
+                total += n
+                pause.add(total, {'type': type, 'le': format_value(le)}, '_bucket')
+            pause.add(total, labels, '_count')
+            pause.add(parser.pause_sums[is_full], labels, '_sum')
+            gc = parser.last_gc(is_full)
+            if gc is not None:
+                last_pause.add(gc.get('costtime'), labels)
+                last_interval.add(gc.get('interval'), labels)
+                heap_after.add(gc['after'] * 1024, labels) # K转字节
+                heap_total.add(gc['total'] * 1024, labels)
+        return [count, pause, last_pause, last_interval, heap_after, heap_total]
@@ -0,0 +1,84 @@
+import time
+from collections import namedtuple
+import psutil
+
+# smaps_rollup汇总的内存: 单位字节
+#    rss: 常驻内存
+#    pss: 按共享进程数均摊后的内存
+#    uss: 当前进程独有的内存(不包共享内存)
+#    swap: 换出的内存
+pmem_rollup = namedtuple('pmem_rollup', ['rss', 'pss', 'uss', 'swap'])
+
+# smaps_rollup中的字段 -> pmem_rollup的字段
+rollup_fields = {
+    b'Rss:': 'rss',
+    b'Pss:': 'pss',
+    b'Private_Clean:': 'uss',
+    b'Private_Dirty:': 'uss',
+    b'Private_Hugetlb:': 'uss',
+    b'Swap:': 'swap',
+}
+
+'''
+长期持有的进程句柄，由采样器按pid缓存，供 ProcInfo 复用
+   1 name/exe/cmdline 在进程的生命周期内不会变，第一次读取后就缓存起来；
+     psutil.Process 绑定了进程的启动时间，pid被复用(启动时间变了)时 is_running() 返回False，采样器就会丢掉该句柄，缓存也随之失效
+   2 内存读 /proc/pid/smaps_rollup(内核已汇总好)，而不是逐个映射区解析 /proc/pid/smaps，大堆jvm的映射区很多，后者很慢
+   3 smaps_rollup 在内核中仍要遍历映射区，因此结果缓存max_age秒，同一周期内的 mem_used/mem_rss/mem_pss 只读一次
+'''
+class ProcHandle(psutil.Process):
+
+    def __init__(self, pid):
+        super(ProcHandle, self).__init__(int(pid))
+        # 不变属性的缓存
+        self.attrs = {}
+        # smaps_rollup的缓存 + 读取时间
+        self.rollup = None
+        self.rollup_time = 0
+
+    # 读缓存的不变属性
+    def cached_attr(self, name, getter):
+        ret = self.attrs.get(name)
+        if ret is None:
+            ret = self.attrs[name] = getter()
+        return ret
+
+    def name(self):
+        return self.cached_attr('name', super(ProcHandle, self).name)
+
+    def exe(self):
+        return self.cached_attr('exe', super(ProcHandle, self).exe)
+
+    def cmdline(self):
+        return self.cached_attr('cmdline', super(ProcHandle, self).cmdline)
+
+    def memory_rollup(self, max_age = 1):
+        '''
+        读取内核汇总的内存: /proc/pid/smaps_rollup (linux 4.14+)，不支持则退化为 memory_full_info()
+        :param max_age: 缓存的最长秒数
+        :return: pmem_rollup
+        '''
+        now = time.time()
+        if self.rollup is None or now - self.rollup_time >= max_age:
+            self.rollup = self.read_rollup()
+            self.rollup_time = now
+        return self.rollup
+
+    # 读取 /proc/pid/smaps_rollup
+    def read_rollup(self):
+        try:
+            with open(f'/proc/{self.pid}/smaps_rollup', 'rb') as f:
+                data = f.read()
+        except PermissionError:
+            raise psutil.AccessDenied(self.pid)
+        except OSError: # 不支持smaps_rollup或进程已退出
+            mem = self.memory_full_info() # 进程已退出则抛 NoSuchProcess
+            return pmem_rollup(mem.rss, getattr(mem, 'pss', 0), mem.uss, getattr(mem, 'swap', 0))
+        vals = dict.fromkeys(pmem_rollup._fields, 0)
+        for line in data.split(b'\n'):
+            parts = line.split()
+            if len(parts) >= 2:
+                field = rollup_fields.get(parts[0])
+                if field is not None:
+                    vals[field] += int(parts[1]) * 1024 # kB
+        return pmem_rollup(**vals)
@@ -0,0 +1,201 @@
+import os
+import re
+import time
+import psutil
+from pyutilb.log import log
+
+# 时钟频率，用于将 /proc/pid/stat 中的启动时间(clock ticks)转为秒
+clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+'''
+进程命令行的索引: pid -> 命令行，用于在进程内按关键字搜索进程，代替 `ps -ef | grep` 管道
+   1 每次搜索只需列出/proc下的pid，只读取新进程的 /proc/pid/cmdline，已退出的进程从索引中干掉
+   2 刚启动的进程可能还没exec(如 nohup java ... 先fork出shell再exec为java)，其命令行会变，因此启动不久的进程每次搜索都重新读取
+   3 匹配的进程会重新读取命令行来确认，以免pid被复用时用了旧的命令行
+'''
+class ProcIndex(object):
+
+    def __init__(self, proc_dir = '/proc', settle_seconds = 60):
+        '''
+        :param proc_dir: proc文件系统的目录
+        :param settle_seconds: 进程启动多少秒后命令行才算稳定，之前每次搜索都重新读取
+        '''
+        self.proc_dir = proc_dir
+        self.settle_seconds = settle_seconds
+        self.cmdlines = {} # pid -> 命令行
+        self.unsettled = set() # 命令行可能还会变的pid
+        self.boot_time = psutil.boot_time()
+
+    # 刷新索引
+    def scan(self):
+        pids = {int(name) for name in os.listdir(self.proc_dir) if name.isdigit()}
+        # 干掉已退出的进程
+        for pid in self.cmdlines.keys() - pids:
+            del self.cmdlines[pid]
+            self.unsettled.discard(pid)
+        # 读新进程 + 刚启动的进程的命令行
+        for pid in (pids - self.cmdlines.keys()) | self.unsettled:
+            self.read(pid)
+        return self.cmdlines
+
+    # 读进程的命令行
+    def read(self, pid):
+        cmdline = read_cmdline(self.proc_dir, pid)
+        if cmdline is None: # 已退出
+            self.cmdlines.pop(pid, None)
+            self.unsettled.discard(pid)
+            return None
+        self.cmdlines[pid] = cmdline
+        start_time = read_start_time(self.proc_dir, pid)
+        if start_time is not None and time.time() - (self.boot_time + start_time) < self.settle_seconds:
+            self.unsettled.add(pid)
+        else:
+            self.unsettled.discard(pid)
+        return cmdline
+
+    def grep(self, grep):
+        '''
+        搜索命令行匹配所有关键字的进程
+        :param grep: 关键字，支持多个，用|分割，同 `ps -ef | grep 关键字1 | grep 关键字2`，关键字是正则，如 java.*order-svc
+        :return: 匹配的pid的list，已排序
+        '''
+        regs = [compile_keyword(k) for k in re.split(r' *\| *', grep.strip()) if k]
+        self_pid = os.getpid()
+        ret = []
+        for pid, cmdline in list(self.scan().items()):
+            if pid != self_pid and all(reg.search(cmdline) for reg in regs):
+                # 重新读取来确认
+                cmdline = self.read(pid)
+                if cmdline is not None and all(reg.search(cmdline) for reg in regs):
+                    ret.append(pid)
+        return sorted(ret)
+
+# 编译关键字的正则，有缓存: 同一关键字每次搜索都用
+_keyword_regs = {}
+def compile_keyword(keyword):
+    reg = _keyword_regs.get(keyword)
+    if reg is None:
+        try:
+            reg = re.compile(keyword)
+        except re.error as ex:
+            raise Exception(f"无效的进程关键字[{keyword}]: {ex}")
+        _keyword_regs[keyword] = reg
+    return reg
+
+# 读进程的命令行，参数间用空格分割; 内核线程没有命令行，同ps显示为[进程名]; 进程已退出则返回None
+def read_cmdline(proc_dir, pid):
+    try:
+        with open(f'{proc_dir}/{pid}/cmdline', 'rb') as f:
+            data = f.read()
+        if data:
+            return data.rstrip(b'\0').replace(b'\0', b' ').decode('utf-8', 'replace')
+        with open(f'{proc_dir}/{pid}/comm', 'rb') as f:
+            return '[' + f.read().strip().decode('utf-8', 'replace') + ']'
+    except OSError:
+        return None
+
+# 读进程的启动时间，单位秒(开机以来)
+def read_start_time(proc_dir, pid):
+    try:
+        with open(f'{proc_dir}/{pid}/stat', 'rb') as f:
+            data = f.read()
+        # 进程名可能包含空格与括号，因此从最后一个)后开始分割，启动时间是第22个字段
+        fields = data[data.rindex(b')') + 2:].split()
+        return int(fields[19]) / clock_ticks
+    except (OSError, ValueError, IndexError):
+        return None
+
+# 打开pidfd: 进程退出时可读; 不支持(linux<5.3 或 非linux)则返回None
+def open_pidfd(pid):
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except ProcessLookupError:
+        raise psutil.NoSuchProcess(pid)
+    except OSError: # 内核不支持
+        return None
+
+'''
+进程退出的监听器: 进程退出时立即回调，而不是定时检查进程是否存在
+   1 优先用pidfd: 注册到事件循环的reader中，进程退出时pidfd可读，毫秒级得到退出事件，无需轮询
+   2 不支持pidfd时退化为轮询: 每poll_interval秒检查一次进程句柄(能识别pid被复用与僵尸进程)
+'''
+class ProcWatcher(object):
+
+    def __init__(self, loop, poll_interval = 1):
+        '''
+        :param loop: 事件循环
+        :param poll_interval: 不支持pidfd时的轮询间隔秒数
+        '''
+        self.loop = loop
+        self.poll_interval = poll_interval
+        self.watches = {} # 监听的key -> (pid, pidfd, 进程句柄, 回调)
+        self.poll_timer = None
+
+    def watch(self, key, pid, callback):
+        '''
+        监听进程退出
+        :param key: 监听的key，如进程分组名，同一key只监听一个进程
+        :param pid: 进程id
+        :param callback: 进程退出时的回调，在事件循环线程中调用，无参数
+        '''
+        self.unwatch(key)
+        pid = int(pid)
+        try:
+            fd = open_pidfd(pid)
+            proc = psutil.Process(pid) if fd is None else None
+        except psutil.NoSuchProcess: # 已退出
+            self.loop.call_soon(callback)
+            return
+        self.watches[key] = (pid, fd, proc, callback)
+        if fd is not None:
+            self.loop.add_reader(fd, self.on_exit, key)
+        elif self.poll_timer is None:
+            self.poll_timer = self.loop.call_later(self.poll_interval, self.poll)
+
+    # 取消监听
+    def unwatch(self, key):
+        item = self.watches.pop(key, None)
+        if item is not None and item[1] is not None:
+            self.loop.remove_reader(item[1])
+            os.close(item[1])
+
+    # 进程退出
+    def on_exit(self, key):
+        item = self.watches.get(key)
+        if item is None:
+            return
+        self.unwatch(key)
+        log.info("进程[%s]已退出", item[0])
+        try:
+            item[3]()
+        except Exception as ex:
+            log.error("ProcWatcher.on_exit()异常: " + str(ex), exc_info=ex)
+
+    # 轮询不支持pidfd的进程
+    def poll(self):
+        self.poll_timer = None
+        for key, (pid, fd, proc, callback) in list(self.watches.items()):
+            if fd is None and not is_alive(proc):
+                self.on_exit(key)
+        if any(item[1] is None for item in self.watches.values()):
+            self.poll_timer = self.loop.call_later(self.poll_interval, self.poll)
+
+    # 取消所有监听
+    def close(self):
+        for key in list(self.watches):
+            self.unwatch(key)
+        if self.poll_timer is not None:
+            self.poll_timer.cancel()
+            self.poll_timer = None
+
+# 进程是否存活: 已退出/pid被复用/僵尸进程都不算
+def is_alive(proc):
+    try:
+        return proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+# 全局的进程索引
+proc_index = ProcIndex()
@@ -5,38 +5,23 @@ import psutil
 from pyutilb.cmd import get_pid_by_grep
 from pyutilb.lazy import lazyproperty
 from pyutilb.log import log
-from MonitorBoot.sysinfo import PresleepMixin
+from MonitorBoot.proc_handle import ProcHandle
+from MonitorBoot.sampler import metric_sampler
 
 # 进程信息，如cpu/内存/磁盘等
-class ProcInfo(PresleepMixin):
+#    速率类指标(cpu/磁盘io)由采样器的最近2个快照计算得到，无需睡眠
+class ProcInfo(object):
 
-    # 要睡1s的字段
-    sleep_fields = 'cpu_percent|disk_read|disk_write'.split('|')
-
-    def __init__(self, pid):
+    def __init__(self, pid, sampler = None):
         self.pid = pid
-        self.last_dio = None  # 记录上一秒磁盘io统计(读写字节数)，以便通过下一秒的值的对比来计算读写速率
-
-    # 预备：部分指标需要隔1秒调2次，以便通过通过下一秒的值的对比来计算指标值
-    def presleep_field(self, expr):
-        if 'cpu_percent' in expr:
-            # 1 对 self.proc.cpu_percent(interval)，当interval不为空，则阻塞
-            # self.proc.cpu_percent(1) # 会阻塞1s
-            # 2 当interval为空时，计算的cpu时间是相对上一次调用的，第1次计算直接返回0，因此主动在前一秒调用一下，让后续动作的调用有结果
-            self.proc.cpu_percent()  # 对 self.proc.cpu_percent(1) 的异步实现
-            return True
-
-        if 'dio' in expr:
-            self.last_dio = self.proc.io_counters()
-            return True
-
-        return False
+        self.sampler = sampler or metric_sampler
 
     # 延迟创建，因为ProcInfo要提前创建但不一定使用，而psutil.Process()比较重，就延迟创建了
+    # 进程句柄由采样器来创建与缓存，以便每个周期统一采样，且多个ProcInfo实例共用同一个句柄(及其缓存的name/exe/cmdline)
     @lazyproperty
     def proc(self):
-        proc = psutil.Process(int(self.pid))
-        if proc.status() not in (psutil.STATUS_RUNNING, psutil.STATUS_SLEEPING):
+        proc = self.sampler.watch_pid(self.pid)
+        if proc is None or proc.status() not in (psutil.STATUS_RUNNING, psutil.STATUS_SLEEPING):
             log.error(f"进程[%s]没运行", self.pid)
             return None
         return proc
@@ -63,37 +48,47 @@ class ProcInfo(PresleepMixin):
     def status(self):
         return self.proc.status()
 
-    # 已用内存
+    # 已用内存: 当前进程独有的内存(uss，不包共享内存)
     @property
     def mem_used(self):
-        # pss： 当前进程与其他进程共享的内存
-        # uss： 当前进程独有的内存（不包共享内存）
-        return self.proc.memory_full_info().uss
+        return self.proc.memory_rollup().uss
+
+    # 常驻内存
+    @property
+    def mem_rss(self):
+        return self.proc.memory_rollup().rss
+
+    # 按共享进程数均摊后的内存
+    @property
+    def mem_pss(self):
+        return self.proc.memory_rollup().pss
 
-    # 内存使用率
+    # 内存使用率: 总内存取采样器最近的快照，而不是 memory_percent() 每次都读一遍系统内存
     @property
     def mem_percent(self):
-        return self.proc.memory_percent()
+        total = self.sampler.last_sys().vmem.total
+        return round(self.proc.memory_info().rss / total * 100, 2)
 
-    # cpu的使用频率
+    # cpu的使用频率 = 最近2个快照的cpu时间差 / 时间差
     @property
     def cpu_percent(self):
-        return self.proc.cpu_percent(1)
-
-    # 磁盘io计数(读写字节数)
-    @lazyproperty
-    def dio(self):
-        return self.proc.io_counters()
+        if self.proc is None: # 先让采样器监控该进程
+            return 0.0
+        return self.sampler.proc_cpu_percent(self.pid)
 
-    # 读速率 = 当前读字节数 - 上一秒读字节数
+    # 读速率 = 最近2个快照的读字节数差 / 时间差
     @property
     def disk_read(self):
-        return self.dio.read_bytes - self.last_dio.read_bytes
+        if self.proc is None:
+            return 0
+        return self.sampler.proc_rate(self.pid, 'read_bytes')
 
-    # 写速率 = 当前写字节数 - 上一秒写字节数
+    # 写速率 = 最近2个快照的写字节数差 / 时间差
     @property
     def disk_write(self):
-        return self.dio.write_bytes - self.last_dio.write_bytes
+        if self.proc is None:
+            return 0
+        return self.sampler.proc_rate(self.pid, 'write_bytes')
 
 if __name__ == '__main__':
     pid = get_pid_by_grep("java | com.intellij.idea.Main")
@@ -107,6 +102,15 @@ if __name__ == '__main__':
     print("p.cpu_num(): " + str(p.cpu_num()))
     print("p.memory_info(): " + str(p.memory_info()))
     print("p.memory_full_info(): " + str(p.memory_full_info()))
+    # 对比 memory_full_info() 与 smaps_rollup 的耗时
+    '''
+    h = ProcHandle(pid)
+    for f in [h.memory_full_info, h.read_rollup, h.memory_rollup]:
+        start = time.time()
+        for i in range(100):
+            f()
+        print(f"{f.__name__}: {(time.time() - start) * 10:.3f} ms")
+    '''
     print("p.memory_percent(): " + str(p.memory_percent()))
     print("p.open_files(): " + str(p.open_files()))
     print("p.connections(): " + str(p.connections()))
@@ -1,57 +1,283 @@
 import asyncio
+import os
 import time
+from collections import namedtuple
 import pandas as pd
 import psutil
-from pyutilb import ts
-from pyutilb.cmd import run_command, run_command_async, cmd_output2dataframe
 from pyutilb.log import log
-from pyutilb.util import set_vars, link_sheet
-from ExcelBoot.boot import Boot as EBoot
+from pyutilb.util import link_sheet
+from MonitorBoot.report_worker import export_excel_async
+from MonitorBoot.html_report import HtmlReport, check_format, report_file, df2records, save_json
 
 '''
-主要使用 iostat 与 pidstat 命令来统计进程或线程的cpu、内存、io等信息
-https://www.cnblogs.com/storyawine/p/13332052.html
+通过psutil读/proc来统计进程或线程的cpu、内存、io等信息，替代原来的 iostat 与 pidstat 命令
+   1 间隔interval秒采集2次快照(所有进程与线程)，由2个快照的差值计算区间内的真实速率; 而不带间隔的pidstat输出的是开机以来的平均值，告警时找出的top进程往往不对
+   2 在进程内采集，省掉fork/exec子进程与解析命令输出的开销，告警风暴时也不会拖慢系统
+   3 导出的df的列与原来命令输出的列保持一致，psutil拿不到的字段(如%guest/%wait/kB_ccwr/s)填0
 '''
 
 # ExcelBoot的步骤文件
 excel_boot_yaml = __file__.replace("procstat.py", "eb-allproc2xlsx.yml")
 
-async def all_proc_stat2xlsx(filename_pref, monitor_proc = None):
+# 快照中要采集的进程属性
+proc_attrs = ['pid', 'name', 'uids', 'cpu_times', 'cpu_num', 'memory_info', 'memory_percent', 'io_counters', 'threads']
+
+# 时钟频率，用于将秒转为clock ticks，如pidstat的iodelay
+clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# 快照: 采集时间 + 进程信息(pid -> dict) + 磁盘io计数(磁盘名 -> sdiskio)
+ProcStatSnapshot = namedtuple('ProcStatSnapshot', ['time', 'procs', 'disks'])
+
+# 采集快照: 所有进程(含线程) + 所有磁盘
+def take_snapshot():
+    disks = psutil.disk_io_counters(perdisk=True) or {}
+    procs = {}
+    for p in psutil.process_iter(proc_attrs):
+        info = p.info
+        info['faults'] = read_faults(info['pid'])
+        procs[info['pid']] = info
+    return ProcStatSnapshot(time.time(), procs, disks)
+
+# 读/proc/pid/stat中的缺页次数(minflt, majflt)，psutil没有提供
+def read_faults(pid):
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError: # 非linux或进程已退出
+        return None
+    # 进程名可能有空格与括号，因此从最后一个)后开始分割
+    fields = stat[stat.rfind(b')') + 2:].split()
+    return int(fields[7]), int(fields[9])
+
+# 读/proc/pid/task/tid/stat中的线程名与最后运行的cpu
+def read_thread_stat(pid, tid):
+    try:
+        with open(f'/proc/{pid}/task/{tid}/stat', 'rb') as f:
+            stat = f.read().decode('utf-8', 'replace')
+    except OSError: # 非linux或线程已退出
+        return None, -1
+    end = stat.rfind(')')
+    name = stat[stat.find('(') + 1:end]
+    fields = stat[end + 2:].split()
+    return name, int(fields[36])
+
+'''
+进程统计：采集2个快照，并将差值转为df
+'''
+class ProcStat(object):
+
+    def __init__(self, interval = 1):
+        '''
+        :param interval: 2次快照的间隔秒数
+        '''
+        self.interval = 1 if interval is None or interval == '' else float(interval)
+        self.snap1 = None
+        self.snap2 = None
+
+    # 采集2个快照，采集有大量文件读，放到线程池中执行，以免阻塞事件循环
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        self.snap1 = await loop.run_in_executor(None, take_snapshot)
+        await asyncio.sleep(self.interval)
+        self.snap2 = await loop.run_in_executor(None, take_snapshot)
+        return self
+
+    # 2个快照的时间差
+    @property
+    def dt(self):
+        return self.snap2.time - self.snap1.time
+
+    # 2个快照都有的进程: 生成 (pid, 旧信息, 新信息)
+    def proc_pairs(self):
+        procs1 = self.snap1.procs
+        for pid, p2 in self.snap2.procs.items():
+            p1 = procs1.get(pid)
+            if p1 is not None:
+                yield pid, p1, p2
+
+    # 每秒的速率
+    def rate(self, v1, v2):
+        return round((v2 - v1) / self.dt, 2)
+
+    # cpu使用率
+    def percent(self, t1, t2):
+        return round((t2 - t1) / self.dt * 100, 2)
+
+    # -------------------------------- 磁盘统计 -----------------------------------
+    # 磁盘读写信息，同 iostat -x，主要拿 %util 来识别磁盘io频率(一秒中有百分之多少的时间用于I/O操作)
+    def disk_io_df(self):
+        rows = []
+        ms = self.dt * 1000
+        disks1 = self.snap1.disks
+        for disk, d2 in self.snap2.disks.items():
+            d1 = disks1.get(disk)
+            if d1 is None:
+                continue
+            r = d2.read_count - d1.read_count
+            w = d2.write_count - d1.write_count
+            rkb = (d2.read_bytes - d1.read_bytes) / 1024
+            wkb = (d2.write_bytes - d1.write_bytes) / 1024
+            rrqm = getattr(d2, 'read_merged_count', 0) - getattr(d1, 'read_merged_count', 0)
+            wrqm = getattr(d2, 'write_merged_count', 0) - getattr(d1, 'write_merged_count', 0)
+            rtime = d2.read_time - d1.read_time
+            wtime = d2.write_time - d1.write_time
+            busy = getattr(d2, 'busy_time', 0) - getattr(d1, 'busy_time', 0)
+            rows.append([
+                disk,
+                round(r / self.dt, 2), # r/s
+                round(w / self.dt, 2), # w/s
+                round(rkb / self.dt, 2), # rkB/s
+                round(wkb / self.dt, 2), # wkB/s
+                round(rrqm / self.dt, 2), # rrqm/s
+                round(wrqm / self.dt, 2), # wrqm/s
+                div(rrqm * 100, rrqm + r), # %rrqm
+                div(wrqm * 100, wrqm + w), # %wrqm
+                div(rtime, r), # r_await
+                div(wtime, w), # w_await
+                round((rtime + wtime) / ms, 2), # aqu-sz
+                div(rkb, r), # rareq-sz
+                div(wkb, w), # wareq-sz
+                div(busy, r + w), # svctm
+                round(min(busy / ms * 100, 100), 2), # %util
+            ])
+        df = pd.DataFrame(rows, columns=['Device', 'r/s', 'w/s', 'rkB/s', 'wkB/s', 'rrqm/s', 'wrqm/s', '%rrqm', '%wrqm', 'r_await', 'w_await', 'aqu-sz', 'rareq-sz', 'wareq-sz', 'svctm', '%util'])
+        return df.sort_values(by='%util', ascending=False)
+
+    # -------------------------------- 进程cpu统计 -----------------------------------
+    # 进程的cpu统计信息，同 pidstat，用于找到cpu多的进程
+    def cpu_df(self):
+        rows = []
+        for pid, p1, p2 in self.proc_pairs():
+            t1, t2 = p1['cpu_times'], p2['cpu_times']
+            if t1 is None or t2 is None: # 无权限
+                continue
+            usr = self.percent(t1.user, t2.user)
+            system = self.percent(t1.system, t2.system)
+            rows.append([uid_of(p2), pid, usr, system, 0.0, 0.0, round(usr + system, 2), p2['cpu_num'], p2['name']])
+        df = pd.DataFrame(rows, columns=['UID', 'PID', '%usr', '%system', '%guest', '%wait', '%CPU', 'CPU', 'Command'])
+        return df.sort_values(by='%CPU', ascending=False)
+
+    # -------------------------------- 进程mem统计 -----------------------------------
+    # 进程的mem统计信息，同 pidstat -r，用于找到mem多的进程
+    def mem_df(self):
+        rows = []
+        for pid, p1, p2 in self.proc_pairs():
+            mem = p2['memory_info']
+            if mem is None: # 无权限
+                continue
+            f1, f2 = p1['faults'], p2['faults']
+            if f1 is None or f2 is None:
+                minflt = majflt = 0.0
+            else:
+                minflt = self.rate(f1[0], f2[0])
+                majflt = self.rate(f1[1], f2[1])
+            rows.append([uid_of(p2), pid, minflt, majflt, mem.vms // 1024, mem.rss // 1024, round(p2['memory_percent'] or 0, 2), p2['name']])
+        df = pd.DataFrame(rows, columns=['UID', 'PID', 'minflt/s', 'majflt/s', 'VSZ', 'RSS', '%MEM', 'Command'])
+        return df.sort_values(by='%MEM', ascending=False)
+
+    # -------------------------------- 进程io统计 -----------------------------------
+    # 进程的io统计信息，同 pidstat -d，用于找到io多的进程，按读写总速度降序
+    def io_df(self):
+        rows = []
+        for pid, p1, p2 in self.proc_pairs():
+            io1, io2 = p1['io_counters'], p2['io_counters']
+            if io1 is None or io2 is None: # 无权限，同pidstat输出-1
+                rd = wr = -1.0
+            else:
+                rd = self.rate(io1.read_bytes / 1024, io2.read_bytes / 1024)
+                wr = self.rate(io1.write_bytes / 1024, io2.write_bytes / 1024)
+            t1, t2 = p1['cpu_times'], p2['cpu_times']
+            iodelay = 0
+            if t1 is not None and t2 is not None: # 块设备io等待的clock ticks
+                iodelay = round((getattr(t2, 'iowait', 0) - getattr(t1, 'iowait', 0)) * clock_ticks)
+            rows.append([uid_of(p2), pid, rd, wr, 0.0, iodelay, p2['name']])
+        df = pd.DataFrame(rows, columns=['UID', 'PID', 'kB_rd/s', 'kB_wr/s', 'kB_ccwr/s', 'iodelay', 'Command'])
+        order = (df['kB_rd/s'] + df['kB_wr/s']).sort_values(ascending=False, kind='stable').index
+        return df.loc[order]
+
+    # -------------------------------- 线程处理 -----------------------------------
+    # 进程的线程统计信息，同 pidstat -t -p pid，用于找到cpu多的线程
+    def threads_df(self, pid):
+        pid = int(pid)
+        p1 = self.snap1.procs.get(pid)
+        p2 = self.snap2.procs.get(pid)
+        rows = []
+        if p1 is not None and p2 is not None and p1['threads'] and p2['threads']:
+            threads1 = {t.id: t for t in p1['threads']}
+            # 如果是java进程，只要java中的业务线程
+            is_java = p2['name'] == 'java'
+            uid = uid_of(p2)
+            for t2 in p2['threads']:
+                t1 = threads1.get(t2.id)
+                if t1 is None:
+                    continue
+                name, cpu = read_thread_stat(pid, t2.id)
+                if is_java and name is not None and is_vm_thread(name):
+                    continue
+                usr = self.percent(t1.user_time, t2.user_time)
+                system = self.percent(t1.system_time, t2.system_time)
+                rows.append([uid, pid, t2.id, usr, system, 0.0, 0.0, round(usr + system, 2), cpu, name, hex(t2.id)])
+        # nid列: tid的16进制，用于关联jstack中的线程
+        df = pd.DataFrame(rows, columns=['UID', 'TGID', 'TID', '%usr', '%system', '%guest', '%wait', '%CPU', 'CPU', 'Command', 'NID'])
+        return df.sort_values(by='%CPU', ascending=False)
+
+# 进程的用户id
+def uid_of(info):
+    uids = info['uids']
+    return -1 if uids is None else uids.real
+
+# 除法，除数为0则返回0
+def div(a, b):
+    return round(a / b, 2) if b else 0.0
+
+async def all_proc_stat2xlsx(filename_pref, monitor_procs = None, interval = None):
+    '''
+    导出所有进程统计信息到xlsx
+    :param filename_pref:
+    :param monitor_procs: MonitorBoot 监控的进程: 统计项名 -> {PID, Command}
+    :param interval: 采集2次快照的间隔秒数，默认1
+    :return:
+    '''
+    return await all_proc_stat2report(filename_pref, monitor_procs, interval, 'xlsx')
+
+async def all_proc_stat2report(filename_pref, monitor_procs = None, interval = None, format = 'xlsx'):
     '''
     导出所有进程统计信息
     :param filename_pref:
-    :param monitor_proc: MonitorBoot 监控的进程
+    :param monitor_procs: MonitorBoot 监控的进程: 统计项名 -> {PID, Command}
+    :param interval: 采集2次快照的间隔秒数，默认1
+    :param format: 报告格式: xlsx/html/json
     :return:
     '''
+    format = check_format(format)
     # 获得进程统计
-    disk_io_df, process_cpu_df, process_mem_df, process_io_df =\
-        await asyncio.gather(get_disk_io_df(), process_get_cpu_df(), process_get_mem_df(), process_get_io_df())
+    stat = await ProcStat(interval).collect()
+    disk_io_df = stat.disk_io_df()
+    process_cpu_df = stat.cpu_df()
+    process_mem_df = stat.mem_df()
+    process_io_df = stat.io_df()
     # 获得top进程的pid
     top_procs = {
         'top_cpu_proc': process_cpu_df.iloc[0],
         'top_mem_proc': process_mem_df.iloc[0],
         'top_io_proc': process_io_df.iloc[0],
     }
-    if monitor_proc is not None:
-        top_procs['monitor_proc'] = monitor_proc
+    if monitor_procs:
+        top_procs.update(monitor_procs)
     top_pids = []
     for k, p in top_procs.items():
-        pid = p['PID']
+        pid = int(p['PID'])
         if pid not in top_pids:
             top_pids.append(pid)
     # 逐个pid获得线程
-    thread_dfs = await asyncio.gather(*map(get_threads_df, top_pids))
     pid2threads = []
-    for i in range(0, len(top_pids)):
+    for pid in top_pids:
         item = {
-            'pid': top_pids[i],
-            'threads': thread_dfs[i]
+            'pid': pid,
+            'threads': stat.threads_df(pid)
         }
         pid2threads.append(item)
-    # excel文件名
-    filename_pref = filename_pref or 'ProcStat'
-    now = ts.now2str("%Y%m%d%H%M%S")
-    file = f'{filename_pref}-{now}.xlsx'
+    file = report_file(filename_pref or 'ProcStat', format)
     # 设置变量
     vars = {
         'file': file,
@@ -63,11 +289,38 @@ async def all_proc_stat2xlsx(filename_pref, monitor_proc = None):
         'pid2threads': pid2threads,
         'stat_list_df': build_stat_list_df(top_procs)
     }
-    set_vars(vars)
-    # 导出excel
-    boot = EBoot()
-    boot.run_1file(excel_boot_yaml)
-    return file
+    if format != 'xlsx': # 只有几百个进程，数据量小，直接生成
+        return save_proc_stat_report(file, vars, format)
+    # 导出excel: 在工作进程中生成，不阻塞事件循环
+    return await export_excel_async(excel_boot_yaml, vars)
+
+# 报告中每个统计只取前几个进程
+top_n = 50
+
+# 将进程统计存为html/json
+def save_proc_stat_report(file, vars, format):
+    if format == 'json':
+        return save_json(file, {
+            'disk_io_stat': df2records(vars['disk_io_df']),
+            'process_cpu_stat': df2records(vars['process_cpu_df'], top_n),
+            'process_mem_stat': df2records(vars['process_mem_df'], top_n),
+            'process_io_stat': df2records(vars['process_io_df'], top_n),
+            'threads': {str(item['pid']): df2records(item['threads'], top_n) for item in vars['pid2threads']},
+        })
+    report = HtmlReport('Process Stat')
+    report.add_heading('Disk IO')
+    report.add_table(vars['disk_io_df'])
+    for title, key, col in (('Process CPU', 'process_cpu_df', '%CPU'), ('Process Memory', 'process_mem_df', '%MEM')):
+        df = vars[key].head(top_n)
+        report.add_heading(title)
+        report.add_chart(range(len(df.head(20))), {col: df[col].head(20)}, 'bar', 'top process', col)
+        report.add_table(df)
+    report.add_heading('Process IO')
+    report.add_table(vars['process_io_df'].head(top_n))
+    for item in vars['pid2threads']:
+        report.add_heading(f"Threads of pid {item['pid']}")
+        report.add_table(item['threads'].head(top_n))
+    return report.save(file)
 
 # 获得统计清单
 def build_stat_list_df(top_procs):
@@ -85,108 +338,56 @@ def build_stat_list_df(top_procs):
     return pd.DataFrame(ret, columns=['Item', 'Process', 'Pid', 'Link'])
 
 # -------------------------------- 磁盘统计 -----------------------------------
-# 通过 iostat -x 来获得磁盘读写信息，主要拿 %util 来识别磁盘io频率(一秒中有百分之多少的时间用于I/O操作)
-async def get_disk_io_df():
-    # 1 执行命令
-    output = await run_command_async(f'iostat -x')
-    '''Linux 5.10.60-amd64-desktop (shi-PC)    2023年04月24日  _x86_64_        (6 CPU)
-
-avg-cpu:  %user   %nice %system %iowait  %steal   %idle
-          23.07    0.09    5.70    0.07    0.00   71.07
-
-Device            r/s     w/s     rkB/s     wkB/s   rrqm/s   wrqm/s  %rrqm  %wrqm r_await w_await aqu-sz rareq-sz wareq-sz  svctm  %util
-sda              0.04    0.00      1.10      0.00     0.00     0.00   0.00   0.00   14.27    0.00   0.00    29.16     0.00   7.90   0.03
-sdb              7.44   12.02    296.64    616.39     1.33    14.19  15.18  54.14    0.29    1.14   0.02    39.85    51.30   0.67   1.31'''
-    # 2 将命令结果转为df
-    df = cmd_output2dataframe(output, 5)  # 干掉5行
-    # 3 按%CPU降序
-    return order_df(df, '%util', False)
+# 获得磁盘读写信息
+async def get_disk_io_df(interval = None):
+    stat = await ProcStat(interval).collect()
+    return stat.disk_io_df()
 
 # 获得最高磁盘io频率(一秒中有百分之多少的时间用于I/O操作)
-async def max_disk_util():
-    df = get_disk_io_df()
+async def max_disk_util(interval = None):
+    df = await get_disk_io_df(interval)
     return df['%util'].max()
 
 # -------------------------------- 进程cpu统计 -----------------------------------
-# 通过 pidstat 来获得进程的cpu统计信息，用于找到cpu多的进程
-async def process_get_cpu_df():
-    # 1 执行命令
-    output = await run_command_async(f'pidstat')
-    '''Linux 5.10.60-amd64-desktop (shi-PC)    2023年04月24日  _x86_64_        (6 CPU)
-
-16时40分05秒   UID       PID    %usr %system  %guest   %wait    %CPU   CPU  Command
-16时40分05秒     0         1    0.01    0.01    0.00    0.00    0.02     1  systemd
-16时40分05秒     0         2    0.00    0.00    0.00    0.00    0.00     1  kthreadd'''
-    # 2 将命令结果转为df
-    df = cmd_output2dataframe(output, 2)  # 干掉2行
-    # 3 删除时间列(第一列)
-    col1 = df.columns[0]
-    del df[col1]
-    # 4 按%CPU降序
-    return order_df(df, '%CPU', False)
-
-# 将df按列排序
-def order_df(df, by, asc):
-    df[by] = df[by].apply(float) # 排序列要先转为数值
-    return df.sort_values(by=by, ascending=asc) # 按列排序
+# 获得进程的cpu统计信息
+async def process_get_cpu_df(interval = None):
+    stat = await ProcStat(interval).collect()
+    return stat.cpu_df()
 
 # 获得cpu最忙的进程id
-async def process_top_cpu():
+async def process_top_cpu(interval = None):
     # 1 获得进程
-    df = await process_get_cpu_df()
+    df = await process_get_cpu_df(interval)
     # 2 选择第一个
     row = dict(df.iloc[0])
     log.info(f"cpu最忙的进程为: %s", row)
     return row
 
 # -------------------------------- 进程mem统计 -----------------------------------
-# 通过 pidstat -r 来获得进程的mem统计信息，用于找到mem多的进程
-async def process_get_mem_df():
-    # 1 执行命令
-    output = await run_command_async(f'pidstat -r')
-    '''Linux 5.10.60-amd64-desktop (shi-PC)    2023年04月26日  _x86_64_        (6 CPU)
-
-11时12分45秒   UID       PID  minflt/s  majflt/s     VSZ     RSS   %MEM  Command
-11时12分45秒     0         1      4.79      0.02  166088   10672   0.04  systemd
-11时12分45秒     0       349      0.14      3.35   79712   36624   0.15  systemd-journal'''
-    # 2 将命令结果转为df
-    df = cmd_output2dataframe(output, 2)  # 干掉2行
-    # 3 删除时间列(第一列)
-    col1 = df.columns[0]
-    del df[col1]
-    # 4 按%mem降序
-    return order_df(df, '%MEM', False)
+# 获得进程的mem统计信息
+async def process_get_mem_df(interval = None):
+    stat = await ProcStat(interval).collect()
+    return stat.mem_df()
 
 # 获得mem最忙的进程id
-async def process_top_mem():
+async def process_top_mem(interval = None):
     # 1 获得进程
-    df = await process_get_mem_df()
+    df = await process_get_mem_df(interval)
     # 2 选择第一个
     row = dict(df.iloc[0])
     log.info(f"mem最忙的进程为: %s", row)
     return row
 
 # -------------------------------- 进程io统计 -----------------------------------
-# 通过 pidstat -d 来获得进程的io统计信息，用于找到io多的进程
-async def process_get_io_df():
-    # 1 执行命令
-    output = await run_command_async(f'pidstat -d')
-    '''Linux 5.10.60-amd64-desktop (shi-PC)    2023年04月24日  _x86_64_        (6 CPU)
-
-16时09分10秒   UID       PID   kB_rd/s   kB_wr/s kB_ccwr/s iodelay  Command
-16时09分11秒  1000       347      0.00      7.77      0.00       0  chrome
-16时09分11秒     0       808     -1.00     -1.00     -1.00       1  jbd2/sdb4-8'''
-    # 2 将命令结果转为df
-    df = cmd_output2dataframe(output, 2)  # 干掉2行
-    # 3 删除时间列(第一列)
-    col1 = df.columns[0]
-    del df[col1]
-    return df
+# 获得进程的io统计信息
+async def process_get_io_df(interval = None):
+    stat = await ProcStat(interval).collect()
+    return stat.io_df()
 
 # 获得io最忙的进程id
-async def process_top_io(is_read):
+async def process_top_io(is_read, interval = None):
     # 1 获得进程
-    df = await process_get_io_df()
+    df = await process_get_io_df(interval)
     # 2 按读写速度降序
     if is_read:
         order_by = 'kB_rd/s'
@@ -201,37 +402,15 @@ async def process_top_io(is_read):
     return row
 
 # -------------------------------- 线程处理 -----------------------------------
-# 通过 pidstat -t -p pid 来获得线程
-async def get_threads_df(pid):
-    # 1 执行命令
-    output = await run_command_async(f'pidstat -t -p {pid}')
-    '''Linux 5.10.60-amd64-desktop (shi-PC) 	2023年04月23日 	_x86_64_	(6 CPU)
-
-11时28分27秒   UID      TGID       TID    %usr %system  %guest   %wait    %CPU   CPU  Command
-11时28分27秒  1000      9702         -   19.37    0.50    0.00    0.00   19.87     0  java
-11时28分27秒  1000         -      9702    0.00    0.00    0.00    0.00    0.00     0  |__java'''
-    # 2 将命令结果转为df
-    df = cmd_output2dataframe(output, 2) # 干掉2行
-    # 3 如果是java进程，只要java中的业务线程: 通过构建 VM_THREAD 列来过滤
-    if df.iloc[0]['Command'] == 'java': # 检查第一行是java进程，必须在删除第一行前做检查
-        df['VM_THREAD'] = df['Command'].apply(is_vm_thread)
-        df = df.loc[lambda x: x['VM_THREAD'] == False]
-        del df['VM_THREAD']
-    # 4 删除第一行是进程而不是线程，如java且tid为-
-    df = df.drop(0)
-    # 5 删除时间列(第一列)
-    col1 = df.columns[0]
-    del df[col1]
-    # 6 按cpu降序
-    df = order_df(df, '%CPU', False)
-    # 7 nid列: tid的16进制
-    df['NID'] = df['TID'].apply(lambda x: hex(int(x)))
-    return df
-
-# 挑出cpu最忙的线程： 用 pidstat -t -p pid
-async def top_cpu_thread(pid):
+# 获得进程的线程统计信息
+async def get_threads_df(pid, interval = None):
+    stat = await ProcStat(interval).collect()
+    return stat.threads_df(pid)
+
+# 挑出cpu最忙的线程
+async def top_cpu_thread(pid, interval = None):
     # 1 获得线程
-    df = await get_threads_df(pid)
+    df = await get_threads_df(pid, interval)
     # 2 选择第一个
     # 取前2个: print(df.head(2))
     # 取第1个: df.iloc[0]
@@ -262,7 +441,17 @@ async def test():
     # df = await get_threads_df(pid)
     # print(df)
     # t = await top_cpu_thread(pid)
+
+    # 测试采集的耗时: 与原来每个命令都fork子进程相比
+    '''
+    stat = ProcStat(0)
+    start = time.time()
+    for i in range(10):
+        await stat.collect()
+        stat.disk_io_df(), stat.cpu_df(), stat.mem_df(), stat.io_df()
+    print(f"ProcStat: {(time.time() - start) / 10:.3f} secs")
+    '''
     await all_proc_stat2xlsx("../data/Stat")
 
 if __name__ == '__main__':
-    asyncio.run(test())
\ No newline at end of file
+    asyncio.run(test())
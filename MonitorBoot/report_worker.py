@@ -0,0 +1,87 @@
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+'''
+报告(xlsx)生成的工作进程
+   1 ExcelBoot写大的xlsx(含图表)要几秒，在工作进程中执行，不阻塞事件循环中的采样/tail/定时任务
+   2 数据通过参数显式传递(序列化后传给工作进程)，不再通过调用线程的全局变量传递，多个导出同时执行也不会串数据
+   3 工作进程是常驻的(首次导出时创建)，避免每次导出都重新导入pandas/openpyxl/matplotlib
+   4 用spawn启动工作进程，而不是fork: 监控进程中有多个线程(事件循环/邮件连接池等)，fork多线程的进程不安全
+'''
+
+# 工作进程池: 递延创建
+_executor = None
+_lock = threading.Lock()
+
+# 最多同时生成几个报告
+max_workers = 1
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+# 工作进程异常退出(如oom被杀)后，丢弃进程池，下次导出时重建
+def reset_executor(executor):
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+def run_excel_boot(yaml_file, vars):
+    '''
+    在工作进程中执行ExcelBoot的步骤文件
+    :param yaml_file: ExcelBoot的步骤文件
+    :param vars: 步骤文件中用到的变量，如 file(导出的文件) 与各个DataFrame
+    :return: 导出的文件
+    '''
+    from pyutilb.util import UseVars
+    from ExcelBoot.boot import Boot as EBoot
+    # 工作进程单线程执行任务，变量用完即清理，不会影响下一个任务
+    with UseVars(vars):
+        boot = EBoot()
+        boot.run_1file(yaml_file)
+    return vars.get('file')
+
+def export_excel(yaml_file, vars):
+    '''
+    同步导出xlsx: 在工作进程中生成，当前线程等待结果，用于没有事件循环的场景(如顶层步骤或线程中)
+    :param yaml_file: ExcelBoot的步骤文件
+    :param vars: 步骤文件中用到的变量
+    :return: 导出的文件
+    '''
+    executor = get_executor()
+    try:
+        return executor.submit(run_excel_boot, yaml_file, vars).result()
+    except BrokenProcessPool:
+        reset_executor(executor)
+        raise
+
+async def export_excel_async(yaml_file, vars):
+    '''
+    异步导出xlsx: 在工作进程中生成，不阻塞事件循环
+    :param yaml_file: ExcelBoot的步骤文件
+    :param vars: 步骤文件中用到的变量
+    :return: 导出的文件
+    '''
+    executor = get_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, run_excel_boot, yaml_file, vars)
+    except BrokenProcessPool:
+        reset_executor(executor)
+        raise
+
+# 关闭工作进程
+def shutdown():
+    global _executor
+    with _lock:
+        executor = _executor
+        _executor = None
+    if executor is not None:
+        executor.shutdown(wait=True)
@@ -0,0 +1,190 @@
+import math
+import time
+from collections import deque
+
+'''
+样本值的直方图: 对数-线性分桶(同gc耗时的PauseHistogram)，但值是任意浮点数(可为负)，桶是稀疏的
+   1 用frexp取值的2的幂(指数)与尾数，每个2的幂区间再等分为 2^sub_bits 个子桶，sub_bits=7时相对误差不超过 1/128
+   2 添加与删除都是O(1)，分位数要按桶有序扫描，桶数不超过样本数
+   3 桶号保持值的顺序: 正数桶号>0，负数桶号为其绝对值的桶号取反，0的桶号为0
+'''
+class ValueHistogram(object):
+
+    def __init__(self, sub_bits = 7):
+        self.sub_count = 1 << sub_bits
+        self.counts = {} # 桶号 -> 个数
+        self.count = 0
+        self.keys = None # 有序的桶号，分位数时才创建，桶增减时作废
+
+    # 值对应的桶号，非有限值(nan/inf)返回None
+    def index(self, val):
+        if val == 0:
+            return 0
+        if not math.isfinite(val):
+            return None
+        m, e = math.frexp(abs(val)) # abs(val) = m * 2^e, 0.5 <= m < 1
+        key = (e + 1100) * self.sub_count + int((m * 2 - 1) * self.sub_count) + 1 # 指数最小为-1074，加上1100使桶号>0
+        return key if val > 0 else -key
+
+    # 桶的上界，对负数桶来说是绝对值的下界
+    def upper(self, key):
+        if key == 0:
+            return 0.0
+        k = abs(key) - 1
+        e = k // self.sub_count - 1100
+        sub = k % self.sub_count
+        if key > 0:
+            return math.ldexp(0.5 + (sub + 1) / self.sub_count / 2, e)
+        return -math.ldexp(0.5 + sub / self.sub_count / 2, e)
+
+    def add(self, val, n = 1):
+        '''
+        添加或删除值
+        :param val: 值
+        :param n: 1为添加，-1为删除
+        '''
+        key = self.index(val)
+        if key is None:
+            return
+        c = self.counts.get(key, 0) + n
+        if c == 0:
+            del self.counts[key]
+            self.keys = None
+        else:
+            if c == n:
+                self.keys = None
+            self.counts[key] = c
+        self.count += n
+
+    def percentile(self, q):
+        '''
+        分位数(最近秩法)，取所在桶的上界
+        :param q: 分位，如0.95
+        :return: 值，没有记录则返回None
+        '''
+        if self.count == 0:
+            return None
+        if self.keys is None:
+            self.keys = sorted(self.counts)
+        target = max(math.ceil(q * self.count), 1)
+        total = 0
+        for key in self.keys:
+            total += self.counts[key]
+            if total >= target:
+                return self.upper(key)
+        return self.upper(self.keys[-1])
+
+'''
+指标的滚动时间窗口：有界的环形队列，保留最近window秒的样本，并增量维护聚合值
+   1 avg/sum/count: 累计和与个数，入队加、出队减，O(1)
+   2 min/max: 单调队列，每个样本最多入队出队各一次，均摊O(1)
+   3 rate: 计数器在窗口内的增量，入队时记录与上一个样本的差值(计数器重置时差值为当前值)，累计差值和，O(1)
+   4 p分位数(如p95): 对数-线性分桶的直方图，入队出队O(1)，相对误差不超过1%，结果不超出窗口的[min, max]，仅在用到分位数时才维护
+'''
+class RollingWindow(object):
+
+    def __init__(self, seconds, max_size = 100000):
+        '''
+        :param seconds: 窗口秒数
+        :param max_size: 最多保留的样本数，用于限制内存
+        '''
+        self.seconds = seconds
+        self.max_size = max_size
+        self.samples = deque() # 样本: (序号, 时间, 值, 与上一个样本的差值)
+        self.seq = 0 # 样本序号，用于在单调队列中识别样本
+        self.sum = 0.0
+        self.delta_sum = 0.0
+        self.last_val = None # 上一个样本的值(包含已出队的)，用于计算差值
+        self.max_queue = deque() # 单调递减队列: (序号, 值)
+        self.min_queue = deque() # 单调递增队列: (序号, 值)
+        self.hist = None # 样本值的直方图，用到分位数时才创建
+        self.last_key = None # 最近记录的样本的key，用于同一样本只记录一次
+
+    def __len__(self):
+        return len(self.samples)
+
+    def append(self, val, now = None):
+        '''
+        添加样本
+        :param val: 样本值
+        :param now: 样本时间，默认为当前时间
+        '''
+        now = now or time.time()
+        seq = self.seq = self.seq + 1
+        # 计数器的差值
+        if self.last_val is None:
+            delta = 0.0
+        elif val >= self.last_val:
+            delta = val - self.last_val
+        else: # 计数器重置
+            delta = val
+        self.last_val = val
+        self.samples.append((seq, now, val, delta))
+        self.sum += val
+        self.delta_sum += delta
+        # 单调队列
+        q = self.max_queue
+        while q and q[-1][1] <= val:
+            q.pop()
+        q.append((seq, val))
+        q = self.min_queue
+        while q and q[-1][1] >= val:
+            q.pop()
+        q.append((seq, val))
+        if self.hist is not None:
+            self.hist.add(val)
+        self.expire(now)
+
+    # 淘汰窗口外的样本
+    def expire(self, now = None):
+        cutoff = (now or time.time()) - self.seconds
+        samples = self.samples
+        while samples and (samples[0][1] < cutoff or len(samples) > self.max_size):
+            seq, _, val, delta = samples.popleft()
+            self.sum -= val
+            self.delta_sum -= delta
+            if self.max_queue[0][0] == seq:
+                self.max_queue.popleft()
+            if self.min_queue[0][0] == seq:
+                self.min_queue.popleft()
+            if self.hist is not None:
+                self.hist.add(val, -1)
+        if not samples: # 清掉浮点累计误差
+            self.sum = 0.0
+            self.delta_sum = 0.0
+
+    def agg(self, func):
+        '''
+        获得聚合值，窗口为空则返回None
+        :param func: 聚合函数名: avg/sum/count/min/max/rate/p分位数(如p95)
+        '''
+        self.expire()
+        n = len(self.samples)
+        if func == 'count':
+            return n
+        if n == 0:
+            return None
+        if func == 'avg':
+            return self.sum / n
+        if func == 'sum':
+            return self.sum
+        if func == 'max':
+            return self.max_queue[0][1]
+        if func == 'min':
+            return self.min_queue[0][1]
+        if func == 'rate':
+            return self.delta_sum
+        # p分位数: 最近秩法，取桶的上界，但不超出窗口的[min, max]
+        if self.hist is None:
+            self.hist = ValueHistogram()
+            for s in self.samples:
+                self.hist.add(s[2])
+        val = self.hist.percentile(int(func[1:]) / 100)
+        if val is None:
+            return None
+        return min(max(val, self.min_queue[0][1]), self.max_queue[0][1])
+
+# 是否合法的聚合函数名
+def is_agg_func(func):
+    return func in ('avg', 'sum', 'count', 'min', 'max', 'rate') \
+           or (len(func) > 1 and func[0] == 'p' and func[1:].isdigit() and 0 < int(func[1:]) <= 100)
@@ -0,0 +1,180 @@
+import asyncio
+import time
+from collections import deque, namedtuple
+import psutil
+from pyutilb.log import log
+from MonitorBoot.proc_handle import ProcHandle
+
+# 系统快照: 采样时间 + cpu时间 + 磁盘io计数 + 网络io计数 + 内存
+SysSnapshot = namedtuple('SysSnapshot', ['time', 'cpu_times', 'dio', 'nio', 'vmem'])
+
+# 进程快照: 采样时间 + cpu时间 + 磁盘io计数
+ProcSnapshot = namedtuple('ProcSnapshot', ['time', 'cpu_times', 'dio'])
+
+'''
+指标采样器：每个周期统一采样一次psutil计数器，并记录到环形队列中
+   SysInfo/ProcInfo 的速率类指标(cpu/磁盘io/网络io)，就是最近2个快照的差值，不再需要每次执行步骤都睡1s
+'''
+class MetricSampler(object):
+
+    def __init__(self, interval = 1, size = 60):
+        '''
+        :param interval: 采样周期，单位秒
+        :param size: 环形队列的大小，即保留最近多少个快照
+        '''
+        self.interval = interval
+        self.size = size
+        # 系统快照的环形队列
+        self.sys_snapshots = deque(maxlen=size)
+        # 被监控的进程: pid -> ProcHandle(进程句柄的缓存)
+        self.procs = {}
+        # 进程快照的环形队列: pid -> deque
+        self.proc_snapshots = {}
+        # 定时采样的任务
+        self.job = None
+
+    def start(self, scheduler):
+        '''
+        启动定时采样
+        :param scheduler: 调度器
+        '''
+        if self.job is not None:
+            return
+        self.sample()
+        self.job = scheduler.add_job(self.sample, 'interval', seconds=self.interval)
+
+    async def warmup(self):
+        '''
+        预热：保证至少有2个快照，用于无调度器的场景(如单独测试)
+        '''
+        if len(self.sys_snapshots) == 0:
+            self.sample()
+        if len(self.sys_snapshots) < 2:
+            await asyncio.sleep(self.interval)
+            self.sample()
+        return self
+
+    # 采样一次: 系统 + 所有被监控的进程
+    def sample(self):
+        now = time.time()
+        snapshot = SysSnapshot(now, psutil.cpu_times(), psutil.disk_io_counters(), psutil.net_io_counters(), psutil.virtual_memory())
+        self.sys_snapshots.append(snapshot)
+        for pid, proc in list(self.procs.items()):
+            self.sample_proc(pid, proc, now)
+
+    # 采样单个进程
+    def sample_proc(self, pid, proc, now = None):
+        try:
+            if not proc.is_running(): # 进程已退出或pid已被复用(启动时间变了)，则句柄失效
+                raise psutil.NoSuchProcess(pid)
+            with proc.oneshot():
+                cpu_times = proc.cpu_times()
+                try:
+                    dio = proc.io_counters()
+                except (psutil.AccessDenied, AttributeError): # 无权限或平台不支持
+                    dio = None
+            self.proc_snapshots[pid].append(ProcSnapshot(now or time.time(), cpu_times, dio))
+        except psutil.NoSuchProcess:
+            log.error(f"进程[%s]已不存在, 停止采样", pid)
+            self.unwatch_pid(pid)
+
+    def watch_pid(self, pid):
+        '''
+        监控进程: 后续每个周期都会采样该进程
+        :param pid: 进程id
+        :return: ProcHandle, 长期持有的进程句柄
+        '''
+        pid = int(pid)
+        if pid not in self.procs:
+            proc = ProcHandle(pid)
+            self.procs[pid] = proc
+            self.proc_snapshots[pid] = deque(maxlen=self.size)
+            self.sample_proc(pid, proc)
+        return self.procs.get(pid)
+
+    # 取消监控进程
+    def unwatch_pid(self, pid):
+        pid = int(pid)
+        self.procs.pop(pid, None)
+        self.proc_snapshots.pop(pid, None)
+
+    # 获得最近2个快照，不够2个则返回None
+    def last_pair(self, snapshots):
+        if snapshots is None or len(snapshots) < 2:
+            return None
+        return snapshots[-2], snapshots[-1]
+
+    # 获得最近的系统快照
+    def last_sys(self):
+        if len(self.sys_snapshots) == 0:
+            self.sample()
+        return self.sys_snapshots[-1]
+
+    # 系统cpu使用率 = 非空闲cpu时间差 / 总cpu时间差
+    def sys_cpu_percent(self):
+        pair = self.last_pair(self.sys_snapshots)
+        if pair is None: # 同 psutil.cpu_percent() 第1次调用返回0
+            return 0.0
+        t1, t2 = pair[0].cpu_times, pair[1].cpu_times
+        total = cpu_total(t2) - cpu_total(t1)
+        if total <= 0:
+            return 0.0
+        idle = cpu_idle(t2) - cpu_idle(t1)
+        return round(max(0.0, (total - idle) / total * 100), 1)
+
+    def sys_rate(self, counter, field):
+        '''
+        系统io速率 = 最近2个快照的计数差 / 时间差
+        :param counter: 计数器, 如 dio(磁盘io) / nio(网络io)
+        :param field: 计数器字段, 如 read_bytes
+        :return: 每秒的速率
+        '''
+        return self.calc_rate(self.last_pair(self.sys_snapshots), counter, field)
+
+    # 进程cpu使用率 = 进程cpu时间差 / 时间差
+    def proc_cpu_percent(self, pid):
+        pair = self.last_pair(self.proc_snapshots.get(int(pid)))
+        if pair is None:
+            return 0.0
+        (s1, s2) = pair
+        dt = s2.time - s1.time
+        if dt <= 0:
+            return 0.0
+        delta = (s2.cpu_times.user + s2.cpu_times.system) - (s1.cpu_times.user + s1.cpu_times.system)
+        return round(delta / dt * 100, 1)
+
+    # 进程io速率 = 最近2个快照的计数差 / 时间差
+    def proc_rate(self, pid, field):
+        return self.calc_rate(self.last_pair(self.proc_snapshots.get(int(pid))), 'dio', field)
+
+    # 计算速率
+    def calc_rate(self, pair, counter, field):
+        if pair is None:
+            return 0
+        (s1, s2) = pair
+        c1 = getattr(s1, counter)
+        c2 = getattr(s2, counter)
+        dt = s2.time - s1.time
+        if c1 is None or c2 is None or dt <= 0: # 如无磁盘的容器
+            return 0
+        return (getattr(c2, field) - getattr(c1, field)) / dt
+
+# 总cpu时间: guest时间已包含在user时间中，不能重复计算
+def cpu_total(times):
+    return sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+
+# 空闲cpu时间
+def cpu_idle(times):
+    return times.idle + getattr(times, 'iowait', 0)
+
+# 全局的采样器
+metric_sampler = MetricSampler()
+
+async def test():
+    await metric_sampler.warmup()
+    print("cpu_percent=", metric_sampler.sys_cpu_percent())
+    print("disk_read=", metric_sampler.sys_rate('dio', 'read_bytes'))
+    print("net_recv=", metric_sampler.sys_rate('nio', 'bytes_recv'))
+
+if __name__ == '__main__':
+    asyncio.run(test())
@@ -3,119 +3,61 @@ import time
 import psutil
 from pyutilb.cmd import get_pid_by_grep
 from pyutilb.lazy import lazyproperty
-
-# 为了预备指标，需要提前睡1s
-class PresleepMixin(object):
-    sleep_sec = 1
-
-    # 预备所有指标
-    async def presleep_all_fields(self):
-        self.last_dio = None  # 记录上一秒磁盘io统计(读写字节数)，以便通过下一秒的值的对比来计算读写速率
-        self.last_nio = None  # 记录上一秒网络i
-
-        # 检查是否要预备睡1s
-        for field in self.sleep_fields:
-            self.presleep_field(field)
-        # 睡1s
-        await asyncio.sleep(PresleepMixin.sleep_sec)
-        return self
-
-    # 在执行步骤前，提前预备指标
-    async def presleep_fields_in_steps(self, steps):
-        # 逐个alert条件来预备相关字段
-        need_sleep = False
-        for step in steps:
-            if 'alert' in step:  # alert动作
-                for expr in step['alert']:  # alert参数是表达式
-                    need_sleep = self.presleep_field(expr) or need_sleep
-        # 睡1s
-        if need_sleep:
-            await asyncio.sleep(PresleepMixin.sleep_sec)
-        return self
+from MonitorBoot.sampler import metric_sampler
 
 # 系统信息，如cpu/内存/磁盘等
-class SysInfo(PresleepMixin):
-
-    # 要睡1s的字段
-    sleep_fields = 'cpu_percent|disk_read|disk_write|net_recv|net_sent'.split('|')
-
-    def __init__(self):
-        self.last_dio = None # 记录上一秒磁盘io统计(读写字节数)，以便通过下一秒的值的对比来计算读写速率
-        self.last_nio = None # 记录上一秒网络io统计(读写字节数)，以便通过下一秒的值的对比来计算读写速率
+#    速率类指标(cpu/磁盘io/网络io)由采样器的最近2个快照计算得到，无需睡眠
+class SysInfo(object):
 
-    # 预备：部分指标需要隔1秒调2次，以便通过通过下一秒的值的对比来计算指标值
-    def presleep_field(self, expr):
-        if 'cpu_percent' in expr:
-            # 1 对 psutil.cpu_percent(interval)，当interval不为空，则阻塞
-            # psutil.cpu_percent(1) # 会阻塞1s
-            # 2 当interval为空时，计算的cpu时间是相对上一次调用的，第1次计算直接返回0，因此主动在前一秒调用一下，让后续动作的调用有结果
-            psutil.cpu_percent()  # 对 psutil.cpu_percent(1) 的异步实现
-            return True
-
-        if 'disk_read' in expr or 'disk_write' in expr:
-            self.last_dio = psutil.disk_io_counters()
-            return True
-
-        if 'net_recv' in expr or 'net_sent' in expr:
-            self.last_nio = psutil.net_io_counters()
-            return True
-
-        return False
-
-    # 磁盘io计数(读写字节数)
-    @lazyproperty
-    def dio(self):
-        return psutil.disk_io_counters()
+    def __init__(self, sampler = None):
+        self.sampler = sampler or metric_sampler
 
-    # 网络io计数(读写字节数)
+    # 最近的快照
     @lazyproperty
-    def nio(self):
-        return psutil.net_io_counters()
+    def snapshot(self):
+        return self.sampler.last_sys()
 
-    # 读速率 = 当前读字节数 - 上一秒读字节数
+    # 读速率 = 最近2个快照的读字节数差 / 时间差
     @property
     def disk_read(self):
-        return self.dio.read_bytes - self.last_dio.read_bytes
+        return self.sampler.sys_rate('dio', 'read_bytes')
 
-    # 写速率 = 当前写字节数 - 上一秒写字节数
+    # 写速率 = 最近2个快照的写字节数差 / 时间差
     @property
     def disk_write(self):
-        return self.dio.write_bytes - self.last_dio.write_bytes
+        return self.sampler.sys_rate('dio', 'write_bytes')
 
-    # 接收速率 = 当前接收字节数 - 上一秒接收字节数
+    # 接收速率 = 最近2个快照的接收字节数差 / 时间差
     @property
     def net_recv(self):
-        return self.nio.bytes_recv - self.last_nio.bytes_recv
+        return self.sampler.sys_rate('nio', 'bytes_recv')
 
-    # 发送速率 = 当前发送字节数 - 上一秒发送字节数
+    # 发送速率 = 最近2个快照的发送字节数差 / 时间差
     @property
     def net_sent(self):
-        return self.nio.bytes_sent - self.last_nio.bytes_sent
+        return self.sampler.sys_rate('nio', 'bytes_sent')
 
     # 已使用内存
     @property
     def mem_used(self):
-        memory_info = psutil.virtual_memory()
-        return memory_info.used
+        return self.snapshot.vmem.used
 
     # 可用内存
     @property
     def mem_free(self):
         # free 是真正尚未被使用的物理内存数量。
         # available 是应用程序认为可用内存数量，available = free + buffer + cache
-        memory_info = psutil.virtual_memory()
-        return memory_info.free
+        return self.snapshot.vmem.free
 
     # 内存使用率
     @property
     def mem_percent(self):
-        memory_info = psutil.virtual_memory()
-        return memory_info.percent
+        return self.snapshot.vmem.percent
 
     # cpu使用率
     @property
     def cpu_percent(self):
-        return psutil.cpu_percent()
+        return self.sampler.sys_cpu_percent()
 
     # 磁盘使用率
     @property
@@ -125,13 +67,16 @@ class SysInfo(PresleepMixin):
 
 async def test():
     while True:
-        sys = await SysInfo().presleep_all_fields()
+        await metric_sampler.warmup()
+        sys = SysInfo()
         print("cpu_percent=", sys.cpu_percent)
         # print("mem_percent=", sys.mem_percent)
         # print("mem_used=", sys.mem_used)
         # print("disk_read=", sys.disk_read)
         # print("disk_write=", sys.disk_write)
         # print("net_sent=", sys.net_sent)
+        await asyncio.sleep(1)
+        metric_sampler.sample()
 
 if __name__ == '__main__':
     # print("psutil.psutil.disk_usage(): " + str(psutil.disk_usage("/")))
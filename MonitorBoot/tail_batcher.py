@@ -0,0 +1,69 @@
+import asyncio
+from pyutilb.tail import Tail
+
+'''
+tail行的批量分发器：攒够一批行(或等够一段时间)才回调一次，以减少逐行执行子步骤的开销
+'''
+class TailBatcher(object):
+
+    def __init__(self, callback, batch_lines = None, batch_ms = None):
+        '''
+        :param callback: 批量回调，参数为一批元素的list，可以是协程函数
+        :param batch_lines: 每批最多元素数，默认500
+        :param batch_ms: 每批最多等待毫秒数，默认200
+        '''
+        self.callback = callback
+        self.batch_lines = int(batch_lines or 500)
+        self.batch_sec = int(batch_ms or 200) / 1000
+        self.items = [] # 当前批
+        self.timer = None # 超时分发的定时器
+
+    # 添加元素(如tail的行)
+    async def add(self, item):
+        if item is None:
+            return
+        self.items.append(item)
+        # 1 攒够一批，则立即分发
+        if len(self.items) >= self.batch_lines:
+            await self.flush()
+            return
+        # 2 否则等超时再分发
+        if self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.batch_sec, self.on_timeout)
+
+    # 超时分发
+    def on_timeout(self):
+        self.timer = None
+        asyncio.ensure_future(self.flush())
+
+    # 分发当前批
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if len(self.items) == 0:
+            return
+        items = self.items
+        self.items = []
+        ret = self.callback(items)
+        if asyncio.iscoroutine(ret):
+            await ret
+
+# 批量模式的tail：每次定时读完所有新增的行，而不是只读一行
+class BatchTail(Tail):
+
+    async def read_line(self):
+        await self.check_file_size()
+        while True:
+            pos = self.file.tell()
+            line = self.file.readline()
+            if not line:
+                break
+            if not line.endswith('\n'): # 不完整的行，退回去留待下次读
+                self.file.seek(pos)
+                break
+            # 回调
+            if line != "\n": # 忽略空+换行符
+                ret = self.callback(line)
+                if asyncio.iscoroutine(ret):
+                    await ret
@@ -0,0 +1,416 @@
+import gzip
+import io
+import re
+from collections import Counter
+import pandas as pd
+from MonitorBoot.html_report import write_text
+
+'''
+jvm线程栈(jstack -l 或 jcmd Thread.print -l 的输出)解析
+   1 流式: 逐行解析，每行只做前缀判断，只有线程头才用正则，1万个线程的dump在1秒内解析完
+   2 索引: nid(即操作系统的线程id) -> 线程，状态 -> 个数，锁地址 -> 持有者/等待者
+   3 分析: 关联pidstat的线程cpu，输出cpu最忙的线程及其栈；检测死锁；跨多次dump检测锁护航(同一把锁一直有多个线程排队)
+线程栈的格式如下:
+"http-nio-8080-exec-1" #31 daemon prio=5 os_prio=0 cpu=2.31ms elapsed=10.20s tid=0x00007f2c4c0b6800 nid=0x1a2b waiting for monitor entry  [0x00007f2c1f4fe000]
+   java.lang.Thread.State: BLOCKED (on object monitor)
+	at com.example.Foo.bar(Foo.java:10)
+	- waiting to lock <0x000000076b0a2c30> (a java.lang.Object)
+	- locked <0x000000076b0a2c40> (a java.lang.Object)
+
+   Locked ownable synchronizers:
+	- <0x000000076b0a2c50> (a java.util.concurrent.locks.ReentrantLock$NonfairSync)
+'''
+
+# 线程头: "线程名" #序号 daemon ...，vm线程没有序号
+head_reg = re.compile(r'^"(.*)" (?:#(\d+) )?(daemon )?')
+# 线程头中的nid与描述，jdk19+的nid是10进制
+nid_reg = re.compile(r' nid=(0x[0-9a-fA-F]+|\d+) ?([^\[]*)')
+# 线程头中的cpu耗时(jdk11+)
+cpu_reg = re.compile(r' cpu=([\d.]+)ms')
+# 锁: <地址> (a 类名)
+lock_reg = re.compile(r'<(0x[0-9a-fA-F]+)> \(a (.+)\)')
+
+# 等待锁的行前缀 -> 等待类型，都是在等别的线程释放锁
+lock_waits = {
+    '\t- waiting to lock ': 'monitor', # synchronized
+    '\t- waiting to re-lock in wait() ': 'monitor', # wait()被唤醒后重新获得锁
+    '\t- parking to wait for ': 'park', # juc的锁，也可能是条件/信号量/future等，只有被持有的同步器才算锁
+}
+
+# park等待的条件，如 Condition.await()，同 Object.wait()，不是在等锁
+condition_classes = ('$ConditionObject',)
+
+'''
+线程
+'''
+class ThreadInfo(object):
+    __slots__ = ('name', 'num', 'daemon', 'nid', 'cpu', 'desc', 'state', 'frames', 'locked', 'waiting', 'waiting_on')
+
+    def __init__(self, name, num, daemon, nid, cpu, desc):
+        self.name = name # 线程名
+        self.num = num # java中的线程序号，vm线程为None
+        self.daemon = daemon # 是否守护线程
+        self.nid = nid # 操作系统的线程id，同pidstat的TID
+        self.cpu = cpu # 线程启动以来的cpu耗时(ms)，jdk11+才有
+        self.desc = desc # 线程头中的描述，如 runnable / waiting on condition
+        self.state = None # java线程状态，如 RUNNABLE/BLOCKED，vm线程没有
+        self.frames = [] # 栈帧，栈顶在前
+        self.locked = {} # 持有的锁: 地址 -> 类名
+        self.waiting = None # 等待获得的锁: (地址, 类名, 等待类型)
+        self.waiting_on = None # wait()的对象: (地址, 类名)，wait()时已释放该锁
+
+    # 线程状态，vm线程取线程头中的描述
+    @property
+    def status(self):
+        return self.state or self.desc.upper().replace(' ', '_')
+
+    # 栈顶的n个栈帧
+    def top_frames(self, n = 10):
+        return self.frames[:n]
+
+    # 格式化为线程栈
+    def format(self, frames = 20):
+        lines = [f'"{self.name}" nid={hex(self.nid)}({self.nid}) {self.status}']
+        for frame in self.top_frames(frames):
+            lines.append('\tat ' + frame)
+        if len(self.frames) > frames:
+            lines.append(f'\t... {len(self.frames) - frames} more')
+        if self.waiting is not None:
+            lines.append(f'\t- waiting for <{self.waiting[0]}> (a {self.waiting[1]})')
+        for addr, clazz in self.locked.items():
+            lines.append(f'\t- locked <{addr}> (a {clazz})')
+        return '\n'.join(lines)
+
+'''
+线程栈的解析结果 + 索引
+'''
+class ThreadDump(object):
+
+    def __init__(self):
+        self.time = None # dump时间，为线程栈的第一行非空行，如 2023-05-05 16:46:57
+        self.threads = [] # 线程
+        self.by_nid = {} # nid -> 线程
+        self.owners = {} # 锁地址 -> 持有的线程
+        self.waiters = {} # 锁地址 -> 等待的线程的list
+        self.jvm_deadlock = False # jvm自己是否检测到死锁: 有 Found one Java-level deadlock
+
+    # 添加线程并建索引
+    def add_thread(self, thread):
+        # wait()的对象虽然在栈中是locked，但已经释放了
+        if thread.waiting_on is not None:
+            thread.locked.pop(thread.waiting_on[0], None)
+        self.threads.append(thread)
+        self.by_nid[thread.nid] = thread
+        for addr in thread.locked:
+            self.owners[addr] = thread
+        if thread.waiting is not None:
+            self.waiters.setdefault(thread.waiting[0], []).append(thread)
+
+    # 各状态的线程数
+    def states(self):
+        return Counter(t.status for t in self.threads)
+
+    # 某状态的线程
+    def threads_of(self, state):
+        return [t for t in self.threads if t.status == state]
+
+    # 锁的类名
+    def lock_class(self, addr):
+        owner = self.owners.get(addr)
+        if owner is not None:
+            return owner.locked[addr]
+        return self.waiters[addr][0].waiting[1]
+
+    def contended_locks(self, min_waiters = 2):
+        '''
+        有线程排队的锁
+        :param min_waiters: 至少有几个线程在等待
+        :return: [{lock, class, owner, waiters}]，按等待线程数倒序
+        '''
+        ret = []
+        for addr, waiters in self.waiters.items():
+            if len(waiters) >= min_waiters:
+                owner = self.owners.get(addr)
+                # park的对象只有被某线程持有(在其 Locked ownable synchronizers 中)才是锁，否则是在等信号量/future/队列等
+                if owner is None and waiters[0].waiting[2] == 'park':
+                    continue
+                ret.append({
+                    'lock': addr,
+                    'class': self.lock_class(addr),
+                    'owner': None if owner is None else owner.name,
+                    'waiters': len(waiters),
+                })
+        return sorted(ret, key=lambda x: -x['waiters'])
+
+    def deadlocks(self):
+        '''
+        检测死锁: 等待图(线程 -> 所等锁的持有线程)中的环
+        每个线程最多等一把锁，图中每个点最多一条出边，沿边走一遍就能找到所有环，是线性的
+        :return: 环的list，每个环是线程的list
+        '''
+        ret = []
+        visited = {} # 线程的nid -> 第几轮遍历中访问的
+        for i, start in enumerate(self.threads):
+            path = []
+            t = start
+            while t is not None and t.nid not in visited:
+                visited[t.nid] = i
+                path.append(t)
+                t = self.owners.get(t.waiting[0]) if t.waiting is not None else None
+            # 在本轮遍历中又走回到路径上的线程，则有环
+            if t is not None and visited[t.nid] == i and t is not path[-1]: # 排除自己等自己，只可能是栈不完整
+                ret.append(path[path.index(t):])
+        return ret
+
+    # 线程的df
+    def to_df(self, frames = 3):
+        rows = []
+        for t in self.threads:
+            rows.append([t.nid, hex(t.nid), t.name, t.status, t.cpu,
+                         None if t.waiting is None else f'<{t.waiting[0]}> (a {t.waiting[1]})',
+                         ', '.join(f'<{addr}> (a {clazz})' for addr, clazz in t.locked.items()),
+                         '\n'.join(t.top_frames(frames))])
+        return pd.DataFrame(rows, columns=['TID', 'NID', 'Name', 'State', 'CpuMs', 'Waiting', 'Locked', 'TopFrames'])
+
+'''
+线程栈的解析器
+'''
+class ThreadDumpParser(object):
+
+    def __init__(self):
+        self.dump = ThreadDump()
+        self.thread = None # 当前线程
+        self.in_ownable = False # 是否在 Locked ownable synchronizers 区中
+        self.done = False # 是否已解析完线程，后面是死锁等信息
+
+    # 解析文件，支持gzip/zstd压缩
+    def parse_file(self, file):
+        if file.endswith('.zst'):
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("解析zstd压缩的线程栈要先安装zstandard: pip install zstandard")
+            with open(file, 'rb') as f:
+                reader = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f), encoding='utf-8', errors='replace')
+                return self.parse_lines(reader)
+        open_file = gzip.open if file.endswith('.gz') else open
+        with open_file(file, 'rt', encoding='utf-8', errors='replace') as f:
+            return self.parse_lines(f)
+
+    # 解析文本
+    def parse_text(self, text):
+        return self.parse_lines(text.splitlines())
+
+    # 解析多行
+    def parse_lines(self, lines):
+        parse_line = self.parse_line
+        for line in lines:
+            # 栈帧占了绝大多数行，直接处理，省掉方法调用
+            if line.startswith('\tat ') and self.thread is not None:
+                self.thread.frames.append(line[4:].rstrip())
+            else:
+                parse_line(line)
+        return self.finish()
+
+    # 解析单行
+    def parse_line(self, line):
+        if self.done:
+            return
+        c = line[:1]
+        # 1 栈帧或锁
+        if c == '\t':
+            t = self.thread
+            if t is None:
+                return
+            if line.startswith('\tat '):
+                t.frames.append(line[4:].rstrip())
+            elif line.startswith('\t- '):
+                self.parse_lock(t, line)
+            return
+        # 2 线程头
+        if c == '"':
+            self.add_thread()
+            self.thread = self.parse_head(line)
+            return
+        # 3 线程状态
+        if line.startswith('   java.lang.Thread.State: '):
+            if self.thread is not None:
+                self.thread.state = line[27:].split(' ', 1)[0].rstrip()
+            return
+        if line.startswith('   Locked ownable synchronizers:'):
+            self.in_ownable = True
+            return
+        # 4 线程栈之后的死锁信息
+        if line.startswith('Found ') and 'deadlock' in line: # Found one Java-level deadlock / Found 2 deadlocks
+            self.dump.jvm_deadlock = True
+            self.done = True
+            self.add_thread()
+            return
+        # 5 dump时间: jstack第一行就是，jcmd第一行是 pid:
+        if self.dump.time is None and line[:2] == '20':
+            self.dump.time = line.strip()
+
+    # 解析线程头
+    def parse_head(self, line):
+        mat = nid_reg.search(line)
+        head = head_reg.match(line)
+        if mat is None or head is None: # 不是线程头，如死锁信息中的 "线程名":
+            return None
+        nid = mat.group(1)
+        nid = int(nid, 16) if nid.startswith('0x') else int(nid)
+        cpu = cpu_reg.search(line)
+        num = head.group(2)
+        return ThreadInfo(head.group(1), None if num is None else int(num), head.group(3) is not None, nid,
+                          None if cpu is None else float(cpu.group(1)), mat.group(2).strip())
+
+    # 解析锁的行
+    def parse_lock(self, t, line):
+        mat = lock_reg.search(line)
+        if mat is None: # 如 - None / - waiting on <no object reference available>
+            return
+        addr, clazz = mat.group(1), mat.group(2)
+        if self.in_ownable or line.startswith('\t- locked '):
+            t.locked[addr] = clazz
+            return
+        if line.startswith('\t- waiting on '):
+            t.waiting_on = (addr, clazz)
+            return
+        for pref, kind in lock_waits.items():
+            if line.startswith(pref):
+                if kind == 'park' and clazz.endswith(condition_classes): # 等条件，如空闲线程池的线程在等任务
+                    t.waiting_on = (addr, clazz)
+                else:
+                    t.waiting = (addr, clazz, kind)
+                return
+
+    # 当前线程解析完，加到结果中
+    def add_thread(self):
+        if self.thread is not None:
+            self.dump.add_thread(self.thread)
+        self.thread = None
+        self.in_ownable = False
+
+    # 解析完成
+    def finish(self):
+        self.add_thread()
+        return self.dump
+
+# 解析线程栈文件
+def parse_thread_dump(file):
+    return ThreadDumpParser().parse_file(file)
+
+def hot_threads(threads_df, dump, top = 10):
+    '''
+    cpu最忙的线程: pidstat的线程cpu(区间内的增量) 按nid关联 线程栈
+    :param threads_df: 线程cpu的df，即 ProcStat.threads_df(pid)，已按%CPU倒序
+    :param dump: 线程栈 ThreadDump
+    :param top: 取前几个线程
+    :return: [(线程cpu的行dict, 线程ThreadInfo)]，线程栈中没有的线程(如dump前已退出)为None
+    '''
+    ret = []
+    for row in threads_df.head(top).to_dict('records'):
+        ret.append((row, dump.by_nid.get(int(row['TID']))))
+    return ret
+
+'''
+多次dump的历史: 检测锁护航(lock convoy)，即同一把锁在连续多次dump中都有多个线程排队
+只保留每次dump的排队锁，不保留线程栈，内存占用很小
+'''
+class ThreadDumpHistory(object):
+
+    def __init__(self, min_waiters = 3, min_dumps = 2):
+        '''
+        :param min_waiters: 锁至少有几个线程排队才算
+        :param min_dumps: 锁至少在连续几次dump中都有排队才算护航
+        '''
+        self.min_waiters = min_waiters
+        self.min_dumps = min_dumps
+        self.contended = [] # 最近几次dump的排队锁: 锁地址 -> 锁信息
+
+    def add(self, dump):
+        '''
+        添加一次dump，并检测护航
+        :param dump: 线程栈 ThreadDump
+        :return: 护航的锁的list: [{lock, class, dumps, waiters, owners}]，其中waiters/owners为每次dump的排队线程数/持有线程
+        '''
+        locks = {lock['lock']: lock for lock in dump.contended_locks(self.min_waiters)}
+        self.contended.append(locks)
+        if len(self.contended) > self.min_dumps:
+            self.contended.pop(0)
+        if len(self.contended) < self.min_dumps:
+            return []
+        ret = []
+        for addr, lock in locks.items():
+            history = [c.get(addr) for c in self.contended]
+            # 同一地址但类不同，则是gc后地址被其他对象复用
+            if all(h is not None and h['class'] == lock['class'] for h in history):
+                ret.append({
+                    'lock': addr,
+                    'class': lock['class'],
+                    'dumps': len(history),
+                    'waiters': [h['waiters'] for h in history],
+                    'owners': [h['owner'] for h in history],
+                })
+        return ret
+
+def format_analysis(dump, hots = None, convoys = None, frames = 20):
+    '''
+    格式化分析结果为文本
+    :param dump: 线程栈 ThreadDump
+    :param hots: cpu最忙的线程，即 hot_threads() 的结果
+    :param convoys: 护航的锁，即 ThreadDumpHistory.add() 的结果
+    :param frames: 每个线程最多输出几个栈帧
+    :return: 文本
+    '''
+    lines = [f"线程栈时间: {dump.time}", f"线程数: {len(dump.threads)}",
+             "线程状态: " + ', '.join(f'{state}={n}' for state, n in dump.states().most_common())]
+    if hots:
+        lines.append("\n===== cpu最忙的线程 =====")
+        for i, (row, thread) in enumerate(hots):
+            lines.append(f"\n#{i + 1} TID={row['TID']} NID={row['NID']} Command={row['Command']} %CPU={row['%CPU']} %usr={row['%usr']} %system={row['%system']}")
+            lines.append("线程栈中没有该线程(可能是vm线程或已退出)" if thread is None else thread.format(frames))
+    deadlocks = dump.deadlocks()
+    if deadlocks or dump.jvm_deadlock:
+        lines.append("\n===== 死锁 =====")
+        if not deadlocks:
+            lines.append("jvm检测到死锁(Found one Java-level deadlock)，见线程栈文件末尾")
+        for i, cycle in enumerate(deadlocks):
+            lines.append(f"\n死锁#{i + 1}: " + ' -> '.join(f'"{t.name}"' for t in cycle + cycle[:1]))
+            for t in cycle:
+                lines.append(t.format(frames))
+    contended = dump.contended_locks()
+    if contended:
+        lines.append("\n===== 排队的锁 =====")
+        for lock in contended[:20]:
+            lines.append(f"<{lock['lock']}> (a {lock['class']}): 持有线程=\"{lock['owner']}\", 等待线程数={lock['waiters']}")
+    if convoys:
+        lines.append("\n===== 锁护航(连续多次dump都有多个线程排队) =====")
+        for lock in convoys:
+            lines.append(f"<{lock['lock']}> (a {lock['class']}): 连续{lock['dumps']}次dump, 等待线程数={lock['waiters']}, 持有线程={lock['owners']}")
+    return '\n'.join(lines) + '\n'
+
+# 保存分析结果
+def save_analysis(file, dump, hots = None, convoys = None, frames = 20):
+    write_text(file, format_analysis(dump, hots, convoys, frames))
+    return file
+
+if __name__ == '__main__':
+    text = '''2023-05-05 16:46:57
+Full thread dump OpenJDK 64-Bit Server VM (17.0.2+8-86 mixed mode, sharing):
+
+"t1" #11 prio=5 os_prio=0 cpu=1.00ms elapsed=1.00s tid=0x00007f2c4c0b6800 nid=0x1a2b waiting for monitor entry  [0x00007f2c1f4fe000]
+   java.lang.Thread.State: BLOCKED (on object monitor)
+	at Test.a(Test.java:10)
+	- waiting to lock <0x0000000001> (a java.lang.Object)
+	- locked <0x0000000002> (a java.lang.Object)
+
+"t2" #12 prio=5 os_prio=0 cpu=1.00ms elapsed=1.00s tid=0x00007f2c4c0b7800 nid=0x1a2c waiting for monitor entry  [0x00007f2c1f3fe000]
+   java.lang.Thread.State: BLOCKED (on object monitor)
+	at Test.b(Test.java:20)
+	- waiting to lock <0x0000000002> (a java.lang.Object)
+	- locked <0x0000000001> (a java.lang.Object)
+
+"VM Thread" os_prio=0 cpu=5.00ms elapsed=1.00s tid=0x00007f2c4c0a0000 nid=0x1a00 runnable
+'''
+    dump = ThreadDumpParser().parse_text(text)
+    print(format_analysis(dump))
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import re
+import time
+import numpy as np
+from pyutilb import ts
+from pyutilb.log import log
+from MonitorBoot import jvm_dumper
+from MonitorBoot.html_report import write_text
+from MonitorBoot.thread_dump_parser import ThreadDumpParser
+
+'''
+线程cpu的采样分析器: 回答"是什么在烧cpu"，不用在生产机上跑async-profiler
+   1 按固定频率读 /proc/pid/task/tid/stat 中的cpu时间，文件只打开一次，之后每次用pread重读，写到预分配的数组中
+   2 每隔几秒用 jcmd Thread.print 采样一次线程栈，将上次采样以来各线程的cpu增量归到该线程的栈上
+   3 聚合为火焰图的折叠栈(collapsed stacks)格式: 栈帧1;栈帧2;... cpu毫秒数，可直接用 flamegraph.pl 或 speedscope 打开
+'''
+
+# 时钟频率，用于将clock ticks转为秒
+clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# 正在采样的pid，同一进程同时只跑一个采样
+_running = set()
+
+# 线程名中的序号，如 GC Thread#3 -> GC Thread#，以便同类vm线程合并
+num_reg = re.compile(r'\d+')
+
+# 读线程的cpu时间(utime + stime，单位clock ticks)，线程已退出则返回None
+def read_cpu(fd):
+    try:
+        stat = os.pread(fd, 1024, 0)
+    except OSError:
+        return None
+    if not stat:
+        return None
+    # 线程名可能有空格与括号，因此从最后一个)后开始分割，utime/stime是第14/15个字段
+    fields = stat[stat.rfind(b')') + 2:].split()
+    return int(fields[11]) + int(fields[12])
+
+# 读线程名
+def read_comm(pid, tid):
+    try:
+        with open(f'/proc/{pid}/task/{tid}/comm', 'rb') as f:
+            return f.read().strip().decode('utf-8', 'replace')
+    except OSError:
+        return str(tid)
+
+# 栈帧去掉源码位置，如 com.Foo.bar(Foo.java:10) -> com.Foo.bar，同一方法的不同行才能合并
+def frame_name(frame):
+    i = frame.find('(')
+    return (frame if i == -1 else frame[:i]).replace(';', ':')
+
+class ThreadProfiler(object):
+
+    def __init__(self, pid, hz = 10, duration = 30, stack_interval = 5, thread_names = False):
+        '''
+        :param pid: 进程id
+        :param hz: 每秒读几次线程cpu
+        :param duration: 采样秒数
+        :param stack_interval: 每隔几秒采样一次线程栈，为None则不采样栈(如非java进程)，只按线程名聚合
+        :param thread_names: 折叠栈的根是否为线程名，否则只有vm线程等没有栈的线程才用线程名
+        '''
+        self.pid = int(pid)
+        self.hz = float(hz)
+        self.duration = float(duration)
+        self.stack_interval = None if stack_interval is None else float(stack_interval)
+        self.thread_names = thread_names
+        # 预分配数组: 采样次数 * 线程数，线程数不够再扩容
+        self.n = max(int(self.hz * self.duration), 1) + 1
+        self.times = np.zeros(self.n)
+        self.cpu = np.zeros((self.n, 256), dtype=np.int64)
+        self.rows = 0 # 已采样次数
+        self.cols = {} # tid -> 列
+        self.names = [] # 列 -> 线程名
+        self.fds = {} # tid -> stat文件的fd
+        self.stacks = [] # 线程栈采样: (采样行, ThreadDump)
+
+    # 采样一次线程cpu，写到第row行
+    def sample(self, row):
+        self.times[row] = time.time()
+        if row > 0:
+            self.cpu[row] = self.cpu[row - 1] # 已退出的线程保留最后的值
+        try:
+            tids = os.listdir(f'/proc/{self.pid}/task')
+        except OSError:
+            raise Exception(f"进程[{self.pid}]不存在或已退出")
+        for name in tids:
+            tid = int(name)
+            fd = self.fds.get(tid)
+            if fd is None:
+                try:
+                    fd = self.fds[tid] = os.open(f'/proc/{self.pid}/task/{tid}/stat', os.O_RDONLY)
+                except OSError: # 已退出
+                    continue
+            value = read_cpu(fd)
+            if value is None: # 已退出
+                os.close(self.fds.pop(tid))
+                continue
+            col = self.cols.get(tid)
+            if col is None:
+                col = self.add_thread(tid)
+            self.cpu[row, col] = value
+        self.rows = row + 1
+
+    # 新线程加一列，不够就扩容一倍
+    def add_thread(self, tid):
+        col = self.cols[tid] = len(self.names)
+        self.names.append(read_comm(self.pid, tid))
+        if col >= self.cpu.shape[1]:
+            self.cpu = np.concatenate([self.cpu, np.zeros_like(self.cpu)], axis=1)
+        return col
+
+    # 采样一次线程栈
+    async def sample_stack(self):
+        text = await jvm_dumper.thread_print(self.pid)
+        dump = await asyncio.get_running_loop().run_in_executor(None, ThreadDumpParser().parse_text, text)
+        self.stacks.append((self.rows - 1, dump))
+
+    # 采样，按固定频率读线程cpu，中间穿插线程栈采样
+    async def run(self):
+        if self.pid in _running:
+            raise Exception(f"进程[{self.pid}]的线程正在采样中")
+        _running.add(self.pid)
+        loop = asyncio.get_running_loop()
+        try:
+            stack_every = None if self.stack_interval is None else max(int(self.stack_interval * self.hz), 1)
+            start = time.time()
+            for row in range(self.n):
+                await loop.run_in_executor(None, self.sample, row)
+                if stack_every is not None and row > 0 and (row % stack_every == 0 or row == self.n - 1):
+                    try:
+                        await self.sample_stack()
+                    except Exception as ex: # 栈采样失败(如jcmd超时)不影响cpu采样
+                        log.error("ThreadProfiler.sample_stack()异常: " + str(ex), exc_info=ex)
+                # 按开始时间对齐下次采样，不累积误差
+                delay = start + (row + 1) / self.hz - time.time()
+                if row < self.n - 1 and delay > 0:
+                    await asyncio.sleep(delay)
+            return self
+        finally:
+            _running.discard(self.pid)
+            self.close()
+
+    # 关闭打开的stat文件
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+    # 各线程在[row1, row2]区间的cpu毫秒数
+    def cpu_ms(self, row1, row2):
+        cols = len(self.names)
+        return (self.cpu[row2, :cols] - self.cpu[row1, :cols]) * 1000 // clock_ticks
+
+    def threads_cpu(self):
+        '''
+        各线程在整个采样期间的cpu
+        :return: [(线程名, tid, cpu毫秒数, cpu使用率)]，按cpu倒序
+        '''
+        if self.rows < 2:
+            return []
+        ms = self.cpu_ms(0, self.rows - 1)
+        secs = self.times[self.rows - 1] - self.times[0]
+        tids = {col: tid for tid, col in self.cols.items()}
+        ret = [(self.names[col], tids[col], int(ms[col]), round(ms[col] / 10 / secs, 2)) for col in np.argsort(-ms) if ms[col] > 0]
+        return ret
+
+    def collapse(self):
+        '''
+        聚合为折叠栈: 每次栈采样的cpu增量 = 上次栈采样以来各线程的cpu，归到该线程本次采样的栈上
+        :return: 折叠栈 -> cpu毫秒数
+        '''
+        ret = {}
+        tids = {col: tid for tid, col in self.cols.items()}
+        # 没有栈采样则整个期间只按线程名聚合；最后一次栈采样之后的cpu(如栈采样失败)也归到最后一次栈采样上
+        rows = [row for row, _ in self.stacks[:-1]] + [self.rows - 1]
+        dumps = [dump for _, dump in self.stacks] or [None]
+        prev = 0
+        for row, dump in zip(rows, dumps):
+            ms = self.cpu_ms(prev, row)
+            prev = row
+            for col in np.flatnonzero(ms > 0):
+                thread = None if dump is None else dump.by_nid.get(tids[col])
+                if thread is None or not thread.frames: # vm线程或非java线程没有栈，用线程名
+                    name = self.names[col] if self.thread_names else num_reg.sub('', self.names[col])
+                    key = f'[{name}]'
+                else:
+                    key = ';'.join(frame_name(frame) for frame in reversed(thread.frames))
+                    if self.thread_names:
+                        key = f'[{thread.name}];' + key
+                ret[key] = ret.get(key, 0) + int(ms[col])
+        return ret
+
+    # 保存折叠栈文件
+    def save(self, file):
+        lines = [f'{stack} {ms}' for stack, ms in sorted(self.collapse().items())]
+        write_text(file, '\n'.join(lines) + '\n')
+        return file
+
+async def profile_threads(pid, filename_pref = None, hz = 10, duration = 30, stack_interval = 5, thread_names = False):
+    '''
+    采样线程cpu并导出折叠栈文件
+    :param pid: 进程id
+    :param filename_pref: 文件名前缀
+    :param hz: 每秒读几次线程cpu
+    :param duration: 采样秒数
+    :param stack_interval: 每隔几秒采样一次线程栈，为None则不采样栈
+    :param thread_names: 折叠栈的根是否为线程名
+    :return: 折叠栈文件
+    '''
+    profiler = await ThreadProfiler(pid, hz, duration, stack_interval, thread_names).run()
+    now = ts.now2str("%Y%m%d%H%M%S")
+    file = profiler.save(f'{filename_pref or "ThreadProfile"}-{now}.collapsed')
+    top = profiler.threads_cpu()[:5]
+    log.info("进程[%s]cpu最忙的线程: %s", pid, ', '.join(f'{name}[{tid}]={percent}%' for name, tid, _, percent in top))
+    return file
+
+if __name__ == '__main__':
+    file = asyncio.run(profile_threads(os.getpid(), '../data/ThreadProfile', 10, 2, None, True))
+    print(open(file).read())
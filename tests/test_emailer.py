@@ -0,0 +1,221 @@
+import asyncio
+import email
+import os
+import socket
+import threading
+import smtplib
+from email.header import decode_header, make_header
+import pytest
+
+aiosmtpd = pytest.importorskip('aiosmtpd')
+from aiosmtpd.controller import Controller
+from MonitorBoot import emailer
+
+# 本地smtp服务器的处理器: 记录收到的邮件，可指定前几封邮件返回的错误
+class Handler(object):
+
+    def __init__(self):
+        self.messages = [] # 收到的邮件
+        self.errors = [] # 依次返回的错误，如 '451 Try again later'
+        self.rcpt_error = None # 收件人被拒的错误，如 '550 No such user'
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if self.rcpt_error is not None:
+            return self.rcpt_error
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.errors:
+            return self.errors.pop(0)
+        self.messages.append(email.message_from_bytes(envelope.content))
+        return '250 Message accepted for delivery'
+
+    # 收到的邮件的标题
+    @property
+    def subjects(self):
+        return [str(make_header(decode_header(msg['Subject']))) for msg in self.messages]
+
+# 空闲端口
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# 本地smtp服务器，Controller不能重复启动，因此重启时新建
+class Server(object):
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.port = free_port()
+        self.controller = None
+
+    def start(self):
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=self.port)
+        self.controller.start()
+
+    def stop(self):
+        if self.controller is not None:
+            self.controller.stop()
+            self.controller = None
+
+    # 重启: 之前的连接都会断开
+    def restart(self):
+        self.stop()
+        self.start()
+
+# 在临时目录中执行: 重试的告警日志会写到当前目录的boot.log
+@pytest.fixture(scope='module', autouse=True)
+def workdir(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('emailer'))
+    yield
+    os.chdir(cwd)
+
+@pytest.fixture
+def handler():
+    return Handler()
+
+@pytest.fixture
+def server(handler):
+    server = Server(handler)
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture(autouse=True)
+def config(server, monkeypatch):
+    emailer.config_email({
+        'host': '127.0.0.1',
+        'port': server.port,
+        'password': '',
+        'from_name': 'MonitorBoot',
+        'from_email': 'aaa@localhost',
+        'to_email': 'bbb@localhost',
+        'timeout': 5,
+        'retries': 3,
+    })
+    # 记录退避的次数，不真的等
+    backoffs = []
+    def backoff_seconds(i):
+        backoffs.append(i)
+        return 0
+    monkeypatch.setattr(emailer, 'backoff_seconds', backoff_seconds)
+    yield backoffs
+    emailer.config_email({})
+
+def test_send(handler):
+    emailer.send_email('同步邮件', 'hello')
+    asyncio.run(emailer.send_email_async('异步邮件', 'world'))
+    assert handler.subjects == ['同步邮件', '异步邮件']
+    assert handler.messages[0]['To'] == 'bbb@localhost'
+
+def test_reuse_connection(handler):
+    for i in range(3):
+        emailer.send_email(f'邮件{i}', 'hello')
+    assert len(handler.subjects) == 3
+    assert emailer.get_pool().idle.qsize() == 1 # 顺序发送只用了一个连接
+
+def test_reconnect(handler, server, config):
+    emailer.send_email('断线前', 'hello')
+    server.restart()
+    emailer.send_email('断线后', 'hello')
+    assert handler.subjects == ['断线前', '断线后']
+    assert config == [0] # 断线的连接发送失败，重试一次就换了新连接
+
+def test_reconnect_idle(handler, server, config):
+    emailer.send_email('断线前', 'hello')
+    emailer.get_pool().max_idle = 0 # 借出前都检查连接是否存活
+    server.restart()
+    emailer.send_email('断线后', 'hello')
+    assert handler.subjects == ['断线前', '断线后']
+    assert config == [] # noop检查出断线，直接新建连接，不用重试
+
+def test_retry_backoff(handler, config):
+    handler.errors = ['451 Try again later', '452 Insufficient storage']
+    asyncio.run(emailer.send_email_async('临时错误', 'hello'))
+    assert handler.subjects == ['临时错误']
+    assert config == [0, 1] # 第i次重试前退避 backoff * 2^i 秒
+
+def test_retry_exhausted(handler, config):
+    handler.errors = ['451 Try again later'] * 10
+    with pytest.raises(smtplib.SMTPDataError):
+        emailer.send_email('一直失败', 'hello')
+    assert config == [0, 1, 2]
+    assert handler.messages == []
+
+def test_no_retry_permanent_error(handler, config):
+    handler.errors = ['554 Transaction failed']
+    with pytest.raises(smtplib.SMTPDataError):
+        emailer.send_email('永久错误', 'hello')
+    handler.rcpt_error = '550 No such user'
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        emailer.send_email('收件人被拒', 'hello')
+    assert config == []
+
+def test_is_retryable():
+    assert emailer.is_retryable(smtplib.SMTPServerDisconnected())
+    assert emailer.is_retryable(smtplib.SMTPConnectError(421, 'busy'))
+    assert emailer.is_retryable(smtplib.SMTPDataError(451, 'later'))
+    assert emailer.is_retryable(socket.timeout())
+    assert emailer.is_retryable(ConnectionRefusedError())
+    assert not emailer.is_retryable(smtplib.SMTPDataError(554, 'failed'))
+    assert not emailer.is_retryable(smtplib.SMTPAuthenticationError(535, 'bad password'))
+    assert not emailer.is_retryable(smtplib.SMTPRecipientsRefused({'bbb@localhost': (550, b'no such user')}))
+    assert not emailer.is_retryable(smtplib.SMTPNotSupportedError())
+
+# 等到服务器收到n封邮件
+async def wait_messages(handler, n, timeout = 5):
+    for _ in range(int(timeout * 100)):
+        if len(handler.messages) >= n:
+            return
+        await asyncio.sleep(0.01)
+
+def test_digest_window(handler):
+    emailer.config['digest_window'] = 0.2
+    async def run():
+        for i in range(3):
+            await emailer.send_email_async(f'告警{i}', f'内容{i}')
+        assert handler.messages == [] # 窗口内不发送
+        await wait_messages(handler, 1)
+        await asyncio.sleep(0.3)
+    asyncio.run(run())
+    assert handler.subjects == ['[3个告警] 告警0']
+    body = handler.messages[0].get_payload(decode=True).decode('utf-8')
+    assert '1. 告警0\n内容0' in body and '3. 告警2\n内容2' in body
+
+def test_digest_max(handler):
+    emailer.config['digest_window'] = 60
+    emailer.config['digest_max'] = 2
+    async def run():
+        for i in range(2):
+            await emailer.send_email_async(f'告警{i}', f'内容{i}')
+        await wait_messages(handler, 1) # 够数就立即发送，不等窗口结束
+    asyncio.run(run())
+    assert handler.subjects == ['[2个告警] 告警0']
+
+def test_digest_single(handler):
+    emailer.config['digest_window'] = 0.1
+    async def run():
+        await emailer.send_email_async('告警', '内容')
+        await wait_messages(handler, 1)
+    asyncio.run(run())
+    assert handler.subjects == ['告警'] # 只有一个告警则原样发送
+
+def test_digest_threads(handler):
+    emailer.config['digest_window'] = 0.3
+    emailer.config['digest_max'] = 1000
+    # 多个线程各自的事件循环同时发告警，如告警动作执行器的各通道
+    def run(i):
+        async def send():
+            for j in range(10):
+                await emailer.send_email_async(f'告警{i}-{j}', '内容')
+        asyncio.run(send())
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    asyncio.run(wait_messages(handler, 1))
+    assert len(handler.subjects) == 1
+    assert handler.subjects[0].startswith('[50个告警]')